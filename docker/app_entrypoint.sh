@@ -18,6 +18,11 @@ case "${SERVICE}" in
         echo "Starting Celery Worker"
         exec ./run_worker.sh
         ;;
+    station_worker)
+        echo "Starting Station Worker"
+        cd ..
+        exec ./docker/run_station_worker.sh "$@"
+        ;;
     map)
         echo "Creating datamaps image tiles."
         cd ..
@@ -38,6 +43,6 @@ case "${SERVICE}" in
         fi
         ;;
     *)
-        echo "Usage: $0 {scheduler|web|worker|shell}"
+        echo "Usage: $0 {scheduler|web|worker|station_worker|shell}"
         exit 1
 esac
@@ -0,0 +1,3 @@
+#!/bin/sh
+
+python ./ichnaea/scripts/station_worker.py "$@"
@@ -1,7 +1,7 @@
 # cython: language_level=3, emit_code_comments=False
 
 from libc.math cimport asin, atan, atan2, cos
-from libc.math cimport fmax, fmin, M_PI, sin, sqrt, tan
+from libc.math cimport fmax, fmin, M_PI, rint, sin, sqrt, tan
 from numpy cimport double_t, ndarray
 cimport cython
 
@@ -445,6 +445,136 @@ cpdef double max_distance(double lat, double lon,
     return result
 
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef ndarray haversine_distances(double lat, double lon,
+                                  ndarray[double_t, ndim=1] lats,
+                                  ndarray[double_t, ndim=1] lons):
+    """
+    Compute the Haversine distance in meters from the given lat/lon
+    point to each of the points given by the lats and lons arrays.
+    """
+    cdef Py_ssize_t i, length
+    cdef double a, cos_lat, rad_lat, rad_lon, rad_lat2, sin_dlat, sin_dlon
+    cdef ndarray[double_t, ndim=1] result
+
+    length = lats.shape[0]
+    if lons.shape[0] != length:
+        raise ValueError("lats and lons must have the same length.")
+
+    rad_lat = deg2rad(lat)
+    rad_lon = deg2rad(lon)
+    cos_lat = cos(rad_lat)
+    result = numpy.zeros(length, dtype=numpy.double)
+
+    for i in range(length):
+        rad_lat2 = deg2rad(lats[i])
+        sin_dlat = sin((rad_lat2 - rad_lat) / 2.0)
+        sin_dlon = sin((deg2rad(lons[i]) - rad_lon) / 2.0)
+        a = sin_dlat ** 2 + cos_lat * cos(rad_lat2) * sin_dlon ** 2
+        result[i] = 1000.0 * 2.0 * EARTH_RADIUS * asin(fmin(1, sqrt(a)))
+    return result
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef ndarray pairwise_haversine_distance(ndarray[double_t, ndim=1] lats,
+                                          ndarray[double_t, ndim=1] lons):
+    """
+    Compute the Haversine distance in meters between all pairs of the
+    given lat/lon points.
+
+    The result is returned as a condensed distance matrix, in the
+    same order as :func:`scipy.spatial.distance.pdist` would return
+    it, and can be passed directly to
+    :func:`scipy.cluster.hierarchy.linkage`.
+    """
+    cdef Py_ssize_t i, j, k, length
+    cdef double a, cos_lat_i, sin_dlat, sin_dlon
+    cdef ndarray[double_t, ndim=1] rad_lats, rad_lons, cos_lats, result
+
+    length = lats.shape[0]
+    if lons.shape[0] != length:
+        raise ValueError("lats and lons must have the same length.")
+
+    rad_lats = numpy.radians(lats)
+    rad_lons = numpy.radians(lons)
+    cos_lats = numpy.cos(rad_lats)
+    result = numpy.zeros(length * (length - 1) // 2, dtype=numpy.double)
+
+    k = 0
+    for i in range(length - 1):
+        cos_lat_i = cos_lats[i]
+        for j in range(i + 1, length):
+            sin_dlat = sin((rad_lats[j] - rad_lats[i]) / 2.0)
+            sin_dlon = sin((rad_lons[j] - rad_lons[i]) / 2.0)
+            a = sin_dlat ** 2 + cos_lat_i * cos_lats[j] * sin_dlon ** 2
+            result[k] = 1000.0 * 2.0 * EARTH_RADIUS * asin(fmin(1, sqrt(a)))
+            k += 1
+    return result
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef ndarray distances(ndarray[double_t, ndim=1] lats1,
+                        ndarray[double_t, ndim=1] lons1,
+                        ndarray[double_t, ndim=1] lats2,
+                        ndarray[double_t, ndim=1] lons2):
+    """
+    Compute the :func:`distance` in meters between each pair of points,
+    the first points given by lats1 and lons1, the second points by
+    lats2 and lons2.
+    """
+    cdef Py_ssize_t i, length
+    cdef ndarray[double_t, ndim=1] result
+
+    length = lats1.shape[0]
+    if (lons1.shape[0] != length or
+            lats2.shape[0] != length or lons2.shape[0] != length):
+        raise ValueError("All arrays must have the same length.")
+
+    result = numpy.zeros(length, dtype=numpy.double)
+    for i in range(length):
+        result[i] = distance(lats1[i], lons1[i], lats2[i], lons2[i])
+    return result
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef ndarray circle_radii(ndarray[double_t, ndim=1] lats,
+                           ndarray[double_t, ndim=1] lons,
+                           ndarray[double_t, ndim=1] max_lats,
+                           ndarray[double_t, ndim=1] max_lons,
+                           ndarray[double_t, ndim=1] min_lats,
+                           ndarray[double_t, ndim=1] min_lons):
+    """
+    Compute the :func:`circle_radius` for each of the given points and
+    bounding boxes.
+    """
+    cdef Py_ssize_t i, length
+    cdef double lat, lon, radius
+    cdef ndarray[long, ndim=1] result
+
+    length = lats.shape[0]
+    if (lons.shape[0] != length or
+            max_lats.shape[0] != length or max_lons.shape[0] != length or
+            min_lats.shape[0] != length or min_lons.shape[0] != length):
+        raise ValueError("All arrays must have the same length.")
+
+    result = numpy.zeros(length, dtype=numpy.int_)
+    for i in range(length):
+        lat = lats[i]
+        lon = lons[i]
+        radius = 0.0
+        radius = fmax(radius, distance(lat, lon, min_lats[i], min_lons[i]))
+        radius = fmax(radius, distance(lat, lon, min_lats[i], max_lons[i]))
+        radius = fmax(radius, distance(lat, lon, max_lats[i], min_lons[i]))
+        radius = fmax(radius, distance(lat, lon, max_lats[i], max_lons[i]))
+        # rint rounds half to even, like the round builtin.
+        result[i] = <long>rint(radius)
+    return result
+
+
 cpdef list random_points(long lat, long lon, int num):
     """
     Given a row from the datamap table, return a list of
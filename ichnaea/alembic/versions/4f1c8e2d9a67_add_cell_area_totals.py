@@ -0,0 +1,53 @@
+"""Add running total columns to cell_area table.
+
+Revision ID: 4f1c8e2d9a67
+Revises: 3be4004781bc
+Create Date: 2026-10-18 10:12:41.530212
+"""
+
+import logging
+
+from alembic import op
+import sqlalchemy as sa
+
+
+log = logging.getLogger("alembic.migration")
+revision = "4f1c8e2d9a67"
+down_revision = "3be4004781bc"
+
+
+def upgrade():
+    log.info("Add running total columns to cell_area table.")
+    op.execute(
+        sa.text(
+            "ALTER TABLE cell_area "
+            "ADD COLUMN `sum_lat` DOUBLE AFTER `last_seen`, "
+            "ADD COLUMN `sum_lon` DOUBLE AFTER `sum_lat`, "
+            "ADD COLUMN `sum_radius` BIGINT(20) UNSIGNED AFTER `sum_lon`, "
+            "ADD COLUMN `num_radius` INT(10) UNSIGNED AFTER `sum_radius`, "
+            "ADD COLUMN `max_lat` DOUBLE AFTER `num_radius`, "
+            "ADD COLUMN `min_lat` DOUBLE AFTER `max_lat`, "
+            "ADD COLUMN `max_lon` DOUBLE AFTER `min_lat`, "
+            "ADD COLUMN `min_lon` DOUBLE AFTER `max_lon`, "
+            "ADD COLUMN `region_counts` TEXT AFTER `min_lon`, "
+            "ADD COLUMN `totals_modified` DATETIME AFTER `region_counts`"
+        )
+    )
+
+
+def downgrade():
+    op.execute(
+        sa.text(
+            "ALTER TABLE cell_area "
+            "DROP COLUMN `sum_lat`, "
+            "DROP COLUMN `sum_lon`, "
+            "DROP COLUMN `sum_radius`, "
+            "DROP COLUMN `num_radius`, "
+            "DROP COLUMN `max_lat`, "
+            "DROP COLUMN `min_lat`, "
+            "DROP COLUMN `max_lon`, "
+            "DROP COLUMN `min_lon`, "
+            "DROP COLUMN `region_counts`, "
+            "DROP COLUMN `totals_modified`"
+        )
+    )
@@ -42,7 +42,13 @@ class BluePositionMixin(object):
     def search_blue(self, query):
         results = self.result_list()
 
-        blues = query_macs(query, query.blue, self.raven_client, BlueShard)
+        blues = query_macs(
+            query,
+            query.blue,
+            self.raven_client,
+            BlueShard,
+            redis_client=self.redis_client,
+        )
         for cluster in cluster_networks(
             blues,
             query.blue,
@@ -80,7 +86,13 @@ class BlueRegionMixin(object):
 
         now = util.utcnow()
         regions = defaultdict(int)
-        blues = query_macs(query, query.blue, self.raven_client, BlueShard)
+        blues = query_macs(
+            query,
+            query.blue,
+            self.raven_client,
+            BlueShard,
+            redis_client=self.redis_client,
+        )
         for blue in blues:
             regions[blue.region] += station_score(blue, now)
 
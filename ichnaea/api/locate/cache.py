@@ -0,0 +1,388 @@
+"""
+A two tier cache for the station rows loaded by the locate searches.
+
+The first tier is kept in-process, the optional second tier is shared
+between all web workers via Redis.
+"""
+
+from collections import namedtuple
+from random import randint
+import time
+
+from cachetools import TLRUCache
+from gevent.lock import RLock
+import markus
+from redis.exceptions import RedisError
+from sqlalchemy import select, union_all
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from ichnaea.cache import decode_station, encode_station, station_cache_key
+from ichnaea.conf import settings
+from ichnaea.models import decode_cellid, decode_mac
+
+METRICS = markus.get_metrics()
+
+_MISSING = object()
+
+# The fields loaded from the station tables, used in the score
+# calculation and for the position or region.
+MAC_FIELDS = (
+    "mac",
+    "lat",
+    "lon",
+    "radius",
+    "region",
+    "samples",
+    "created",
+    "modified",
+    "last_seen",
+    "block_last",
+    "block_count",
+)
+CELL_FIELDS = (
+    "cellid",
+    "lat",
+    "lon",
+    "radius",
+    "region",
+    "samples",
+    "created",
+    "modified",
+    "last_seen",
+    "block_last",
+    "block_count",
+)
+AREA_FIELDS = (
+    "areaid",
+    "lat",
+    "lon",
+    "radius",
+    "region",
+    "num_cells",
+    "created",
+    "modified",
+    "last_seen",
+)
+
+MacRow = namedtuple("MacRow", MAC_FIELDS)
+CellRow = namedtuple("CellRow", CELL_FIELDS)
+AreaRow = namedtuple("AreaRow", AREA_FIELDS)
+
+UNION_SHARD_QUERIES = settings("locate_union_shard_queries")
+
+# The errors raised for statements running longer than their time limit,
+# MySQL's ER_QUERY_TIMEOUT and MariaDB's ER_STATEMENT_TIMEOUT.
+_ER_QUERY_TIMEOUT = 3024
+_ER_STATEMENT_TIMEOUT = 1969
+
+# Row classes and station key decoders for the data types stored in
+# the shared cache tier.
+_SHARED_ROWS = {
+    "blue": (MacRow, decode_mac),
+    "cell": (CellRow, decode_cellid),
+    "wifi": (MacRow, decode_mac),
+}
+
+
+class QueryTimeout(Exception):
+    """
+    A station query took longer than its time limit. The rows loaded by
+    the shard queries which finished in time are kept in `rows`.
+    """
+
+    def __init__(self, rows):
+        super(QueryTimeout, self).__init__("Station query timed out.")
+        self.rows = rows
+
+
+def query_shards(session, shard_keys, fields, key_field, union=None, timeout=None):
+    """
+    Load the station rows with a position for the given keys.
+
+    `shard_keys` maps shard models to the list of keys to load from each
+    shard. If `union` is true, all shards are queried in a single
+    UNION ALL statement, paying for only one database round trip.
+    Otherwise one query per shard is run. `union` defaults to the
+    ``LOCATE_UNION_SHARD_QUERIES`` setting.
+
+    If a `timeout` in seconds is given, MySQL and MariaDB abort statements
+    which run for longer than that, and :class:`QueryTimeout` is raised.
+    """
+    if union is None:
+        union = UNION_SHARD_QUERIES
+
+    statements = []
+    for shard, keys in shard_keys.items():
+        columns = shard.__table__.c
+        statements.append(
+            select([getattr(columns, field) for field in fields])
+            .where(columns.lat.isnot(None))
+            .where(columns.lon.isnot(None))
+            .where(getattr(columns, key_field).in_(keys))
+        )
+
+    if union and len(statements) > 1:
+        statements = [union_all(*statements)]
+
+    rows = []
+    for statement in statements:
+        if timeout is not None:
+            statement = _TimeLimitedSelect(statement, timeout)
+        try:
+            rows.extend(session.execute(statement).fetchall())
+        except OperationalError as exc:
+            if timeout is None or exc.orig.args[:1] not in (
+                (_ER_QUERY_TIMEOUT,),
+                (_ER_STATEMENT_TIMEOUT,),
+            ):
+                raise
+            if key_field == "areaid":
+                datatype = "area"
+            else:
+                datatype = next(iter(shard_keys)).__tablename__.split("_")[0]
+            METRICS.incr("locate.budget.timeout", tags=["type:%s" % datatype])
+            raise QueryTimeout(rows)
+    return rows
+
+
+class _TimeLimitedSelect(Executable, ClauseElement):
+    """A select or union statement, aborted after `timeout` seconds."""
+
+    def __init__(self, statement, timeout):
+        self.statement = statement
+        self.timeout = timeout
+
+
+@compiles(_TimeLimitedSelect)
+def _compile_time_limited_select(element, compiler, **kw):
+    # Other databases don't limit the statement.
+    return compiler.process(element.statement, **kw)
+
+
+@compiles(_TimeLimitedSelect, "mysql")
+def _compile_time_limited_select_mysql(element, compiler, **kw):
+    # A zero limit would disable the server side limit.
+    if compiler.dialect._is_mariadb:
+        # MariaDB ignores the MySQL optimizer hint, but has a statement
+        # time limit in seconds.
+        return "SET STATEMENT max_statement_time=%.3f FOR %s" % (
+            max(element.timeout, 0.001),
+            compiler.process(element.statement, **kw),
+        )
+
+    # The optimizer hint has to follow the first SELECT keyword,
+    # it limits the entire statement, including all parts of a union.
+    statement = element.statement
+    hint = "/*+ MAX_EXECUTION_TIME(%d) */" % max(int(element.timeout * 1000), 1)
+    if hasattr(statement, "selects"):
+        first, *rest = statement.selects
+        statement = union_all(first.prefix_with(hint), *rest)
+    else:
+        statement = statement.prefix_with(hint)
+    return compiler.process(statement, **kw)
+
+
+class _StationTLRUCache(TLRUCache):
+    """A TLRUCache which emits a metric for each item evicted due to size."""
+
+    def popitem(self):
+        key, value = super(_StationTLRUCache, self).popitem()
+        METRICS.incr("locate.station_cache.eviction", tags=["type:%s" % key[0]])
+        return (key, value)
+
+
+class StationCache(object):
+    """
+    A bounded, per-process cache of station rows.
+
+    Entries are keyed by the data type, the station table name and the
+    station key as used in the database query. Stations which weren't
+    found in the database are cached as negative entries, with a shorter
+    time-to-live than positive entries.
+
+    The cache only stores rows, it never decides if a station is blocked.
+    Callers have to check :func:`ichnaea.models.station_blocked` for each
+    row, cached or not.
+
+    A size of zero disables the cache.
+
+    Blue, cell and wifi rows can additionally be stored in Redis, as
+    compact records created by :func:`ichnaea.cache.encode_station`.
+    A shared time-to-live of zero disables this tier. The station
+    updaters delete the shared entries of all stations they change,
+    the time-to-live bounds how long a row read from a lagging database
+    replica can stay cached.
+    """
+
+    def __init__(
+        self,
+        maxsize,
+        ttl,
+        negative_ttl,
+        shared_ttl=0,
+        shared_negative_ttl=0,
+        timer=time.monotonic,
+    ):
+        self.lock = RLock()
+        self.timer = timer
+        self.shared_ttl = shared_ttl
+        self.shared_negative_ttl = shared_negative_ttl
+        self.configure(maxsize, ttl, negative_ttl)
+
+    def configure(self, maxsize, ttl, negative_ttl):
+        """Change the cache limits, dropping all cached entries."""
+        with self.lock:
+            self.maxsize = maxsize
+            self.ttl = ttl
+            self.negative_ttl = negative_ttl
+            self.cache = _StationTLRUCache(
+                maxsize=max(maxsize, 1), ttu=self._ttu, timer=self.timer
+            )
+
+    @property
+    def enabled(self):
+        return self.maxsize > 0 and self.ttl > 0
+
+    @property
+    def shared_enabled(self):
+        return self.shared_ttl > 0
+
+    def _ttu(self, key, value, now):
+        if value is None:
+            return now + self.negative_ttl
+        return now + self.ttl
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+    def get_many(self, datatype, table, keys, redis_client=None):
+        """
+        Look up the given station keys.
+
+        Return a tuple of a dictionary mapping the found keys to their
+        cached rows, or `None` for negative entries, and a list of keys
+        which weren't found in the cache.
+
+        Keys which aren't cached in-process are looked up in the shared
+        tier, if it is enabled and a `redis_client` is given.
+        """
+        found = {}
+        missing = list(keys)
+        if self.enabled:
+            found, missing = self._get_local(datatype, table, missing)
+
+        if missing and redis_client is not None and self._is_shared(datatype):
+            shared, missing = self._get_shared(redis_client, datatype, table, missing)
+            if shared:
+                found.update(shared)
+                self._set_local(datatype, table, list(shared.keys()), shared)
+
+        return (found, missing)
+
+    def set_many(self, datatype, table, keys, rows, redis_client=None):
+        """
+        Store the rows loaded from the database for the given keys.
+
+        `rows` maps station keys to rows, keys without a row are stored
+        as negative entries. A negative time-to-live of zero disables
+        negative entries.
+        """
+        self._set_local(datatype, table, keys, rows)
+        if keys and redis_client is not None and self._is_shared(datatype):
+            self._set_shared(redis_client, datatype, table, keys, rows)
+
+    def _is_shared(self, datatype):
+        return self.shared_enabled and datatype in _SHARED_ROWS
+
+    def _get_local(self, datatype, table, keys):
+        found = {}
+        missing = []
+        with self.lock:
+            for key in keys:
+                value = self.cache.get((datatype, table, key), _MISSING)
+                if value is _MISSING:
+                    missing.append(key)
+                else:
+                    found[key] = value
+
+        tags = ["type:%s" % datatype]
+        if found:
+            METRICS.incr("locate.station_cache", len(found), tags=tags + ["status:hit"])
+        if missing:
+            METRICS.incr(
+                "locate.station_cache", len(missing), tags=tags + ["status:miss"]
+            )
+        return (found, missing)
+
+    def _set_local(self, datatype, table, keys, rows):
+        if not self.enabled:
+            return
+
+        with self.lock:
+            for key in keys:
+                self.cache[(datatype, table, key)] = rows.get(key)
+
+    def _get_shared(self, redis_client, datatype, table, keys):
+        tags = ["type:%s" % datatype]
+        try:
+            values = redis_client.mget([station_cache_key(table, key) for key in keys])
+        except RedisError:
+            METRICS.incr("locate.station_cache.shared", tags=tags + ["status:failure"])
+            return ({}, keys)
+
+        row_type, decode_key = _SHARED_ROWS[datatype]
+        found = {}
+        missing = []
+        for key, value in zip(keys, values):
+            if value is None:
+                missing.append(key)
+            elif value == b"":
+                found[key] = None
+            else:
+                found[key] = row_type(decode_key(key), *decode_station(value))
+
+        if found:
+            METRICS.incr(
+                "locate.station_cache.shared", len(found), tags=tags + ["status:hit"]
+            )
+        if missing:
+            METRICS.incr(
+                "locate.station_cache.shared",
+                len(missing),
+                tags=tags + ["status:miss"],
+            )
+        return (found, missing)
+
+    def _set_shared(self, redis_client, datatype, table, keys, rows):
+        try:
+            with redis_client.pipeline() as pipe:
+                for key in keys:
+                    row = rows.get(key)
+                    cache_key = station_cache_key(table, key)
+                    if row is not None:
+                        pipe.set(cache_key, encode_station(row), ex=self.shared_ttl)
+                    elif self.shared_negative_ttl > 0:
+                        pipe.set(cache_key, b"", ex=self.shared_negative_ttl)
+                pipe.execute()
+        except RedisError:
+            METRICS.incr(
+                "locate.station_cache.shared",
+                tags=["type:%s" % datatype, "status:failure"],
+            )
+
+
+# Time-to-live values are spread by +/- 10% to avoid all web workers
+# refreshing the same popular stations at the same time.
+_TTL = settings("locate_station_cache_ttl")
+_NEGATIVE_TTL = settings("locate_station_cache_negative_ttl")
+
+STATION_CACHE = StationCache(
+    maxsize=settings("locate_station_cache_size"),
+    ttl=_TTL + randint(-_TTL // 10, _TTL // 10),
+    negative_ttl=_NEGATIVE_TTL + randint(-_NEGATIVE_TTL // 10, _NEGATIVE_TTL // 10),
+    shared_ttl=settings("locate_station_shared_cache_ttl"),
+    shared_negative_ttl=settings("locate_station_shared_cache_negative_ttl"),
+)
@@ -5,8 +5,16 @@ from collections import defaultdict
 import math
 
 import numpy
-from sqlalchemy import select
 
+from ichnaea.api.locate.cache import (
+    AREA_FIELDS,
+    AreaRow,
+    CELL_FIELDS,
+    CellRow,
+    query_shards,
+    QueryTimeout,
+    STATION_CACHE,
+)
 from ichnaea.api.locate.constants import (
     CELL_MIN_ACCURACY,
     CELL_MAX_ACCURACY,
@@ -173,28 +181,13 @@ def aggregate_cell_position(networks, min_accuracy, max_accuracy):
     return (float(lat), float(lon), float(accuracy), float(score))
 
 
-def query_cells(query, lookups, model, raven_client):
+def query_cells(query, lookups, model, raven_client, redis_client=None):
     # Given a location query and a list of lookup instances, query the
     # database and return a list of model objects.
     cellids = [lookup.cellid for lookup in lookups]
     if not cellids:
         return []
 
-    # load all fields used in score calculation and those we
-    # need for the position
-    load_fields = (
-        "cellid",
-        "lat",
-        "lon",
-        "radius",
-        "region",
-        "samples",
-        "created",
-        "modified",
-        "last_seen",
-        "block_last",
-        "block_count",
-    )
     result = []
     today = util.utcnow().date()
 
@@ -203,19 +196,47 @@ def query_cells(query, lookups, model, raven_client):
         for lookup in lookups:
             shards[model.shard_model(lookup.radioType)].append(lookup.cellid)
 
+        rows = []
+        missing = {}
         for shard, shard_cellids in shards.items():
-            columns = shard.__table__.c
-            fields = [getattr(columns, f) for f in load_fields]
-            rows = (
-                query.session.execute(
-                    select(fields)
-                    .where(columns.lat.isnot(None))
-                    .where(columns.lon.isnot(None))
-                    .where(columns.cellid.in_(shard_cellids))
+            cached, shard_cellids = STATION_CACHE.get_many(
+                "cell", shard.__tablename__, shard_cellids, redis_client=redis_client
+            )
+            rows.extend([row for row in cached.values() if row is not None])
+            if shard_cellids:
+                missing[shard] = shard_cellids
+
+        if missing:
+            timed_out = False
+            try:
+                station_rows = query_shards(
+                    query.session,
+                    missing,
+                    CELL_FIELDS,
+                    "cellid",
+                    timeout=query.remaining_time(),
+                )
+            except QueryTimeout as exc:
+                # Make do with the rows found so far.
+                station_rows = exc.rows
+                timed_out = True
+            loaded = {encode_cellid(*row.cellid): CellRow(*row) for row in station_rows}
+            for shard, shard_cellids in missing.items():
+                if timed_out:
+                    # Don't cache the stations which weren't looked up.
+                    shard_cellids = [
+                        cellid for cellid in shard_cellids if cellid in loaded
+                    ]
+                STATION_CACHE.set_many(
+                    "cell",
+                    shard.__tablename__,
+                    shard_cellids,
+                    loaded,
+                    redis_client=redis_client,
                 )
-            ).fetchall()
+            rows.extend(loaded.values())
 
-            result.extend([row for row in rows if not station_blocked(row, today)])
+        result = [row for row in rows if not station_blocked(row, today)]
     except Exception:
         raven_client.captureException()
 
@@ -227,30 +248,28 @@ def query_areas(query, lookups, model, raven_client):
     if not areaids:
         return []
 
-    # load all fields used in score calculation and those we
-    # need for the position or region
-    load_fields = (
-        "areaid",
-        "lat",
-        "lon",
-        "radius",
-        "region",
-        "num_cells",
-        "created",
-        "modified",
-        "last_seen",
-    )
     try:
-        columns = model.__table__.c
-        fields = [getattr(columns, f) for f in load_fields]
-        rows = (
-            query.session.execute(
-                select(fields)
-                .where(columns.lat.isnot(None))
-                .where(columns.lon.isnot(None))
-                .where(columns.areaid.in_(areaids))
-            )
-        ).fetchall()
+        table = model.__tablename__
+        cached, areaids = STATION_CACHE.get_many("area", table, areaids)
+        rows = [row for row in cached.values() if row is not None]
+
+        if areaids:
+            try:
+                area_rows = query_shards(
+                    query.session,
+                    {model: areaids},
+                    AREA_FIELDS,
+                    "areaid",
+                    timeout=query.remaining_time(),
+                )
+            except QueryTimeout as exc:
+                # Make do with the rows found so far.
+                area_rows = exc.rows
+                # Don't cache the areas which weren't looked up.
+                areaids = []
+            loaded = {encode_cellarea(*row.areaid): AreaRow(*row) for row in area_rows}
+            STATION_CACHE.set_many("area", table, areaids, loaded)
+            rows.extend(loaded.values())
 
         return rows
     except Exception:
@@ -277,7 +296,13 @@ class CellPositionMixin(object):
         results = self.result_list()
 
         if query.cell:
-            cells = query_cells(query, query.cell, self.cell_model, self.raven_client)
+            cells = query_cells(
+                query,
+                query.cell,
+                self.cell_model,
+                self.raven_client,
+                redis_client=self.redis_client,
+            )
             if cells:
                 for cluster in cluster_cells(cells, query.cell):
                     lat, lon, accuracy, score = aggregate_cell_position(
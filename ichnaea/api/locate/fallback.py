@@ -21,7 +21,12 @@ from ichnaea.api.schema import (
 )
 from ichnaea.api.locate.constants import DataSource
 from ichnaea.api.locate.source import PositionSource
-from ichnaea.api.rate_limit import rate_limit_exceeded
+from ichnaea.api.rate_limit import (
+    rate_limit_exceeded,
+    RATE_LIMIT_COUNTER,
+    STRICT_KEYS,
+)
+from ichnaea.conf import settings
 from geocalc import distance
 
 # Magic constant to cache not found.
@@ -34,6 +39,8 @@ GOOGLEMAPS_V1_SCHEMA = "googlemaps/v1"
 UNWIREDLABS_V1_SCHEMA = "unwiredlabs/v1"
 # Default fallback schema, if schema is None/NULL
 DEFAULT_SCHEMA = ICHNAEA_V1_SCHEMA
+# Maximum time in seconds for an external fallback call.
+FALLBACK_TIMEOUT = 5.0
 
 
 METRICS = markus.get_metrics()
@@ -369,7 +376,15 @@ class FallbackCache(object):
         clustered_results = defaultdict(list)
         not_found_cluster = (None, None, None)
         try:
-            for value in self.redis_client.mget(cache_keys):
+            if query.redis_coalescer is not None:
+                # Sent along with the request's pending Redis commands.
+                [values] = query.redis_coalescer.execute(
+                    lambda pipe: pipe.mget(cache_keys)
+                )
+            else:
+                values = self.redis_client.mget(cache_keys)
+
+            for value in values:
                 if not value:
                     continue
 
@@ -454,11 +469,18 @@ class FallbackCache(object):
             cache_value = json.dumps(cache_value)
             cache_values = dict([(key, cache_value) for key in cache_keys])
 
-            with self.redis_client.pipeline() as pipe:
+            def write(pipe):
                 pipe.mset(cache_values)
                 for cache_key in cache_keys:
                     pipe.expire(cache_key, expire)
-                pipe.execute()
+
+            if query.redis_coalescer is not None:
+                # Sent with the request's last Redis pipeline.
+                query.redis_coalescer.defer(write)
+            else:
+                with self.redis_client.pipeline() as pipe:
+                    write(pipe)
+                    pipe.execute()
         except (json.JSONDecodeError, RedisError):
             self.raven_client.captureException()
 
@@ -476,38 +498,38 @@ def _add_fallback_ipf_false(payload):
     return new_payload
 
 
-def _external_call_ichnaea_v1(query, payload):
+def _external_call_ichnaea_v1(query, payload, timeout=FALLBACK_TIMEOUT):
     new_payload = _add_fallback_ipf_false(payload)
     return query.http_session.post(
         query.api_key.fallback_url,
         headers={"User-Agent": "ichnaea"},
         json=new_payload,
-        timeout=5.0,
+        timeout=timeout,
     )
 
 
-def _external_call_combain_v1(query, payload):
+def _external_call_combain_v1(query, payload, timeout=FALLBACK_TIMEOUT):
     new_payload = _add_fallback_ipf_false(payload)
     return query.http_session.post(
         query.api_key.fallback_url,
         headers={"User-Agent": "ichnaea"},
         json=new_payload,
-        timeout=5.0,
+        timeout=timeout,
     )
 
 
-def _external_call_googlemaps_v1(query, payload):
+def _external_call_googlemaps_v1(query, payload, timeout=FALLBACK_TIMEOUT):
     # There is no fallbacks section, the schema takes care of adding
     # a new top-level considerIp: false
     return query.http_session.post(
         query.api_key.fallback_url,
         headers={"User-Agent": "ichnaea"},
         json=payload,
-        timeout=5.0,
+        timeout=timeout,
     )
 
 
-def _external_call_unwiredlabs_v1(query, payload):
+def _external_call_unwiredlabs_v1(query, payload, timeout=FALLBACK_TIMEOUT):
     new_payload = _add_fallback_ipf_false(payload)
 
     # Parse the token from the URL and put it into the body.
@@ -515,7 +537,7 @@ def _external_call_unwiredlabs_v1(query, payload):
     new_payload["token"] = token
 
     return query.http_session.post(
-        url, headers={"User-Agent": "ichnaea"}, json=new_payload, timeout=5.0
+        url, headers={"User-Agent": "ichnaea"}, json=new_payload, timeout=timeout
     )
 
 
@@ -527,6 +549,11 @@ class FallbackPositionSource(PositionSource):
 
     source = DataSource.fallback
 
+    # Only call the external service speculatively if configured, as
+    # each call counts against the rate limit and may be paid for.
+    hedge_delay = settings("locate_fallback_hedge_delay") or None
+    search_timeout = FALLBACK_TIMEOUT
+
     # The schema for ichnaea, combain and googlemaps are currently
     # almost the same.
     schemas = (
@@ -573,6 +600,9 @@ class FallbackPositionSource(PositionSource):
         limit = api_key.fallback_ratelimit or 0
         interval = api_key.fallback_ratelimit_interval or 1
         ratelimit_key = self._ratelimit_key(name, interval)
+        counter = None
+        if api_key.valid_key not in STRICT_KEYS:
+            counter = RATE_LIMIT_COUNTER
 
         return limit and rate_limit_exceeded(
             self.redis_client,
@@ -580,6 +610,8 @@ class FallbackPositionSource(PositionSource):
             maxreq=limit,
             expire=interval * 5,
             on_error=True,
+            counter=counter,
+            coalescer=query.redis_coalescer,
         )
 
     def _make_external_call(self, query, fallback_schema):
@@ -596,11 +628,16 @@ class FallbackPositionSource(PositionSource):
         if not outbound:
             return None
 
+        # Only use the time left in the query's budget.
+        timeout = query.remaining_time(FALLBACK_TIMEOUT)
+        if not timeout:
+            return None
+
         try:
             fallback_tag = "fallback_name:%s" % (query.api_key.fallback_name or "none")
 
             with METRICS.timer("locate.fallback.lookup.timing", tags=[fallback_tag]):
-                response = outbound_call(query, outbound)
+                response = outbound_call(query, outbound, timeout=timeout)
 
             METRICS.incr(
                 "locate.fallback.lookup",
@@ -5,12 +5,23 @@ from ichnaea.api.locate.cell import CellPositionMixin, CellRegionMixin
 from ichnaea.api.locate.constants import DataSource
 from ichnaea.api.locate.source import PositionSource, RegionSource
 from ichnaea.api.locate.wifi import WifiPositionMixin, WifiRegionMixin
+from ichnaea.cache import parse_runtime_value
+
+
+def _get_global_sample_rate(pipe):
+    pipe.get("global_locate_sample_rate")
+
+
+def prefetch_global_sample_rate(coalescer):
+    """Read the global sample rate along with the next Redis pipeline."""
+    coalescer.prefetch("global_locate_sample_rate", _get_global_sample_rate)
 
 
 class BaseInternalSource(object):
     """A source based on our own crowd-sourced internal data."""
 
     fallback_field = None
+    shares_session = True
     source = DataSource.internal
 
     def should_search(self, query, results):
@@ -34,6 +45,9 @@ class BaseInternalSource(object):
             (self.should_search_cell, self.search_cell),
         ):
 
+            if query.remaining_time() == 0.0:
+                # Out of time, make do with the results found so far.
+                break
             if should(query, results):
                 results.add(search(query))
 
@@ -66,11 +80,16 @@ class InternalPositionSource(
             # which was already validated today
             return
 
-        raw_global_rate = self.redis_client.get("global_locate_sample_rate")
-        try:
-            global_rate = float(raw_global_rate)
-        except (TypeError, ValueError):
-            global_rate = 100.0
+        coalescer = self.redis_coalescer(query)
+        if query.runtime_config is not None:
+            global_rate = query.runtime_config.get("global_locate_sample_rate")
+        else:
+            [raw_global_rate] = coalescer.read(
+                "global_locate_sample_rate", _get_global_sample_rate
+            )
+            global_rate = parse_runtime_value(
+                "global_locate_sample_rate", raw_global_rate
+            )
         if not query.api_key.store_sample("locate", global_rate):
             # only store some percentage of the requests
             return
@@ -86,8 +105,10 @@ class InternalPositionSource(
             }
         ]
 
+        queue = self.data_queues["update_incoming"]
         try:
-            self.data_queues["update_incoming"].enqueue(data)
+            # Sent with the request's last Redis pipeline.
+            coalescer.defer(lambda pipe: queue.enqueue(data, pipe=pipe))
         except Exception:
             self.raven_client.captureException()
 
@@ -2,16 +2,22 @@
 
 from base64 import b64decode
 from collections import defaultdict
-import itertools
 import math
 
 import numpy
 from scipy.cluster import hierarchy
 from scipy.optimize import leastsq
-from sqlalchemy import select
 
-from geocalc import distance
+from geocalc import haversine_distances, pairwise_haversine_distance
+from ichnaea.api.locate.cache import (
+    MAC_FIELDS,
+    MacRow,
+    query_shards,
+    QueryTimeout,
+    STATION_CACHE,
+)
 from ichnaea.api.locate.score import station_score
+from ichnaea.constants import EARTH_RADIUS
 from ichnaea.models import decode_mac, encode_mac, station_blocked
 from ichnaea import util
 
@@ -73,11 +79,19 @@ def cluster_networks(
         # Not enough networks to form a valid cluster.
         return []
 
-    positions = networks[["lat", "lon"]]
+    # Calculate the condensed distance matrix based on distance in meters.
+    # This avoids calculating the square form, which would calculate
+    # each value twice and avoids calculating the diagonal of zeros.
+    # We avoid the special cases for length < 2 with the above checks.
+    # See scipy.spatial.distance.squareform and
+    # https://stackoverflow.com/questions/13079563
+    dist_matrix = pairwise_haversine_distance(
+        numpy.ascontiguousarray(networks["lat"]),
+        numpy.ascontiguousarray(networks["lon"]),
+    )
+
     if length == 2:
-        one = positions[0]
-        two = positions[1]
-        if distance(one[0], one[1], two[0], two[1]) <= max_distance:
+        if dist_matrix[0] <= max_distance:
             # Only two networks and they agree, so cluster them.
             return [networks]
         else:
@@ -85,16 +99,6 @@ def cluster_networks(
             # neither of which is large enough to be returned.
             return []
 
-    # Calculate the condensed distance matrix based on distance in meters.
-    # This avoids calculating the square form, which would calculate
-    # each value twice and avoids calculating the diagonal of zeros.
-    # We avoid the special cases for length < 2 with the above checks.
-    # See scipy.spatial.distance.squareform and
-    # https://stackoverflow.com/questions/13079563
-    dist_matrix = numpy.zeros(length * (length - 1) // 2, dtype=numpy.double)
-    for i, (a, b) in enumerate(itertools.combinations(positions, 2)):
-        dist_matrix[i] = distance(a[0], a[1], b[0], b[1])
-
     link_matrix = hierarchy.linkage(dist_matrix, method="complete")
     assignments = hierarchy.fcluster(
         link_matrix, max_distance, criterion="distance", depth=2
@@ -112,38 +116,66 @@ def cluster_networks(
     return clusters
 
 
-def aggregate_mac_position(networks, minimum_accuracy):
-    # Idea based on https://gis.stackexchange.com/questions/40660
+def network_weights(networks):
+    """
+    Return the per-network weights based on the age and signal strength
+    of each network observation, without taking the network score into
+    account.
+    """
+    age = networks["age"].astype(numpy.double)
+    signal = networks["signalStrength"].astype(numpy.double)
+    return numpy.minimum(numpy.sqrt(2000.0 / age), 1.0) / (signal**2)
+
+
+def _residuals(point, lats, lons, weights):
+    return haversine_distances(point[0], point[1], lats, lons) * weights
+
+
+def _residuals_jacobian(point, lats, lons, weights):
+    # Analytic partial derivatives of the weighted Haversine distance
+    # with respect to the latitude and longitude of the point, in
+    # meters per degree.
+    lat = math.radians(point[0])
+    rad_lats = numpy.radians(lats)
+    dlat = lat - rad_lats
+    dlon = math.radians(point[1]) - numpy.radians(lons)
+    cos_lats = numpy.cos(rad_lats)
+    sin_half_dlon_sq = numpy.sin(dlon / 2.0) ** 2
+
+    a = numpy.sin(dlat / 2.0) ** 2 + cos_lats * math.cos(lat) * sin_half_dlon_sq
+    a = numpy.clip(a, 0.0, 1.0)
+    da_dlat = numpy.sin(dlat) / 2.0 - cos_lats * math.sin(lat) * sin_half_dlon_sq
+    da_dlon = cos_lats * math.cos(lat) * numpy.sin(dlon) / 2.0
+
+    denominator = numpy.sqrt(a * (1.0 - a))
+    # The distance isn't differentiable at the network position itself,
+    # use a zero slope for those networks.
+    factor = numpy.divide(
+        1000.0 * EARTH_RADIUS * math.pi / 180.0 * weights,
+        denominator,
+        out=numpy.zeros_like(denominator),
+        where=denominator > 0.0,
+    )
+    return numpy.column_stack((factor * da_dlat, factor * da_dlon))
 
-    def func(point, points):
-        return numpy.array(
-            [
-                distance(p["lat"], p["lon"], point[0], point[1])
-                * min(math.sqrt(2000.0 / p["age"]), 1.0)
-                / math.pow(p["signalStrength"], 2)
-                for p in points
-            ]
-        )
 
-    # Guess initial position as the weighted mean over all networks.
-    points = numpy.array(
-        [(net["lat"], net["lon"]) for net in networks], dtype=numpy.double
-    )
+def aggregate_mac_position(networks, minimum_accuracy, jacobian=False):
+    # Idea based on https://gis.stackexchange.com/questions/40660
+    lats = numpy.ascontiguousarray(networks["lat"], dtype=numpy.double)
+    lons = numpy.ascontiguousarray(networks["lon"], dtype=numpy.double)
+    weights = network_weights(networks)
 
-    weights = numpy.array(
-        [
-            net["score"]
-            * min(math.sqrt(2000.0 / net["age"]), 1.0)
-            / math.pow(net["signalStrength"], 2)
-            for net in networks
-        ],
-        dtype=numpy.double,
+    # Guess initial position as the weighted mean over all networks.
+    initial = numpy.average(
+        numpy.column_stack((lats, lons)), axis=0, weights=networks["score"] * weights
     )
 
-    initial = numpy.average(points, axis=0, weights=weights)
-
     (lat, lon), cov_x, info, mesg, ier = leastsq(
-        func, initial, args=networks, full_output=True
+        _residuals,
+        initial,
+        args=(lats, lons, weights),
+        Dfun=_residuals_jacobian if jacobian else None,
+        full_output=True,
     )
 
     if ier not in (1, 2, 3, 4):
@@ -152,10 +184,7 @@ def aggregate_mac_position(networks, minimum_accuracy):
 
     # Guess the accuracy as the 95th percentile of the distances
     # from the lat/lon to the positions of all networks.
-    distances = numpy.array(
-        [distance(lat, lon, net["lat"], net["lon"]) for net in networks],
-        dtype=numpy.double,
-    )
+    distances = haversine_distances(lat, lon, lats, lons)
     accuracy = max(numpy.percentile(distances, 95), minimum_accuracy)
 
     return (float(lat), float(lon), float(accuracy))
@@ -191,26 +220,11 @@ def aggregate_cluster_position(
     )
 
 
-def query_macs(query, lookups, raven_client, db_model):
+def query_macs(query, lookups, raven_client, db_model, redis_client=None):
     macs = [lookup.mac for lookup in lookups]
     if not macs:
         return []
 
-    # load all fields used in score calculation and those we
-    # need for the position or region
-    load_fields = (
-        "mac",
-        "lat",
-        "lon",
-        "radius",
-        "region",
-        "samples",
-        "created",
-        "modified",
-        "last_seen",
-        "block_last",
-        "block_count",
-    )
     result = []
     today = util.utcnow().date()
 
@@ -219,19 +233,47 @@ def query_macs(query, lookups, raven_client, db_model):
         for mac in macs:
             shards[db_model.shard_model(mac)].append(mac)
 
+        rows = []
+        missing = {}
         for shard, shard_macs in shards.items():
-            columns = shard.__table__.c
-            fields = [getattr(columns, f) for f in load_fields]
-            rows = (
-                query.session.execute(
-                    select(fields)
-                    .where(columns.lat.isnot(None))
-                    .where(columns.lon.isnot(None))
-                    .where(columns.mac.in_(shard_macs))
+            table = shard.__tablename__
+            cached, shard_macs = STATION_CACHE.get_many(
+                table.split("_")[0], table, shard_macs, redis_client=redis_client
+            )
+            rows.extend([row for row in cached.values() if row is not None])
+            if shard_macs:
+                missing[shard] = shard_macs
+
+        if missing:
+            timed_out = False
+            try:
+                station_rows = query_shards(
+                    query.session,
+                    missing,
+                    MAC_FIELDS,
+                    "mac",
+                    timeout=query.remaining_time(),
+                )
+            except QueryTimeout as exc:
+                # Make do with the rows found so far.
+                station_rows = exc.rows
+                timed_out = True
+            loaded = {encode_mac(row.mac): MacRow(*row) for row in station_rows}
+            for shard, shard_macs in missing.items():
+                if timed_out:
+                    # Don't cache the stations which weren't looked up.
+                    shard_macs = [mac for mac in shard_macs if mac in loaded]
+                table = shard.__tablename__
+                STATION_CACHE.set_many(
+                    table.split("_")[0],
+                    table,
+                    shard_macs,
+                    loaded,
+                    redis_client=redis_client,
                 )
-            ).fetchall()
+            rows.extend(loaded.values())
 
-            result.extend([row for row in rows if not station_blocked(row, today)])
+        result = [row for row in rows if not station_blocked(row, today)]
     except Exception:
         raven_client.captureException()
     return result
@@ -1,6 +1,8 @@
 """Code representing a query."""
 
 from ipaddress import ip_address
+import time
+
 import markus
 from structlog.contextvars import bind_contextvars
 
@@ -16,6 +18,7 @@ from ichnaea.api.locate.schema import (
     FallbackLookup,
     WifiLookup,
 )
+from ichnaea.conf import settings
 
 try:
     from collections import OrderedDict
@@ -24,6 +27,7 @@ except ImportError:
 
 METRIC_MAPPING = {0: "none", 1: "one", 2: "many"}
 METRICS = markus.get_metrics()
+LATENCY_BUDGET = settings("locate_latency_budget")
 
 
 class Query(object):
@@ -45,6 +49,9 @@ class Query(object):
         session=None,
         http_session=None,
         geoip_db=None,
+        budget=None,
+        redis_coalescer=None,
+        runtime_config=None,
     ):
         """
         A class representing a concrete query.
@@ -77,9 +84,29 @@ class Query(object):
         :param geoip_db: A geoip database.
         :type geoip_db: :class:`~ichnaea.geoip.GeoIPWrapper`
 
+        :param budget: The latency budget for this query in seconds,
+            defaults to the ``LOCATE_LATENCY_BUDGET`` setting.
+        :type budget: float
+
+        :param redis_coalescer: The Redis command coalescer of the
+            current web request.
+        :type redis_coalescer: :class:`~ichnaea.cache.RedisCoalescer`
+
+        :param runtime_config: A snapshot of the Redis stored tuning
+            values, if these shouldn't be read from Redis directly.
+        :type runtime_config: :class:`~ichnaea.cache.RuntimeConfig`
+
         """
+        if budget is None:
+            budget = LATENCY_BUDGET
+        self.deadline = None
+        if budget > 0:
+            self.deadline = time.monotonic() + budget
+
         self.geoip_db = geoip_db
         self.http_session = http_session
+        self.redis_coalescer = redis_coalescer
+        self.runtime_config = runtime_config
         self.session = session
 
         self.fallback = fallback
@@ -104,6 +131,20 @@ class Query(object):
             has_ip=bool(ip),
         )
 
+    def remaining_time(self, limit=None):
+        """
+        Return the seconds left in the latency budget of this query,
+        but at most `limit` seconds.
+
+        Returns `limit` if the query has no budget.
+        """
+        if self.deadline is None:
+            return limit
+        remaining = max(self.deadline - time.monotonic(), 0.0)
+        if limit is not None:
+            remaining = min(remaining, limit)
+        return remaining
+
     @property
     def fallback(self):
         """
@@ -406,6 +447,17 @@ class Query(object):
             result_status=status,
         )
 
+    def emit_budget_stats(self):
+        """Emit stats about the unused latency budget of this query."""
+        if self.deadline is None or not self.collect_metrics():
+            return
+
+        METRICS.timing(
+            "%s.budget_remaining" % self.api_type,
+            self.remaining_time() * 1000.0,
+            tags=["key:%s" % self.api_key.valid_key],
+        )
+
     def emit_source_stats(self, source, results):
         """Emit stats about how well the source satisfied the query."""
         if not self.collect_metrics():
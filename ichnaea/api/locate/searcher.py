@@ -3,6 +3,11 @@ Abstract searcher and concrete position and region searchers each using
 multiple sources to satisfy a given query.
 """
 
+import time
+
+import gevent
+import markus
+
 from ichnaea.api.locate.fallback import FallbackPositionSource
 from ichnaea.api.locate.geoip import GeoIPPositionSource, GeoIPRegionSource
 from ichnaea.api.locate.internal import InternalPositionSource, InternalRegionSource
@@ -12,8 +17,11 @@ from ichnaea.api.locate.result import (
     Region,
     RegionResultList,
 )
+from ichnaea.conf import settings
 from ichnaea.constants import DEGREE_DECIMAL_PLACES
 
+METRICS = markus.get_metrics()
+
 
 def _configure_searcher(
     klass,
@@ -79,10 +87,15 @@ class Searcher(object):
     A Searcher will use a collection of data sources
     to attempt to satisfy a user's query. It will loop over them
     in the order they are specified and use the best possible result.
+
+    If `concurrent` is set, the sources run concurrently instead, see
+    :meth:`_search_concurrent`.
     """
 
+    concurrent = settings("locate_concurrent_sources")
     result_list = None
     result_type = None
+    source_timeout = settings("locate_source_timeout")
     sources = ()
     source_classes = ()
 
@@ -98,6 +111,9 @@ class Searcher(object):
             self.sources.append((name, source_instance))
 
     def _search(self, query):
+        if self.concurrent:
+            return self._search_concurrent(query)
+
         results = self.result_list()
         for name, source in self.sources:
             if source.should_search(query, results):
@@ -105,6 +121,99 @@ class Searcher(object):
 
         return results.best()
 
+    def _search_concurrent(self, query):
+        """
+        Run the sources concurrently, each in its own greenlet.
+
+        A source is started right away, `hedge_delay` seconds later if
+        the results of the earlier sources aren't known by then, or once
+        they are known and insufficient, see
+        :attr:`~ichnaea.api.locate.source.Source.hedge_delay`.
+
+        The results are still combined in source order. Once the results
+        of all earlier sources are known, the result of a started source
+        which no longer should search is ignored. The searcher waits for
+        the result of each source for at most its own `search_timeout`
+        seconds, or the remaining latency budget of the query.
+
+        Sources are never interrupted, as they share connection pools.
+        Ignored sources keep running until their own timeouts end them,
+        and the searcher waits for those sharing the query's database
+        session before it returns.
+        """
+        results = self.result_list()
+        no_results = self.result_list()
+        begin = time.monotonic()
+        started = {}
+
+        def start(index, source):
+            timeout = source.search_timeout
+            if timeout is None:
+                timeout = self.source_timeout
+            deadline = time.monotonic() + query.remaining_time(timeout)
+            started[index] = (gevent.spawn(source.search, query), deadline)
+
+        hedges = []
+        for index, (name, source) in enumerate(self.sources):
+            if source.hedge_delay is None or not source.should_search(
+                query, no_results
+            ):
+                continue
+            if source.hedge_delay <= 0.0:
+                start(index, source)
+            else:
+                hedges.append((begin + source.hedge_delay, index, source))
+
+        try:
+            for index, (name, source) in enumerate(self.sources):
+                if not source.should_search(query, results):
+                    if index in started:
+                        self._emit_cancel(name, "satisfied")
+                    continue
+
+                if index not in started:
+                    start(index, source)
+                hedges = [hedge for hedge in hedges if hedge[1] > index]
+
+                greenlet, deadline = started[index]
+                while not greenlet.ready():
+                    now = time.monotonic()
+                    if now >= deadline:
+                        break
+                    wake = deadline
+                    for hedge in list(hedges):
+                        hedge_time, hedge_index, hedge_source = hedge
+                        if hedge_time > now:
+                            wake = min(wake, hedge_time)
+                            continue
+                        hedges.remove(hedge)
+                        if hedge_index not in started and hedge_source.should_search(
+                            query, results
+                        ):
+                            start(hedge_index, hedge_source)
+                    greenlet.join(timeout=max(wake - now, 0.0))
+
+                if not greenlet.ready():
+                    self._emit_cancel(name, "timeout")
+                    continue
+
+                results.add(greenlet.get())
+        finally:
+            gevent.joinall(
+                [
+                    greenlet
+                    for index, (greenlet, _) in started.items()
+                    if self.sources[index][1].shares_session
+                ]
+            )
+
+        return results.best()
+
+    def _emit_cancel(self, name, reason):
+        METRICS.incr(
+            "locate.source.cancel", tags=["source:%s" % name, "reason:%s" % reason]
+        )
+
     def format_result(self, result):
         """
         Converts the result object into a dictionary representation.
@@ -126,6 +235,7 @@ class Searcher(object):
         query.emit_query_stats()
         result = self._search(query)
         query.emit_result_stats(result)
+        query.emit_budget_stats()
         if result is not None:
             return self.format_result(result)
 
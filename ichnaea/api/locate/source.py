@@ -8,6 +8,7 @@ from ichnaea.api.locate.result import (
     Region,
     RegionResultList,
 )
+from ichnaea.cache import RedisCoalescer
 
 
 class Source(object):
@@ -22,6 +23,17 @@ class Source(object):
     result_type = None
     source = None
 
+    # If the sources of a searcher run concurrently, a source is started
+    # `hedge_delay` seconds after the search started, if the results of
+    # the earlier sources aren't known by then. None only starts it once
+    # they are known. The searcher waits for its result for at most
+    # `search_timeout` seconds, None uses the searcher's timeout.
+    hedge_delay = 0.0
+    search_timeout = None
+    # Sources using the query's database session are never left running
+    # once the searcher returns, as the session is closed afterwards.
+    shares_session = False
+
     def __init__(self, geoip_db, raven_client, redis_client, data_queues):
         self.geoip_db = geoip_db
         self.raven_client = raven_client
@@ -49,6 +61,20 @@ class Source(object):
 
         return True
 
+    def redis_coalescer(self, query):
+        """
+        Return the Redis command coalescer of the query's web request,
+        or one which executes all commands right away.
+
+        :param query: A query.
+        :type query: :class:`~ichnaea.api.locate.query.Query`
+
+        :rtype: :class:`~ichnaea.cache.RedisCoalescer`
+        """
+        if query.redis_coalescer is not None:
+            return query.redis_coalescer
+        return RedisCoalescer(self.redis_client, deferred=False)
+
     def search(self, query):
         """Provide a type specific possibly empty result list.
 
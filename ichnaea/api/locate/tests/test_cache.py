@@ -0,0 +1,417 @@
+from datetime import timedelta
+from unittest import mock
+
+from pymysql.err import OperationalError as MySQLOperationalError
+import pytest
+from redis import RedisError
+from sqlalchemy import select, union_all
+from sqlalchemy.dialects import mysql
+from sqlalchemy.exc import OperationalError
+
+from ichnaea.api.locate import cache
+from ichnaea.api.locate.cache import (
+    MacRow,
+    query_shards,
+    QueryTimeout,
+    StationCache,
+    STATION_CACHE,
+)
+from ichnaea.cache import station_cache_key
+from ichnaea.api.locate.cell import query_areas, query_cells
+from ichnaea.api.locate.mac import cluster_networks, query_macs
+from ichnaea.api.locate.score import station_score
+from ichnaea.api.locate.tests.base import BaseSourceTest
+from ichnaea.models import (
+    BlueShard,
+    CellArea,
+    CellShard,
+    Radio,
+    WifiShard,
+    encode_mac,
+)
+from ichnaea.tests.factories import (
+    BlueShardFactory,
+    CellAreaFactory,
+    CellShardFactory,
+    WifiShardFactory,
+)
+from ichnaea import util
+
+
+class DummyTimer(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def _row(mac):
+    now = util.utcnow()
+    return MacRow(mac, 1.0, 1.0, 10, "GB", 10, now, now, now.date(), None, 0)
+
+
+@pytest.fixture
+def enabled_cache():
+    limits = (STATION_CACHE.maxsize, STATION_CACHE.ttl, STATION_CACHE.negative_ttl)
+    STATION_CACHE.configure(maxsize=100, ttl=300, negative_ttl=60)
+    yield STATION_CACHE
+    STATION_CACHE.configure(*limits)
+
+
+@pytest.fixture
+def shared_cache():
+    limits = (STATION_CACHE.shared_ttl, STATION_CACHE.shared_negative_ttl)
+    STATION_CACHE.shared_ttl, STATION_CACHE.shared_negative_ttl = (300, 60)
+    yield STATION_CACHE
+    STATION_CACHE.shared_ttl, STATION_CACHE.shared_negative_ttl = limits
+
+
+class TestStationCache(object):
+    def test_disabled(self, metricsmock):
+        cache = StationCache(maxsize=0, ttl=300, negative_ttl=60)
+        cache.set_many("wifi", "wifi_shard_0", ["a"], {"a": _row("a")})
+        assert cache.get_many("wifi", "wifi_shard_0", ["a"]) == ({}, ["a"])
+        assert not metricsmock.get_records()
+
+    def test_hit_miss(self, metricsmock):
+        cache = StationCache(maxsize=10, ttl=300, negative_ttl=60)
+        row = _row("a")
+        cache.set_many("wifi", "wifi_shard_0", ["a", "b"], {"a": row})
+
+        found, missing = cache.get_many("wifi", "wifi_shard_0", ["a", "b", "c"])
+        assert found == {"a": row, "b": None}
+        assert missing == ["c"]
+
+        found, missing = cache.get_many("wifi", "wifi_shard_1", ["a"])
+        assert found == {}
+        assert missing == ["a"]
+
+        metricsmock.assert_incr_once(
+            "locate.station_cache", value=2, tags=["type:wifi", "status:hit"]
+        )
+        assert (
+            len(
+                metricsmock.filter_records(
+                    "incr",
+                    "locate.station_cache",
+                    value=1,
+                    tags=["type:wifi", "status:miss"],
+                )
+            )
+            == 2
+        )
+
+    def test_ttl(self):
+        timer = DummyTimer()
+        cache = StationCache(maxsize=10, ttl=300, negative_ttl=60, timer=timer)
+        row = _row("a")
+        cache.set_many("blue", "blue_shard_0", ["a", "b"], {"a": row})
+
+        timer.now = 59
+        assert cache.get_many("blue", "blue_shard_0", ["a", "b"]) == (
+            {"a": row, "b": None},
+            [],
+        )
+        timer.now = 60
+        assert cache.get_many("blue", "blue_shard_0", ["a", "b"]) == ({"a": row}, ["b"])
+        timer.now = 300
+        assert cache.get_many("blue", "blue_shard_0", ["a", "b"]) == ({}, ["a", "b"])
+
+    def test_no_negative(self):
+        cache = StationCache(maxsize=10, ttl=300, negative_ttl=0)
+        cache.set_many("cell", "cell_gsm", ["a", "b"], {"a": _row("a")})
+        found, missing = cache.get_many("cell", "cell_gsm", ["a", "b"])
+        assert list(found.keys()) == ["a"]
+        assert missing == ["b"]
+
+    def test_eviction(self, metricsmock):
+        cache = StationCache(maxsize=2, ttl=300, negative_ttl=60)
+        cache.set_many("wifi", "wifi_shard_0", ["a", "b", "c"], {})
+        found, missing = cache.get_many("wifi", "wifi_shard_0", ["a", "b", "c"])
+        assert list(found.keys()) == ["b", "c"]
+        assert missing == ["a"]
+        metricsmock.assert_incr_once(
+            "locate.station_cache.eviction", tags=["type:wifi"]
+        )
+
+    def test_shared(self, metricsmock, redis):
+        cache = StationCache(
+            maxsize=0, ttl=300, negative_ttl=60, shared_ttl=300, shared_negative_ttl=60
+        )
+        row = _row("0123456789ab")
+        keys = [encode_mac("0123456789ab"), encode_mac("0123456789ac")]
+        cache.set_many("wifi", "wifi_shard_0", keys, {keys[0]: row}, redis)
+        assert redis.ttl(station_cache_key("wifi_shard_0", keys[0])) == 300
+        assert redis.ttl(station_cache_key("wifi_shard_0", keys[1])) == 60
+
+        found, missing = cache.get_many(
+            "wifi", "wifi_shard_0", keys + [b"abcdef"], redis
+        )
+        assert found == {keys[0]: row, keys[1]: None}
+        assert missing == [b"abcdef"]
+        metricsmock.assert_incr_once(
+            "locate.station_cache.shared", value=2, tags=["type:wifi", "status:hit"]
+        )
+        metricsmock.assert_incr_once(
+            "locate.station_cache.shared", value=1, tags=["type:wifi", "status:miss"]
+        )
+
+        # The shared tier is only used if a client is passed in.
+        assert cache.get_many("wifi", "wifi_shard_0", keys) == ({}, keys)
+
+    def test_shared_fills_local(self, redis):
+        cache = StationCache(maxsize=10, ttl=300, negative_ttl=60, shared_ttl=300)
+        row = _row("0123456789ab")
+        key = encode_mac("0123456789ab")
+        cache.set_many("blue", "blue_shard_0", [key], {key: row}, redis)
+        cache.clear()
+
+        assert cache.get_many("blue", "blue_shard_0", [key], redis) == ({key: row}, [])
+        redis.flushdb()
+        assert cache.get_many("blue", "blue_shard_0", [key], redis) == ({key: row}, [])
+
+    def test_shared_score(self, redis):
+        cache = StationCache(maxsize=0, ttl=300, negative_ttl=60, shared_ttl=300)
+        row = _row("0123456789ab")._replace(created=util.utcnow() - timedelta(days=20))
+        key = encode_mac("0123456789ab")
+        cache.set_many("wifi", "wifi_shard_0", [key], {key: row}, redis)
+
+        found, _ = cache.get_many("wifi", "wifi_shard_0", [key], redis)
+        now = util.utcnow()
+        assert found[key].modified == row.modified
+        assert station_score(found[key], now) == station_score(row, now)
+
+    def test_shared_area(self, redis):
+        cache = StationCache(maxsize=0, ttl=300, negative_ttl=60, shared_ttl=300)
+        cache.set_many("area", "cell_area", [b"a"], {}, redis)
+        assert not redis.keys()
+        assert cache.get_many("area", "cell_area", [b"a"], redis) == ({}, [b"a"])
+
+    def test_shared_failure(self, metricsmock):
+        redis_client = mock.Mock()
+        redis_client.mget.side_effect = RedisError()
+        redis_client.pipeline.side_effect = RedisError()
+        cache = StationCache(maxsize=0, ttl=300, negative_ttl=60, shared_ttl=300)
+        cache.set_many("cell", "cell_gsm", [b"a"], {}, redis_client)
+        assert cache.get_many("cell", "cell_gsm", [b"a"], redis_client) == (
+            {},
+            [b"a"],
+        )
+        assert (
+            len(
+                metricsmock.filter_records(
+                    "incr",
+                    "locate.station_cache.shared",
+                    tags=["type:cell", "status:failure"],
+                )
+            )
+            == 2
+        )
+
+
+class TestQueryShards(object):
+    def shard_keys(self):
+        return {WifiShard.shard_model("000000000001"): [encode_mac("000000000001")]}
+
+    def compile(self, statement, mariadb=False):
+        dialect = mysql.dialect()
+        if mariadb:
+            dialect.server_version_info = (10, 5, 8, "MariaDB")
+        return str(cache._TimeLimitedSelect(statement, 0.25).compile(dialect=dialect))
+
+    def test_time_limit(self):
+        tables = [
+            WifiShard.shard_model(mac).__table__
+            for mac in ("000000000000", "ffffffffffff")
+        ]
+        first, second = [select([table.c.mac]) for table in tables]
+        assert self.compile(first).startswith(
+            "SELECT /*+ MAX_EXECUTION_TIME(250) */ wifi_shard_0.mac"
+        )
+        # The hint of the first select limits the whole union.
+        sql = self.compile(union_all(first, second))
+        assert sql.count("MAX_EXECUTION_TIME") == 1
+        assert "UNION ALL SELECT wifi_shard_f.mac" in sql
+
+    def test_time_limit_mariadb(self):
+        tables = [
+            WifiShard.shard_model(mac).__table__
+            for mac in ("000000000000", "ffffffffffff")
+        ]
+        first, second = [select([table.c.mac]) for table in tables]
+        sql = self.compile(union_all(first, second), mariadb=True)
+        assert sql.startswith(
+            "SET STATEMENT max_statement_time=0.250 FOR SELECT wifi_shard_0.mac"
+        )
+        assert "MAX_EXECUTION_TIME" not in sql
+
+    @pytest.mark.parametrize("code", [3024, 1969])
+    def test_timeout_error(self, code, metricsmock):
+        session = mock.Mock()
+        session.execute.side_effect = OperationalError(
+            "SELECT", {}, MySQLOperationalError(code, "Query execution was interrupted")
+        )
+        with pytest.raises(QueryTimeout):
+            query_shards(session, self.shard_keys(), ("mac",), "mac", timeout=1.0)
+        metricsmock.assert_incr_once("locate.budget.timeout", tags=["type:wifi"])
+
+    def test_other_error(self, metricsmock):
+        session = mock.Mock()
+        session.execute.side_effect = OperationalError(
+            "SELECT", {}, MySQLOperationalError(1205, "Lock wait timeout exceeded")
+        )
+        with pytest.raises(OperationalError):
+            query_shards(session, self.shard_keys(), ("mac",), "mac", timeout=1.0)
+        assert not metricsmock.get_records()
+
+
+class TestQueryCache(BaseSourceTest):
+    def test_macs(self, geoip_db, http_session, session, enabled_cache, raven):
+        wifis = WifiShardFactory.create_batch(2)
+        blue = BlueShardFactory()
+        unknown = WifiShardFactory.build()
+        session.flush()
+
+        query = self.model_query(
+            geoip_db, http_session, session, wifis=wifis + [unknown]
+        )
+        shards = set([WifiShard.shard_model(w.mac) for w in wifis + [unknown]])
+        with mock.patch.object(session, "execute", wraps=session.execute) as execute:
+            for i in range(2):
+                result = query_macs(query, query.wifi, raven, WifiShard)
+                assert set([row.mac for row in result]) == set([w.mac for w in wifis])
+            # One query per shard, the second lookup only used the cache,
+            # including the negative entry for the unknown network.
+            assert execute.call_count == len(shards)
+
+        query = self.model_query(geoip_db, http_session, session, blues=[blue])
+        result = query_macs(query, query.blue, raven, BlueShard)
+        assert [row.mac for row in result] == [blue.mac]
+
+    def test_macs_blocked(self, geoip_db, http_session, session, enabled_cache, raven):
+        now = util.utcnow()
+        wifi = WifiShardFactory()
+        session.flush()
+
+        query = self.model_query(geoip_db, http_session, session, wifis=[wifi])
+        assert len(query_macs(query, query.wifi, raven, WifiShard)) == 1
+
+        # Cached rows are still checked for blocks.
+        key = (
+            "wifi",
+            WifiShard.shard_model(wifi.mac).__tablename__,
+            encode_mac(wifi.mac),
+        )
+        enabled_cache.cache[key] = enabled_cache.cache[key]._replace(
+            block_last=(now - timedelta(days=1)).date(), block_count=1
+        )
+        assert query_macs(query, query.wifi, raven, WifiShard) == []
+
+    def test_cells(self, geoip_db, http_session, session, enabled_cache, raven):
+        cell = CellShardFactory()
+        area = CellAreaFactory()
+        session.flush()
+
+        with mock.patch.object(session, "execute", wraps=session.execute) as execute:
+            query = self.model_query(geoip_db, http_session, session, cells=[cell])
+            for i in range(2):
+                result = query_cells(query, query.cell, CellShard, raven)
+                assert [row.cellid for row in result] == [cell.cellid]
+            assert execute.call_count == 1
+
+            query = self.model_query(geoip_db, http_session, session, cells=[area])
+            for i in range(2):
+                result = query_areas(query, query.cell_area, CellArea, raven)
+                assert [row.areaid for row in result] == [area.areaid]
+            assert execute.call_count == 2
+
+    def test_shared(self, geoip_db, http_session, session, redis, shared_cache, raven):
+        wifis = WifiShardFactory.create_batch(2)
+        cell = CellShardFactory()
+        session.flush()
+
+        query = self.model_query(
+            geoip_db, http_session, session, cells=[cell], wifis=wifis
+        )
+        macs = query_macs(query, query.wifi, raven, WifiShard, redis)
+        assert len(macs) == 2
+        cells = query_cells(query, query.cell, CellShard, raven, redis)
+        assert len(cells) == 1
+
+        # A second worker finds all rows in the shared cache.
+        with mock.patch.object(session, "execute") as execute:
+            result = query_macs(query, query.wifi, raven, WifiShard, redis)
+            assert sorted(result) == sorted(macs)
+            result = query_cells(query, query.cell, CellShard, raven, redis)
+            assert result == cells
+            assert execute.call_count == 0
+
+        # The decoded rows can be scored and located like database rows.
+        now = util.utcnow()
+        for row in result:
+            assert station_score(row, now) > 0
+        result = query_macs(query, query.wifi, raven, WifiShard, redis)
+        clusters = cluster_networks(
+            result, query.wifi, min_signal=-100, max_distance=1000.0
+        )
+        assert len(clusters) == 1
+
+    @pytest.mark.parametrize("union", (False, True))
+    def test_union(self, geoip_db, http_session, session, raven, union):
+        wifis = [
+            WifiShardFactory(mac="000000000001"),
+            WifiShardFactory(mac="000010000001"),
+            WifiShardFactory(mac="000020000001"),
+        ]
+        cells = [CellShardFactory(radio=Radio.gsm), CellShardFactory(radio=Radio.wcdma)]
+        session.flush()
+
+        query = self.model_query(
+            geoip_db, http_session, session, cells=cells, wifis=wifis
+        )
+        with mock.patch.object(cache, "UNION_SHARD_QUERIES", union):
+            with mock.patch.object(
+                session, "execute", wraps=session.execute
+            ) as execute:
+                result = query_macs(query, query.wifi, raven, WifiShard)
+                assert set([row.mac for row in result]) == set([w.mac for w in wifis])
+                result = query_cells(query, query.cell, CellShard, raven)
+                assert set([row.cellid for row in result]) == set(
+                    [c.cellid for c in cells]
+                )
+                assert execute.call_count == (2 if union else 5)
+
+    def test_timeout(
+        self, geoip_db, http_session, session, enabled_cache, raven, metricsmock
+    ):
+        wifis = WifiShardFactory.create_batch(2)
+        session.flush()
+
+        query = self.model_query(
+            geoip_db, http_session, session, wifis=wifis, budget=1.0
+        )
+        result = query_macs(query, query.wifi[:1], raven, WifiShard)
+        assert [row.mac for row in result] == [wifis[0].mac]
+
+        error = OperationalError(
+            "SELECT", {}, MySQLOperationalError(3024, "Query execution was interrupted")
+        )
+        with mock.patch.object(session, "execute", side_effect=error):
+            with pytest.raises(QueryTimeout):
+                query_shards(
+                    session,
+                    {WifiShard.shard_model(wifis[1].mac): [wifis[1].mac]},
+                    ("mac",),
+                    "mac",
+                    timeout=1.0,
+                )
+            # The cached row is still used, the timeout isn't an error.
+            result = query_macs(query, query.wifi, raven, WifiShard)
+            assert [row.mac for row in result] == [wifis[0].mac]
+            assert not raven.msgs
+            metricsmock.assert_incr_once("locate.budget.timeout", tags=["type:wifi"])
+
+        # The station missing due to the timeout wasn't cached as unknown.
+        result = query_macs(query, query.wifi, raven, WifiShard)
+        assert set([row.mac for row in result]) == set([w.mac for w in wifis])
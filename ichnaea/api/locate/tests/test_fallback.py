@@ -27,6 +27,7 @@ from ichnaea.api.locate.query import Query
 from ichnaea.api.locate.result import Position, PositionResultList
 from ichnaea.api.locate.tests.base import BaseSourceTest, DummyModel
 from ichnaea.api.locate.tests.test_query import QueryTest
+from ichnaea.cache import RedisCoalescer
 from ichnaea.models import Radio
 from ichnaea.tests.factories import (
     BlueShardFactory,
@@ -624,6 +625,22 @@ class TestCache(QueryTest):
             "locate.fallback.cache", tags=[self.fallback_tag, "status:hit"]
         )
 
+    def test_coalescer(self, cache, redis):
+        wifis = WifiShardFactory.build_batch(2)
+        wifi = wifis[0]
+        coalescer = RedisCoalescer(redis)
+        query = self._query(
+            wifi=self.wifi_model_query(wifis), redis_coalescer=coalescer
+        )
+        result = ExternalResult(wifi.lat, wifi.lon, wifi.radius, None)
+        cache.set(query, result)
+        assert not redis.keys("cache:fallback:*")
+
+        with mock.patch.object(redis, "pipeline", wraps=redis.pipeline):
+            # The deferred write is sent with the read.
+            assert cache.get(query) == result
+            assert redis.pipeline.call_count == 1
+
     def test_set_wifi_inconsistent(self, cache, metricsmock):
         wifis1 = WifiShardFactory.build_batch(2)
         cache.set(
@@ -898,6 +915,35 @@ class TestDefaultFallback(BaseFallbackTest, BaseSourceTest):
             "locate.fallback.lookup.timing", tags=[self.fallback_tag]
         )
 
+    def test_budget(self, geoip_db, http_session, session, source):
+        cell = CellShardFactory.build()
+
+        with requests_mock.Mocker() as mock_request:
+            mock_request.register_uri(
+                "POST", requests_mock.ANY, json=self.fallback_result
+            )
+            query = self.model_query(
+                geoip_db, http_session, session, cells=[cell], budget=1.0
+            )
+            results = source.search(query)
+            self.check_model_results(results, [self.fallback_model])
+            assert 0.0 < mock_request.request_history[0].timeout <= 1.0
+
+    def test_budget_exhausted(self, geoip_db, http_session, session, source):
+        cell = CellShardFactory.build()
+
+        with requests_mock.Mocker() as mock_request:
+            mock_request.register_uri(
+                "POST", requests_mock.ANY, json=self.fallback_result
+            )
+            query = self.model_query(
+                geoip_db, http_session, session, cells=[cell], budget=1.0
+            )
+            query.deadline = 0.0
+            results = source.search(query)
+            self.check_model_results(results, None)
+            assert mock_request.call_count == 0
+
     def test_api_key_disallows(self, geoip_db, http_session, session, source):
         api_key = KeyFactory(allow_fallback=False)
         cells = CellShardFactory.build_batch(2)
@@ -44,6 +44,18 @@ class TestRegionSource(BaseSourceTest):
         results = source.search(query)
         self.check_model_results(results, None)
 
+    def test_budget_exhausted(self, geoip_db, http_session, session, source):
+        """No stations are looked up once the latency budget is used up."""
+        blues = BlueShardFactory.create_batch(2, samples=10)
+        session.flush()
+
+        query = self.model_query(
+            geoip_db, http_session, session, blues=blues, budget=1.0
+        )
+        query.deadline = 0.0
+        results = source.search(query)
+        self.check_model_results(results, None)
+
     def test_from_mcc(self, geoip_db, http_session, session, source, metricsmock):
         region = GEOCODER.regions_for_mcc(235, metadata=True)[0]
         area = CellAreaFactory(mcc=235, num_cells=10)
@@ -1,3 +1,5 @@
+from unittest import mock
+
 import colander
 import pytest
 import requests_mock
@@ -10,6 +12,7 @@ from ichnaea.api.locate.constants import (
 )
 from ichnaea.api.locate.schema_v1 import LOCATE_V1_SCHEMA
 from ichnaea.api.locate.tests.base import BaseLocateTest, CommonLocateTest
+from ichnaea.cache import RuntimeConfig
 from ichnaea.conftest import GEOIP_DATA
 from ichnaea.models import ApiKey, CellArea, Radio
 from ichnaea.tests.factories import (
@@ -593,6 +596,38 @@ class TestView(LocateV1Base, CommonLocateTest):
         self.check_model_response(res, cell)
         self.check_queue(data_queues, 1)
 
+    def test_redis_round_trips(self, app, data_queues, redis, session):
+        """A stored query needs two Redis round trips."""
+        cell = CellShardFactory()
+        session.flush()
+
+        redis_client = app.app.registry.redis_client
+        with mock.patch.object(
+            redis_client, "pipeline", wraps=redis_client.pipeline
+        ) as pipeline:
+            res = self._call(app, body=self.model_query(cells=[cell]))
+        self.check_model_response(res, cell)
+        self.check_queue(data_queues, 1)
+        # The API key log, rate limit and sample rate read share the first
+        # pipeline, the stored query is sent at the end of the request.
+        assert pipeline.call_count == 2
+
+    def test_runtime_config(self, app, data_queues, redis, session):
+        """The sample rate can be read from a runtime config snapshot."""
+        cell = CellShardFactory()
+        session.flush()
+
+        redis.set("global_locate_sample_rate", b"0")
+        runtime_config = RuntimeConfig(redis, 60.0)
+        with mock.patch.object(
+            app.app.registry, "runtime_config", runtime_config
+        ), mock.patch.object(redis, "get", wraps=redis.get) as redis_get:
+            res = self._call(app, body=self.model_query(cells=[cell]))
+        runtime_config.stop()
+        self.check_model_response(res, cell)
+        self.check_queue(data_queues, 0)
+        assert redis_get.call_count == 0
+
     def test_wifi(self, app, data_queues, session, metricsmock):
         """WiFi can be used for location."""
         wifi = WifiShardFactory()
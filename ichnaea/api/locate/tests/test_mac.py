@@ -0,0 +1,180 @@
+import numpy
+import pytest
+
+from geocalc import distance, pairwise_haversine_distance
+from ichnaea.api.locate.mac import (
+    NETWORK_DTYPE,
+    aggregate_mac_position,
+    cluster_networks,
+    network_weights,
+)
+from ichnaea.api.locate.query import Query
+from ichnaea.tests.factories import WifiShardFactory
+
+# Networks as (lat, lon, age, signalStrength, score), the position and
+# accuracy computed by the previous implementation, which evaluated the
+# residuals with the Vincenty distance one network at a time, and the
+# largest expected position and accuracy differences in meters.
+#
+# There is no log of production queries to record inputs from, so the
+# cases are cluster shapes as they reach aggregate_mac_position: a few
+# at arbitrary places of the world, the shapes of the wifi locate tests
+# and a city cluster with old and weak networks. Both the numerical and
+# the analytic Jacobian have to stay within the differences.
+#
+# The Haversine distance uses a sphere instead of the WGS84 ellipsoid,
+# which changes distances by up to 0.2% depending on the latitude. This
+# shows in the accuracy, the 95th percentile of the network distances.
+# The positions only differ where leastsq stops on a flat cost surface.
+RECORDED_QUERIES = [
+    pytest.param(
+        [
+            (-38.3676147, -172.02781, 30369, -88, 1.022),
+            (-38.3677949, -172.0279051, 15776, -50, 1.717),
+            (-38.367508, -172.0280565, 15397, -42, 1.217),
+        ],
+        (-38.367601127, -172.028001744, 22.47986616),
+        # Three networks close together and no strong fit, leastsq
+        # stops 0.4m apart and the accuracy follows the position.
+        (0.5, 0.3),
+        id="three-networks",
+    ),
+    pytest.param(
+        [
+            (28.4207701, 61.7591886, 11968, -80, 1.655),
+            (28.4201446, 61.7585188, 25017, -68, 0.395),
+            (28.4205748, 61.7586831, 17691, -64, 0.941),
+            (28.4206977, 61.7582691, 6145, -47, 0.983),
+            (28.4204789, 61.7586852, 13984, -81, 0.221),
+        ],
+        (28.420657988, 61.758373134, 76.417875989),
+        # Ellipsoid difference of 0.1% on the accuracy.
+        (0.05, 0.1),
+        id="five-networks",
+    ),
+    pytest.param(
+        [
+            (-57.678989, 92.9549913, 30319, -74, 0.895),
+            (-57.6793295, 92.9531761, 14551, -52, 1.683),
+            (-57.6778631, 92.9560012, 1772, -61, 1.423),
+            (-57.6800279, 92.9555705, 29921, -44, 0.932),
+            (-57.6795245, 92.9547732, 4050, -47, 1.194),
+            (-57.6795273, 92.953372, 27800, -52, 1.766),
+            (-57.6775688, 92.9531529, 6220, -50, 1.448),
+            (-57.6769041, 92.9550009, 5051, -78, 1.348),
+            (-57.678292, 92.9558026, 11051, -65, 1.831),
+            (-57.679138, 92.9536442, 9170, -41, 0.43),
+            (-57.6770303, 92.9558672, 32046, -48, 1.636),
+            (-57.6778466, 92.9537852, 10553, -68, 0.916),
+        ],
+        (-57.67868047, 92.954533803, 200.003021979),
+        # Ellipsoid difference of 0.17% on the accuracy.
+        (0.05, 0.4),
+        id="twelve-networks",
+    ),
+    pytest.param(
+        [
+            (-2.1169498, -2.3076005, 16798, -57, 0.994),
+            (-2.1170522, -2.3075678, 32426, -83, 0.533),
+        ],
+        (-2.116960399, -2.307597114, 10.190340398),
+        # Near the equator the sphere and ellipsoid agree.
+        (0.02, 0.05),
+        id="two-networks",
+    ),
+    pytest.param(
+        [(51.5, -0.1, 1000, -60, 1.0), (51.5, -0.09999, 1000, -80, 1.0)],
+        (51.5, -0.0999964, 10.0),
+        # Within the minimum accuracy, no difference.
+        (0.001, 0.0),
+        id="wifi-pair",
+    ),
+    pytest.param(
+        [
+            (51.5, -0.1, 1000, -80, 1.0),
+            (51.50001, -0.1, 1000, -80, 1.0),
+            (51.50002, -0.1, 1000, -80, 1.0),
+        ],
+        (51.50001, -0.1, 10.0),
+        # Within the minimum accuracy, no difference.
+        (0.001, 0.0),
+        id="wifi-line",
+    ),
+    pytest.param(
+        [
+            (51.5, -0.1, 8000, -90, 0.2),
+            (51.5021, -0.0975, 2000, -55, 1.4),
+            (51.4993, -0.0962, 120000, -71, 0.8),
+            (51.5008, -0.1031, 3000, -63, 1.1),
+        ],
+        (51.501684186, -0.099074342, 326.620580341),
+        # Ellipsoid difference of 0.17% on the accuracy.
+        (0.1, 0.6),
+        id="city-cluster",
+    ),
+]
+
+
+def _networks(rows):
+    return numpy.array(
+        [
+            (lat, lon, 10.0, age, signal, score, b"", False)
+            for lat, lon, age, signal, score in rows
+        ],
+        dtype=NETWORK_DTYPE,
+    )
+
+
+class TestNetworkWeights(object):
+    def test_weights(self):
+        networks = _networks([(1.0, 1.0, 1000, -50, 1.0), (1.0, 1.0, 8000, -100, 0.5)])
+        weights = network_weights(networks)
+        assert weights.dtype == numpy.double
+        assert weights[0] == 1.0 / 2500
+        assert weights[1] == 0.5 / 10000
+
+
+class TestClusterNetworks(object):
+    def test_two_networks(self):
+        wifis = [
+            WifiShardFactory.build(lat=51.5, lon=-0.1),
+            WifiShardFactory.build(lat=51.501, lon=-0.1),
+        ]
+        query = Query(wifi=[{"macAddress": wifi.mac} for wifi in wifis])
+        # Two networks use the same distance as larger clusters.
+        max_distance = pairwise_haversine_distance(
+            numpy.array([wifi.lat for wifi in wifis]),
+            numpy.array([wifi.lon for wifi in wifis]),
+        )[0]
+        clusters = cluster_networks(
+            wifis, query.wifi, min_signal=-100, max_distance=max_distance
+        )
+        assert len(clusters) == 1
+        assert len(clusters[0]) == 2
+
+        clusters = cluster_networks(
+            wifis, query.wifi, min_signal=-100, max_distance=max_distance - 0.01
+        )
+        assert clusters == []
+
+
+class TestAggregateMacPosition(object):
+    @pytest.mark.parametrize("jacobian", [False, True])
+    @pytest.mark.parametrize("rows,expected,max_diff", RECORDED_QUERIES)
+    def test_recorded_parity(self, rows, expected, max_diff, jacobian):
+        lat, lon, accuracy = aggregate_mac_position(
+            _networks(rows), 10.0, jacobian=jacobian
+        )
+        exp_lat, exp_lon, exp_accuracy = expected
+        max_position_diff, max_accuracy_diff = max_diff
+        assert distance(lat, lon, exp_lat, exp_lon) <= max_position_diff
+        assert abs(accuracy - exp_accuracy) <= max_accuracy_diff
+
+    def test_minimum_accuracy(self):
+        networks = _networks(
+            [(51.5, -0.1, 1000, -50, 1.0), (51.5, -0.1, 1000, -60, 1.0)]
+        )
+        lat, lon, accuracy = aggregate_mac_position(networks, 10.0)
+        assert round(lat, 7) == 51.5
+        assert round(lon, 7) == -0.1
+        assert accuracy == 10.0
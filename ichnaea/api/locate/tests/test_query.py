@@ -1,3 +1,5 @@
+import time
+
 import pytest
 
 from ichnaea.api.locate.constants import DataAccuracy, DataSource
@@ -76,6 +78,22 @@ class TestQuery(QueryTest):
         assert query.expected_accuracy is DataAccuracy.none
         assert query.geoip_only is None
 
+    def test_budget(self):
+        query = Query()
+        assert query.deadline is None
+        assert query.remaining_time() is None
+        assert query.remaining_time(5.0) == 5.0
+
+        query = Query(budget=10.0)
+        assert 9.0 < query.remaining_time() <= 10.0
+        assert query.remaining_time(1.0) == 1.0
+
+    def test_budget_exhausted(self):
+        query = Query(budget=0.001)
+        time.sleep(0.002)
+        assert query.remaining_time() == 0.0
+        assert query.remaining_time(5.0) == 0.0
+
     def test_fallback(self, geoip_db):
         query = Query(fallback={"ipf": False}, ip=self.london_ip, geoip_db=geoip_db)
         assert query.fallback.ipf is False
@@ -384,6 +402,25 @@ class TestQueryStats(QueryTest):
         )
 
 
+class TestBudgetStats(QueryTest):
+    def _make_query(self, geoip_db, **kw):
+        return Query(
+            api_key=KeyFactory(valid_key="test"),
+            api_type="locate",
+            ip=self.london_ip,
+            geoip_db=geoip_db,
+            **kw,
+        )
+
+    def test_no_budget(self, geoip_db, metricsmock):
+        self._make_query(geoip_db).emit_budget_stats()
+        assert len(metricsmock.get_records()) == 0
+
+    def test_budget(self, geoip_db, metricsmock):
+        self._make_query(geoip_db, budget=10.0).emit_budget_stats()
+        metricsmock.assert_timing_once("locate.budget_remaining", tags=["key:test"])
+
+
 class TestResultStats(QueryTest):
     def _make_result(self, accuracy=None):
         london = GEOIP_DATA["London"]
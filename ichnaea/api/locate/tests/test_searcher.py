@@ -1,7 +1,12 @@
+import gevent
+import requests_mock
+
+from ichnaea.api.locate.fallback import FallbackPositionSource
 from ichnaea.api.locate.query import Query
 from ichnaea.api.locate.searcher import PositionSearcher, RegionSearcher
 from ichnaea.api.locate.source import PositionSource, RegionSource
-from ichnaea.tests.factories import KeyFactory
+from ichnaea.cache import RedisCoalescer
+from ichnaea.tests.factories import CellShardFactory, KeyFactory
 
 
 class DummyRegionSource(RegionSource):
@@ -23,6 +28,20 @@ class DummyPositionSource(PositionSource):
         return self.result_type(lat=1.0, lon=1.0, accuracy=1000.0, score=0.5)
 
 
+class SatisfyingPositionSource(PositionSource):
+    def search(self, query):
+        return self.result_type(lat=2.0, lon=2.0, accuracy=100.0, score=1.0)
+
+
+class SlowPositionSource(PositionSource):
+    def should_search(self, query, results):
+        return not results.satisfies(query)
+
+    def search(self, query):
+        gevent.sleep(10.0)
+        return self.result_type(lat=3.0, lon=3.0, accuracy=10.0, score=2.0)
+
+
 class SearcherTest(object):
 
     searcher = None
@@ -103,3 +122,212 @@ class TestRegionSearcher(SearcherTest):
         )
         assert result["region_code"] == "DE"
         assert result["region_name"] == "Germany"
+
+
+class TestConcurrentSearcher(SearcherTest):
+    def test_result(self, data_queues, geoip_db, raven, redis, session):
+        class TestSearcher(PositionSearcher):
+            concurrent = True
+            source_classes = (
+                ("test1", DummyPositionSource),
+                ("test2", SatisfyingPositionSource),
+            )
+
+        result = self._search(
+            data_queues, geoip_db, raven, redis, session, TestSearcher
+        )
+        assert result["lat"] == 2.0
+
+    def test_cancel_satisfied(
+        self, data_queues, geoip_db, raven, redis, session, metricsmock
+    ):
+        class TestSearcher(PositionSearcher):
+            concurrent = True
+            source_classes = (
+                ("test1", SatisfyingPositionSource),
+                ("test2", SlowPositionSource),
+            )
+
+        with gevent.Timeout(1.0):
+            result = self._search(
+                data_queues, geoip_db, raven, redis, session, TestSearcher
+            )
+        assert result["lat"] == 2.0
+        metricsmock.assert_incr_once(
+            "locate.source.cancel", tags=["source:test2", "reason:satisfied"]
+        )
+
+    def test_cancel_timeout(
+        self, data_queues, geoip_db, raven, redis, session, metricsmock
+    ):
+        class TestSearcher(PositionSearcher):
+            concurrent = True
+            source_timeout = 0.01
+            source_classes = (
+                ("test1", DummyPositionSource),
+                ("test2", SlowPositionSource),
+            )
+
+        with gevent.Timeout(1.0):
+            result = self._search(
+                data_queues, geoip_db, raven, redis, session, TestSearcher
+            )
+        assert result["lat"] == 1.0
+        metricsmock.assert_incr_once(
+            "locate.source.cancel", tags=["source:test2", "reason:timeout"]
+        )
+
+    def test_should_search(self, data_queues, geoip_db, raven, redis, session):
+        class Source(PositionSource):
+            def should_search(self, query, results):
+                # Only search once there are other results.
+                return len(results) > 0
+
+            def search(self, query):
+                return self.result_type(lat=2.0, lon=2.0, accuracy=100.0, score=1.0)
+
+        class TestSearcher(PositionSearcher):
+            concurrent = True
+            source_classes = (("test1", DummyPositionSource), ("test2", Source))
+
+        result = self._search(
+            data_queues, geoip_db, raven, redis, session, TestSearcher
+        )
+        assert result["lat"] == 2.0
+
+    def test_hedge_delay_none(self, data_queues, geoip_db, raven, redis, session):
+        searches = []
+
+        class Source(SlowPositionSource):
+            hedge_delay = None
+
+            def search(self, query):
+                searches.append(query)
+                return super(Source, self).search(query)
+
+        class TestSearcher(PositionSearcher):
+            concurrent = True
+            source_classes = (
+                ("test1", SatisfyingPositionSource),
+                ("test2", Source),
+            )
+
+        result = self._search(
+            data_queues, geoip_db, raven, redis, session, TestSearcher
+        )
+        assert result["lat"] == 2.0
+        # The source is only started once the earlier results are known.
+        assert searches == []
+
+    def test_hedge_delay(self, data_queues, geoip_db, raven, redis, session):
+        events = []
+
+        class FirstSource(PositionSource):
+            def search(self, query):
+                gevent.sleep(0.1)
+                events.append("first")
+                return self.result_type(lat=1.0, lon=1.0, accuracy=1000.0, score=0.5)
+
+        class HedgedSource(SatisfyingPositionSource):
+            hedge_delay = 0.01
+
+            def search(self, query):
+                events.append("hedged")
+                return super(HedgedSource, self).search(query)
+
+        class TestSearcher(PositionSearcher):
+            concurrent = True
+            source_classes = (("test1", FirstSource), ("test2", HedgedSource))
+
+        with gevent.Timeout(1.0):
+            result = self._search(
+                data_queues, geoip_db, raven, redis, session, TestSearcher
+            )
+        assert result["lat"] == 2.0
+        assert events == ["hedged", "first"]
+
+    def test_shares_session(
+        self, data_queues, geoip_db, raven, redis, session, metricsmock
+    ):
+        finished = []
+
+        class Source(SlowPositionSource):
+            search_timeout = 0.01
+            shares_session = True
+
+            def search(self, query):
+                gevent.sleep(0.05)
+                finished.append(True)
+                return self.result_type(lat=3.0, lon=3.0, accuracy=10.0, score=2.0)
+
+        class TestSearcher(PositionSearcher):
+            concurrent = True
+            source_classes = (("test1", DummyPositionSource), ("test2", Source))
+
+        with gevent.Timeout(1.0):
+            result = self._search(
+                data_queues, geoip_db, raven, redis, session, TestSearcher
+            )
+        # The result came too late, but the search wasn't interrupted.
+        assert result["lat"] == 1.0
+        assert finished == [True]
+        metricsmock.assert_incr_once(
+            "locate.source.cancel", tags=["source:test2", "reason:timeout"]
+        )
+
+    def test_late_fallback_cache(
+        self, data_queues, geoip_db, http_session, raven, redis, session
+    ):
+        finished = []
+
+        class LateFallback(FallbackPositionSource):
+            search_timeout = 0.01
+
+        class TestSearcher(PositionSearcher):
+            concurrent = True
+            source_classes = (("test1", DummyPositionSource), ("test2", LateFallback))
+
+        def slow_response(request, context):
+            gevent.sleep(0.05)
+            finished.append(True)
+            return {"location": {"lat": 3.0, "lng": 3.0}, "accuracy": 10.0}
+
+        cell = CellShardFactory.build()
+        coalescer = RedisCoalescer(redis)
+        query = Query(
+            api_key=KeyFactory(valid_key="test", allow_fallback=True),
+            api_type="locate",
+            cell=[
+                {
+                    "radioType": cell.radio,
+                    "mobileCountryCode": cell.mcc,
+                    "mobileNetworkCode": cell.mnc,
+                    "locationAreaCode": cell.lac,
+                    "cellId": cell.cid,
+                }
+            ],
+            http_session=http_session,
+            redis_coalescer=coalescer,
+            session=session,
+        )
+        searcher = TestSearcher(
+            geoip_db=geoip_db,
+            raven_client=raven,
+            redis_client=redis,
+            data_queues=data_queues,
+        )
+
+        with requests_mock.Mocker() as mock_request:
+            mock_request.register_uri("POST", requests_mock.ANY, json=slow_response)
+            with gevent.Timeout(1.0):
+                result = searcher.search(query)
+                # The request ends before the fallback answers, and
+                # the Redis tween closes the coalescer.
+                coalescer.close()
+                assert result["lat"] == 1.0
+                while not finished:
+                    gevent.sleep(0.01)
+                gevent.sleep(0.01)
+
+        # The late fallback result is still cached.
+        assert len(redis.keys("cache:fallback:*")) == 1
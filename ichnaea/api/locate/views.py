@@ -7,6 +7,7 @@ import json
 from structlog.contextvars import bind_contextvars
 
 from ichnaea.api.exceptions import LocationNotFound
+from ichnaea.api.locate.internal import prefetch_global_sample_rate
 from ichnaea.api.locate.schema_v1 import LOCATE_V1_SCHEMA
 from ichnaea.api.locate.query import Query
 from ichnaea.api.views import BaseAPIView
@@ -33,6 +34,8 @@ class BaseLocateView(BaseAPIView):
             session=self.request.db_session,
             http_session=self.request.registry.http_session,
             geoip_db=self.request.registry.geoip_db,
+            redis_coalescer=self.request.redis_coalescer,
+            runtime_config=self.request.registry.runtime_config,
         )
 
         searcher = getattr(self.request.registry, self.searcher)
@@ -59,6 +62,13 @@ class BasePositionView(BaseLocateView):
     searcher = "position_searcher"
     view_type = "locate"
 
+    def log_ip_and_rate_limited(self, valid_key, maxreq):
+        if self.request.registry.runtime_config is None:
+            # The sample rate is needed to store the query, read it
+            # in the same round trip as the rate limit.
+            prefetch_global_sample_rate(self.request.redis_coalescer)
+        return super().log_ip_and_rate_limited(valid_key, maxreq)
+
 
 class LocateV1View(BasePositionView):
     """View class for v1/geolocate HTTP API."""
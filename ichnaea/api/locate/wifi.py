@@ -42,7 +42,13 @@ class WifiPositionMixin(object):
     def search_wifi(self, query):
         results = self.result_list()
 
-        wifis = query_macs(query, query.wifi, self.raven_client, WifiShard)
+        wifis = query_macs(
+            query,
+            query.wifi,
+            self.raven_client,
+            WifiShard,
+            redis_client=self.redis_client,
+        )
         for cluster in cluster_networks(
             wifis,
             query.wifi,
@@ -80,7 +86,13 @@ class WifiRegionMixin(object):
 
         now = util.utcnow()
         regions = defaultdict(int)
-        wifis = query_macs(query, query.wifi, self.raven_client, WifiShard)
+        wifis = query_macs(
+            query,
+            query.wifi,
+            self.raven_client,
+            WifiShard,
+            redis_client=self.redis_client,
+        )
         for wifi in wifis:
             regions[wifi.region] += station_score(wifi, now)
 
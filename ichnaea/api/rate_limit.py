@@ -1,8 +1,25 @@
 """A Redis based rate limit implementation."""
+import time
+
+from gevent.lock import RLock
+import markus
 from redis import RedisError
 
+from ichnaea.cache import RedisCoalescer
+from ichnaea.conf import settings
+
+METRICS = markus.get_metrics()
+
 
-def rate_limit_exceeded(redis_client, key, maxreq=0, expire=86400, on_error=False):
+def rate_limit_exceeded(
+    redis_client,
+    key,
+    maxreq=0,
+    expire=86400,
+    on_error=False,
+    counter=None,
+    coalescer=None,
+):
     """
     Return `True` if the rate limit is exceeded otherwise `False`.
 
@@ -12,15 +29,159 @@ def rate_limit_exceeded(redis_client, key, maxreq=0, expire=86400, on_error=Fals
     :param expire: How many seconds should the Redis key be retained.
     :param on_error: If Redis could not be connected, report this
                      as the return status.
+    :param counter: An optional :class:`RateLimitCounter`, to count
+                    the request approximately.
+    :param coalescer: An optional :class:`~ichnaea.cache.RedisCoalescer`
+                      of the web request, to send the commands along
+                      with its pending commands.
     """
     if maxreq:
+        if coalescer is None:
+            coalescer = RedisCoalescer(redis_client)
+
+        def incr(pipe):
+            pipe.incr(key, 1)
+            pipe.expire(key, expire)
+
         try:
-            with redis_client.pipeline() as pipe:
-                pipe.incr(key, 1)
-                pipe.expire(key, expire)
-                count, expire = pipe.execute()
+            if counter is not None and counter.enabled:
+                count = counter.incr(coalescer, key, expire, maxreq=maxreq)
                 return count > maxreq
+
+            count, _ = coalescer.execute(incr)
+            return count > maxreq
         except RedisError:
             # If we cannot connect to Redis, return error value.
             return on_error
     return False
+
+
+class RateLimitCounter(object):
+    """
+    Per-process rate limit counters, which are added to the Redis
+    counters in batches.
+
+    Increments are collected locally and sent in a single pipeline,
+    once `interval` seconds have passed since the last sync, or once
+    `batch` increments are pending. Until then, the count of a key is
+    estimated as its last count in Redis plus the local increments.
+    The increments of other processes are only seen after a sync.
+
+    A key is synced right away, if its count isn't known yet, or if the
+    estimate is within `tolerance` of the limit, as a fraction of the
+    limit. This bounds how far a limit can be exceeded.
+
+    An interval of zero disables the counter.
+    """
+
+    def __init__(self, interval, batch, tolerance, timer=time.monotonic):
+        self.lock = RLock()
+        self.interval = interval
+        self.batch = batch
+        self.tolerance = tolerance
+        self.timer = timer
+        self._counts = {}
+        self._members = {}
+        self._pending = {}
+        self._num_pending = 0
+        self._last_sync = timer()
+
+    @property
+    def enabled(self):
+        return self.interval > 0
+
+    def add(self, key, member, expire):
+        """Add a member to a HyperLogLog, to be sent with the next sync."""
+        with self.lock:
+            members, _ = self._members.get(key, (set(), expire))
+            members.add(member)
+            self._members[key] = (members, expire)
+
+    def incr(self, coalescer, key, expire, maxreq=0):
+        """
+        Count one request for the key and return the estimated count.
+
+        :param coalescer: The Redis command coalescer used for syncs.
+        :type coalescer: :class:`~ichnaea.cache.RedisCoalescer`
+        """
+        with self.lock:
+            pending, _ = self._pending.get(key, (0, expire))
+            self._pending[key] = (pending + 1, expire)
+            self._num_pending += 1
+            known = key in self._counts
+            estimate = self._counts.get(key, (0, None))[0] + pending + 1
+
+        if not self._should_sync(known, estimate, maxreq):
+            return estimate
+
+        self.sync(coalescer)
+        with self.lock:
+            count, _ = self._counts.get(key, (estimate, None))
+            pending, _ = self._pending.get(key, (0, None))
+        return count + pending
+
+    def _should_sync(self, known, estimate, maxreq):
+        if not known:
+            return True
+        if maxreq and estimate >= maxreq * (1.0 - self.tolerance):
+            return True
+        if self._num_pending >= self.batch:
+            return True
+        return self.timer() - self._last_sync >= self.interval
+
+    def sync(self, coalescer):
+        """
+        Send all pending increments and members to Redis. If this fails,
+        they are kept for the next sync and the error is raised.
+        """
+        with self.lock:
+            pending, self._pending = self._pending, {}
+            members, self._members = self._members, {}
+            num_pending, self._num_pending = self._num_pending, 0
+            self._last_sync = now = self.timer()
+
+        if not (pending or members):
+            return
+
+        def send(pipe):
+            for key, (count, expire) in pending.items():
+                pipe.incr(key, count)
+                pipe.expire(key, expire)
+            for key, (values, expire) in members.items():
+                pipe.pfadd(key, *values)
+                pipe.expire(key, expire)
+
+        try:
+            results = coalescer.execute(send)
+        except RedisError:
+            METRICS.incr("rate_limit.sync", tags=["status:failure"])
+            self._restore(pending, members, num_pending)
+            raise
+
+        METRICS.incr("rate_limit.sync", tags=["status:success"])
+        with self.lock:
+            # Forget the counts of expired keys, like those of past days.
+            for key, (_, expires) in list(self._counts.items()):
+                if expires <= now:
+                    del self._counts[key]
+            for (key, (_, expire)), count in zip(pending.items(), results[::2]):
+                self._counts[key] = (count, now + expire)
+
+    def _restore(self, pending, members, num_pending):
+        with self.lock:
+            for key, (count, expire) in pending.items():
+                new_count, _ = self._pending.get(key, (0, expire))
+                self._pending[key] = (count + new_count, expire)
+            for key, (values, expire) in members.items():
+                new_values, _ = self._members.get(key, (set(), expire))
+                self._members[key] = (values | new_values, expire)
+            self._num_pending += num_pending
+
+
+STRICT_KEYS = frozenset(settings("api_rate_limit_strict_keys"))
+
+RATE_LIMIT_COUNTER = RateLimitCounter(
+    interval=settings("api_rate_limit_interval"),
+    batch=settings("api_rate_limit_batch"),
+    tolerance=settings("api_rate_limit_tolerance"),
+)
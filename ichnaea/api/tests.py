@@ -5,11 +5,13 @@ from unittest import mock
 import colander
 import pytest
 from pyramid.request import Request
+from redis.exceptions import RedisError
 
 from ichnaea.api.key import get_key, Key
 from ichnaea.api import exceptions as api_exceptions
-from ichnaea.api.rate_limit import rate_limit_exceeded
+from ichnaea.api.rate_limit import rate_limit_exceeded, RateLimitCounter
 from ichnaea.api.schema import RenamingMapping
+from ichnaea.cache import RedisCoalescer
 from ichnaea.tests.factories import ApiKeyFactory, KeyFactory
 
 
@@ -226,3 +228,108 @@ class TestLimiter(object):
         rate_key = "apilimit:key_a:v1.geolocate:20150101"
         broken_redis = None
         assert not rate_limit_exceeded(broken_redis, rate_key, maxreq=0, expire=1)
+
+    def test_counter(self, redis):
+        rate_key = "apilimit:key_a:v1.geolocate:20150101"
+        counter = RateLimitCounter(interval=60.0, batch=100, tolerance=0.1)
+        for i in range(10):
+            assert not rate_limit_exceeded(
+                redis, rate_key, maxreq=10, expire=10, counter=counter
+            )
+        assert rate_limit_exceeded(
+            redis, rate_key, maxreq=10, expire=10, counter=counter
+        )
+
+    def test_coalescer(self, redis):
+        rate_key = "apilimit:key_a:v1.geolocate:20150101"
+        redis.set("foo", b"1")
+        coalescer = RedisCoalescer(redis)
+        coalescer.prefetch("foo", lambda pipe: pipe.get("foo"))
+        coalescer.defer(lambda pipe: pipe.set("bar", b"2"))
+        with mock.patch.object(redis, "pipeline", wraps=redis.pipeline):
+            assert not rate_limit_exceeded(
+                redis, rate_key, maxreq=10, expire=10, coalescer=coalescer
+            )
+            # The pending commands were sent in the same pipeline.
+            assert coalescer.read("foo", None) == [b"1"]
+            assert redis.get("bar") == b"2"
+            assert redis.pipeline.call_count == 1
+        assert redis.get(rate_key) == b"1"
+
+
+class TestRateLimitCounter(object):
+    rate_key = "apilimit:key_a:v1.geolocate:20150101"
+
+    @pytest.fixture
+    def clock(self):
+        return mock.Mock(return_value=0.0)
+
+    @pytest.fixture
+    def counter(self, clock):
+        return RateLimitCounter(interval=1.0, batch=5, tolerance=0.1, timer=clock)
+
+    @pytest.fixture
+    def coalescer(self, redis):
+        return RedisCoalescer(redis)
+
+    def test_disabled(self):
+        assert not RateLimitCounter(interval=0, batch=5, tolerance=0.1).enabled
+
+    def test_unknown_key(self, counter, coalescer, redis):
+        redis.set(self.rate_key, 7)
+        assert counter.incr(coalescer, self.rate_key, 100) == 8
+        assert int(redis.get(self.rate_key)) == 8
+
+    def test_interval(self, counter, coalescer, redis, clock):
+        assert counter.incr(coalescer, self.rate_key, 100) == 1
+        assert counter.incr(coalescer, self.rate_key, 100) == 2
+        assert counter.incr(coalescer, self.rate_key, 100) == 3
+        assert int(redis.get(self.rate_key)) == 1
+
+        # Other processes only get seen after a sync.
+        redis.incr(self.rate_key, 10)
+        clock.return_value = 1.0
+        assert counter.incr(coalescer, self.rate_key, 100) == 14
+        assert int(redis.get(self.rate_key)) == 14
+        assert 0 < redis.ttl(self.rate_key) <= 100
+
+    def test_batch(self, counter, coalescer, redis):
+        for i in range(5):
+            counter.incr(coalescer, self.rate_key, 100)
+        assert int(redis.get(self.rate_key)) == 1
+        counter.incr(coalescer, self.rate_key, 100)
+        assert int(redis.get(self.rate_key)) == 6
+
+    def test_tolerance(self, coalescer, redis, clock):
+        counter = RateLimitCounter(interval=1.0, batch=100, tolerance=0.1, timer=clock)
+        assert counter.incr(coalescer, self.rate_key, 100, maxreq=10) == 1
+        redis.incr(self.rate_key, 6)
+        for i in range(2, 9):
+            assert counter.incr(coalescer, self.rate_key, 100, maxreq=10) == i
+        assert int(redis.get(self.rate_key)) == 7
+        # The estimate gets within 10% of the limit.
+        assert counter.incr(coalescer, self.rate_key, 100, maxreq=10) == 15
+        assert int(redis.get(self.rate_key)) == 15
+        assert counter.incr(coalescer, self.rate_key, 100, maxreq=10) == 16
+        assert int(redis.get(self.rate_key)) == 16
+
+    def test_members(self, counter, coalescer, redis, clock):
+        log_key = "apiuser:locate:key_a:2015-01-01"
+        counter.add(log_key, "127.0.0.1", 100)
+        counter.add(log_key, "127.0.0.2", 100)
+        assert redis.pfcount(log_key) == 0
+        counter.sync(coalescer)
+        assert redis.pfcount(log_key) == 2
+
+    def test_failure(self, counter, coalescer, redis, clock, metricsmock):
+        counter.incr(coalescer, self.rate_key, 100)
+        counter.incr(coalescer, self.rate_key, 100)
+        clock.return_value = 1.0
+        with mock.patch.object(redis, "pipeline", side_effect=RedisError()):
+            with pytest.raises(RedisError):
+                counter.incr(coalescer, self.rate_key, 100)
+        counter.sync(coalescer)
+        assert int(redis.get(self.rate_key)) == 3
+        assert metricsmock.has_record(
+            "incr", "rate_limit.sync", value=1, tags=["status:failure"]
+        )
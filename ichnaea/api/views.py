@@ -14,6 +14,7 @@ from structlog.contextvars import bind_contextvars
 
 from ichnaea.api.exceptions import DailyLimitExceeded, InvalidAPIKey, ParseError
 from ichnaea.api.key import get_key, Key, validated_key
+from ichnaea.api.rate_limit import RATE_LIMIT_COUNTER, STRICT_KEYS
 from ichnaea.exceptions import GZIPDecodeError
 from ichnaea import util
 from ichnaea.webapp.view import BaseView
@@ -82,13 +83,26 @@ class BaseAPIView(BaseView):
         )
 
         should_limit = False
+
+        def log_and_count(pipe):
+            pipe.pfadd(log_ip_key, ip)
+            pipe.expire(log_ip_key, 691200)  # 8 days
+            pipe.incr(rate_key, 1)
+            pipe.expire(rate_key, 90000)  # 25 hours
+
+        # The count is needed right away, so the commands are executed
+        # together with the pending reads of the request, like the
+        # prefetched locate sample rate.
         try:
-            with self.redis_client.pipeline() as pipe:
-                pipe.pfadd(log_ip_key, ip)
-                pipe.expire(log_ip_key, 691200)  # 8 days
-                pipe.incr(rate_key, 1)
-                pipe.expire(rate_key, 90000)  # 25 hours
-                _, _, limit_count, _ = pipe.execute()
+            if RATE_LIMIT_COUNTER.enabled and valid_key not in STRICT_KEYS:
+                RATE_LIMIT_COUNTER.add(log_ip_key, ip, 691200)  # 8 days
+                limit_count = RATE_LIMIT_COUNTER.incr(
+                    self.request.redis_coalescer, rate_key, 90000, maxreq=maxreq
+                )
+            else:
+                _, _, limit_count, _ = self.request.redis_coalescer.execute(
+                    log_and_count
+                )
             log_params = {
                 "api_key_count": limit_count,
             }
@@ -2,13 +2,45 @@
 Functionality related to using Redis as a cache and a queue.
 """
 
+import calendar
 from contextlib import contextmanager
+from datetime import date, datetime
+import struct
 from urllib.parse import urlparse
 
+import gevent
+import markus
 import redis
 from redis.exceptions import RedisError
 
 from ichnaea.conf import settings
+from ichnaea import util
+
+METRICS = markus.get_metrics()
+
+# Prefix for the shared station cache keys, followed by the station
+# table name and the encoded station key. The number is a counter
+# which can be incremented whenever the record format changes.
+STATION_CACHE_PREFIX = b"cache:station:1:"
+
+# The station fields stored in a shared cache record, the station key
+# itself is part of the cache key.
+STATION_RECORD_FIELDS = (
+    "lat",
+    "lon",
+    "radius",
+    "region",
+    "samples",
+    "created",
+    "modified",
+    "last_seen",
+    "block_last",
+    "block_count",
+)
+# A bitmask of None fields, followed by one value per field.
+STATION_RECORD = struct.Struct("<HddI2sIqqiiI")
+
+_NULL_VALUES = {"lat": 0.0, "lon": 0.0, "region": b""}
 
 
 def configure_redis(cache_url=None, _client=None):
@@ -59,6 +91,212 @@ def redis_pipeline(redis_client, execute=True):
             pipe.execute()
 
 
+def _parse_float(value, default):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+# Tuning values stored in Redis and read by the web workers, mapped to
+# a parser and the default used if the key is unset or invalid.
+RUNTIME_CONFIG_KEYS = {"global_locate_sample_rate": (_parse_float, 100.0)}
+
+
+def parse_runtime_value(name, raw_value):
+    """Parse a raw tuning value as read from Redis."""
+    parser, default = RUNTIME_CONFIG_KEYS[name]
+    return parser(raw_value, default)
+
+
+def configure_runtime_config(redis_client, interval=None):
+    """
+    Configure and return a :class:`~ichnaea.cache.RuntimeConfig`, or
+    `None` if the values should be read from Redis whenever needed.
+
+    :param interval: Seconds between reloads, defaults to the
+        ``REDIS_RUNTIME_CONFIG_INTERVAL`` setting.
+    """
+    if interval is None:
+        interval = settings("redis_runtime_config_interval")
+    if interval <= 0:
+        return None
+    return RuntimeConfig(redis_client, interval)
+
+
+class RuntimeConfig(object):
+    """
+    A process-local snapshot of the tuning values stored in Redis.
+
+    The values are loaded on first use, and then reloaded every
+    `interval` seconds by a background greenlet, so reading them never
+    blocks on Redis. If a reload fails, the last values are kept.
+    """
+
+    def __init__(self, redis_client, interval):
+        self.redis_client = redis_client
+        self.interval = interval
+        self._greenlet = None
+        self._values = {}
+
+    def get(self, name):
+        """Return the current value for the given Redis key."""
+        if self._greenlet is None or self._greenlet.dead:
+            # Started lazily, to run in the forked web worker.
+            self.refresh()
+            self._greenlet = gevent.spawn(self._run)
+        if name in self._values:
+            return self._values[name]
+        return parse_runtime_value(name, None)
+
+    def refresh(self):
+        """Reload all values from Redis."""
+        names = sorted(RUNTIME_CONFIG_KEYS.keys())
+        try:
+            raw_values = self.redis_client.mget(names)
+        except RedisError:
+            METRICS.incr("runtime_config.refresh", tags=["status:failure"])
+            return
+
+        self._values = {
+            name: parse_runtime_value(name, raw_value)
+            for name, raw_value in zip(names, raw_values)
+        }
+        METRICS.incr("runtime_config.refresh", tags=["status:success"])
+
+    def stop(self):
+        """Stop the background reloads."""
+        if self._greenlet is not None:
+            self._greenlet.kill()
+            self._greenlet = None
+
+    def _run(self):
+        while True:
+            gevent.sleep(self.interval)
+            self.refresh()
+
+
+def redis_coalescer(request):
+    """Attach a Redis command coalescer to the request."""
+    coalescer = getattr(request, "_redis_coalescer", None)
+    if coalescer is None:
+        request._redis_coalescer = coalescer = RedisCoalescer(
+            request.registry.redis_client
+        )
+    return coalescer
+
+
+def redis_tween_factory(handler, registry):
+    """A Redis tween, sending all deferred commands at the end of a request."""
+
+    def redis_tween(request):
+        try:
+            return handler(request)
+        finally:
+            coalescer = getattr(request, "_redis_coalescer", None)
+            if coalescer is not None:
+                try:
+                    coalescer.close()
+                except RedisError:
+                    registry.raven_client.captureException()
+
+    return redis_tween
+
+
+class RedisCoalescer(object):
+    """
+    Collects the Redis commands of one web request, to send them in as
+    few pipelines as possible.
+
+    Commands are added by callables, which get a pipeline as their only
+    argument. Named reads can be prefetched, they are sent along with
+    the next pipeline which has to be executed anyway. Writes whose
+    results aren't needed are deferred until :meth:`flush` is called,
+    at the latest when the request ends and :meth:`close` is called.
+    Writes deferred by greenlets outliving the request are executed
+    right away.
+
+    The API key IP log and rate limit, the locate sample rate, the stored
+    queries and the fallback cache and rate limit commands all use the
+    coalescer of the request. The shared station cache doesn't, its
+    reads and writes are still sent in their own pipelines.
+
+    If a pipeline fails, all pending commands are dropped.
+
+    :param deferred: If False, deferred writes are executed right away.
+    :type deferred: bool
+    """
+
+    def __init__(self, redis_client, deferred=True):
+        self.redis_client = redis_client
+        self.deferred = deferred
+        self._pending = []
+        self._results = {}
+
+    def prefetch(self, name, func):
+        """Add a named read, to be sent with the next pipeline."""
+        if name in self._results:
+            return
+        if name not in [pending_name for pending_name, _ in self._pending]:
+            self._pending.append((name, func))
+
+    def read(self, name, func):
+        """
+        Return the list of results of a named read. If the read hasn't
+        been prefetched, it is executed right away.
+        """
+        if name not in self._results:
+            self.prefetch(name, func)
+            self.flush()
+        return self._results[name]
+
+    def defer(self, func):
+        """Add commands whose results aren't needed."""
+        self._pending.append((None, func))
+        if not self.deferred:
+            self.flush()
+
+    def close(self):
+        """
+        Execute all pending commands, and any commands deferred later
+        on right away.
+        """
+        self.deferred = False
+        self.flush()
+
+    def execute(self, func):
+        """
+        Execute the commands added by `func` together with all pending
+        commands and return the list of results of `func` commands.
+        """
+        return self._execute(func)
+
+    def flush(self):
+        """Execute all pending commands."""
+        if self._pending:
+            self._execute(None)
+
+    def _execute(self, func):
+        pending, self._pending = self._pending, []
+        if func is not None:
+            pending.append((None, func))
+
+        spans = []
+        with self.redis_client.pipeline() as pipe:
+            for name, pending_func in pending:
+                start = len(pipe)
+                pending_func(pipe)
+                spans.append((name, start, len(pipe)))
+            values = pipe.execute() if len(pipe) else []
+
+        for name, start, end in spans:
+            if name is not None:
+                self._results[name] = values[start:end]
+        if func is not None:
+            name, start, end = spans[-1]
+            return values[start:end]
+
+
 class RedisClient(redis.StrictRedis):
     """A strict pingable RedisClient."""
 
@@ -86,3 +324,51 @@ class RedisClient(redis.StrictRedis):
         except RedisError:
             return False
         return True
+
+
+def station_cache_key(table, key):
+    """Return the shared cache key for a station in the given table."""
+    return STATION_CACHE_PREFIX + table.encode("ascii") + b":" + key
+
+
+def encode_station(row):
+    """
+    Encode the :data:`STATION_RECORD_FIELDS` of a station row into
+    a compact 56 byte record.
+    """
+    values = []
+    nulls = 0
+    for i, field in enumerate(STATION_RECORD_FIELDS):
+        value = getattr(row, field)
+        if value is None:
+            nulls |= 1 << i
+            value = _NULL_VALUES.get(field, 0)
+        elif field in ("created", "modified"):
+            value = calendar.timegm(value.utctimetuple())
+        elif field in ("last_seen", "block_last"):
+            value = value.toordinal()
+        elif field == "region":
+            value = value.encode("ascii")
+        values.append(value)
+    return STATION_RECORD.pack(nulls, *values)
+
+
+def decode_station(value):
+    """
+    Decode a record created by :func:`encode_station` into a tuple of
+    the :data:`STATION_RECORD_FIELDS` values.
+    """
+    nulls, *values = STATION_RECORD.unpack(value)
+    result = []
+    for i, (field, value) in enumerate(zip(STATION_RECORD_FIELDS, values)):
+        if nulls & (1 << i):
+            value = None
+        elif field in ("created", "modified"):
+            # Like the TZDateTime database columns, return UTC datetimes.
+            value = datetime.fromtimestamp(value, util.UTC)
+        elif field in ("last_seen", "block_last"):
+            value = date.fromordinal(value)
+        elif field == "region":
+            value = value.rstrip(b"\0").decode("ascii")
+        result.append(value)
+    return tuple(result)
@@ -6,7 +6,7 @@ from __future__ import absolute_import
 import os
 import os.path
 
-from everett.manager import ConfigManager, ConfigOSEnv, Option
+from everett.manager import ConfigManager, ConfigOSEnv, ListOf, Option
 
 HERE = os.path.dirname(__file__)
 
@@ -57,6 +57,31 @@ class AppComponent:
             doc="url for map tile image assets and export downloads",
             default="",
         )
+        cell_export_processes = Option(
+            doc=(
+                "number of processes writing the daily full cell export in"
+                " parallel, 1 writes it in the task process"
+            ),
+            default="1",
+            parser=int,
+        )
+        cell_export_streaming = Option(
+            doc=(
+                "whether the cell exports are uploaded to S3 while they are"
+                " written, without a local file; only used if"
+                " CELL_EXPORT_PROCESSES is 1"
+            ),
+            default="false",
+            parser=bool,
+        )
+        cell_export_work_dir = Option(
+            doc=(
+                "directory keeping the partial files and checkpoint of a parallel"
+                " full cell export, to resume it after a crash; a temporary"
+                " directory is used if blank"
+            ),
+            default="",
+        )
 
         # Database related settings
         db_readonly_uri = Option(
@@ -100,6 +125,188 @@ class AppComponent:
             default="default for development, change in production",
         )
 
+        # API rate limit related settings
+        api_rate_limit_interval = Option(
+            doc=(
+                "seconds between syncs of the per-process API rate limit counters"
+                " with Redis; 0 counts every request in Redis right away"
+            ),
+            default="0",
+            parser=float,
+        )
+        api_rate_limit_batch = Option(
+            doc=(
+                "number of counted requests after which the per-process API"
+                " rate limit counters are synced with Redis"
+            ),
+            default="100",
+            parser=int,
+        )
+        api_rate_limit_tolerance = Option(
+            doc=(
+                "fraction of a rate limit; counts within this distance of the"
+                " limit are synced with Redis for every request"
+            ),
+            default="0.1",
+            parser=float,
+        )
+        api_rate_limit_strict_keys = Option(
+            doc=(
+                "comma-separated list of API keys whose requests are always"
+                " counted in Redis right away"
+            ),
+            default="",
+            parser=ListOf(str),
+        )
+
+        # Locate related settings
+        locate_station_cache_size = Option(
+            doc=(
+                "maximum number of station rows kept in the per-process locate"
+                " cache; 0 disables the cache"
+            ),
+            default="0",
+            parser=int,
+        )
+        locate_station_cache_ttl = Option(
+            doc="seconds a station row is kept in the per-process locate cache",
+            default="300",
+            parser=int,
+        )
+        locate_station_cache_negative_ttl = Option(
+            doc=(
+                "seconds an unknown station is remembered in the per-process"
+                " locate cache; 0 disables caching of unknown stations"
+            ),
+            default="60",
+            parser=int,
+        )
+        redis_runtime_config_interval = Option(
+            doc=(
+                "seconds between reloads of the tuning values stored in Redis,"
+                " like the global locate sample rate; 0 reads them from Redis"
+                " for every query"
+            ),
+            default="0",
+            parser=float,
+        )
+        locate_latency_budget = Option(
+            doc=(
+                "seconds a locate or region query may take; the database"
+                " lookups and the external fallback call only get the time left"
+                " in the budget, enforced by MySQL's MAX_EXECUTION_TIME hint or"
+                " MariaDB's max_statement_time, 0 disables the budget"
+            ),
+            default="0",
+            parser=float,
+        )
+        locate_concurrent_sources = Option(
+            doc=(
+                "Whether the locate sources run concurrently (True) or one after"
+                " the other (False)"
+            ),
+            default="false",
+            parser=bool,
+        )
+        locate_fallback_hedge_delay = Option(
+            doc=(
+                "seconds after which a concurrently running fallback source is"
+                " started while the earlier locate sources are still searching,"
+                " 0 only starts it once their results are known to be"
+                " insufficient"
+            ),
+            default="0",
+            parser=float,
+        )
+        locate_source_timeout = Option(
+            doc=(
+                "seconds the searcher waits for the result of a concurrently"
+                " running locate source without a timeout of its own"
+            ),
+            default="6.0",
+            parser=float,
+        )
+        locate_union_shard_queries = Option(
+            doc=(
+                "Whether station lookups spanning multiple shard tables are"
+                " combined into one UNION ALL query (True) or run as one query"
+                " per shard (False)"
+            ),
+            default="false",
+            parser=bool,
+        )
+        locate_station_shared_cache_ttl = Option(
+            doc=(
+                "seconds a station row is kept in the locate cache shared via"
+                " Redis; 0 disables the shared cache"
+            ),
+            default="0",
+            parser=int,
+        )
+        locate_station_shared_cache_negative_ttl = Option(
+            doc=(
+                "seconds an unknown station is remembered in the locate cache"
+                " shared via Redis; 0 disables caching of unknown stations"
+            ),
+            default="60",
+            parser=int,
+        )
+
+        # Data pipeline related settings
+        station_update_columnar = Option(
+            doc=(
+                "Whether the station updaters aggregate the observations of all"
+                " stations in a shard batch together in grouped array operations"
+                " (True) or station by station (False)"
+            ),
+            default="false",
+            parser=bool,
+        )
+        cellarea_update_batched = Option(
+            doc=(
+                "Whether the cell area updater aggregates the cells of all areas"
+                " in a batch with one grouped query per cell shard (True) or"
+                " loads the cells area by area (False)"
+            ),
+            default="false",
+            parser=bool,
+        )
+        cellarea_update_incremental = Option(
+            doc=(
+                "Whether the cell updaters queue deltas of the cell area running"
+                " totals, applied without loading the cells of the areas (True),"
+                " or queue the areas for a full update (False)"
+            ),
+            default="false",
+            parser=bool,
+        )
+        data_queue_batch_target = Option(
+            doc=(
+                "target seconds to process one batch of a data queue; the batch"
+                " sizes are adapted to it, 0 keeps the fixed batch sizes"
+            ),
+            default="0",
+            parser=float,
+        )
+        data_queue_binary_observations = Option(
+            doc=(
+                "Whether observations are put into the station update queues as"
+                " compact binary records (True) or as JSON (False); both formats"
+                " are always read"
+            ),
+            default="false",
+            parser=bool,
+        )
+        station_worker_types = Option(
+            doc=(
+                "comma-separated list of station types (blue, cell, wifi) updated"
+                " by the long-running station worker; celery tasks aren't"
+                " scheduled for these types"
+            ),
+            default="",
+            parser=ListOf(str),
+        )
+
     def __init__(self, config):
         self.raw_config = config
         self.config = config.with_options(self)
@@ -15,6 +15,7 @@ from structlog.contextvars import merge_contextvars
 import webtest
 
 from ichnaea.api.key import API_CACHE, API_CACHE_LOCK
+from ichnaea.api.locate.cache import STATION_CACHE
 from ichnaea.api.locate.searcher import (
     configure_position_searcher,
     configure_region_searcher,
@@ -260,6 +261,7 @@ def independent_session(db_independent_session):
             )
     with API_CACHE_LOCK:
         API_CACHE.clear()
+    STATION_CACHE.clear()
 
 
 @pytest.fixture
@@ -284,6 +286,7 @@ def shared_session(db_shared_session):
             db_shared_session.has_session_fixture = False
     with API_CACHE_LOCK:
         API_CACHE.clear()
+    STATION_CACHE.clear()
 
 
 @pytest.fixture
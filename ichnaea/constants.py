@@ -10,3 +10,5 @@ MIN_LAT = -85.051  # Minimum latitude in :term:`Web Mercator` projection.
 
 MAX_LON = 180.0  # Maximum unrestricted longitude in :term:`WSG84`.
 MIN_LON = -180.0  # Minimum unrestricted longitude in :term:`WSG84`.
+
+EARTH_RADIUS = 6371.009  # Mean earth radius in km, used in Haversine distances.
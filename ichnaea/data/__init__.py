@@ -5,9 +5,17 @@ Contains asynchronous tasks and data pipeline logic.
 from ichnaea.conf import settings
 
 
+def _cellarea_incremental_enabled():
+    return bool(settings("cellarea_update_incremental"))
+
+
 def _cell_export_enabled():
     return bool(settings("asset_bucket"))
 
 
 def _map_content_enabled():
     return bool(settings("mapbox_token"))
+
+
+def _station_task_enabled(station_type):
+    return station_type not in settings("station_worker_types")
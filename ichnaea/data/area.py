@@ -1,20 +1,253 @@
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+from datetime import date, datetime
+import json
 
 import numpy
-from sqlalchemy import delete, select
+from sqlalchemy import delete, func, select, tuple_
+from sqlalchemy.dialects.mysql import insert
 
 from geocalc import circle_radius
+from ichnaea.conf import settings
 from ichnaea.db import retry_on_mysql_lock_fail
 from ichnaea.geocode import GEOCODER
-from ichnaea.models import decode_cellarea, CellArea, CellShard
+from ichnaea.models import (
+    decode_cellarea,
+    encode_cellarea,
+    CellArea,
+    CellShard,
+    Radio,
+)
 from ichnaea import util
 
+# A Redis set of the area ids changed by incremental updates, whose
+# running totals are fully recomputed by the daily drift correction.
+DELTA_AREAS_KEY = "cellarea:delta_areas"
+
+# The values of a cell with a position, which contribute to its area.
+AreaCell = namedtuple(
+    "AreaCell",
+    (
+        "lat",
+        "lon",
+        "max_lat",
+        "min_lat",
+        "max_lon",
+        "min_lon",
+        "radius",
+        "region",
+        "last_seen",
+    ),
+)
+
+
+def encode_region_counts(regions):
+    """
+    Encode a mapping of cell regions to the number of cells in them into
+    the JSON string stored in the area `region_counts` column.
+    """
+    return json.dumps(
+        dict([(region or "", count) for region, count in regions.items() if count]),
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+
+
+def decode_region_counts(value):
+    """Decode the area `region_counts` column into a dictionary."""
+    return dict(
+        [(region or None, count) for region, count in json.loads(value).items()]
+    )
+
+
+def _float_or_none(value):
+    return None if value is None else float(value)
+
+
+def _none_if_nan(value):
+    value = float(value)
+    return None if numpy.isnan(value) else value
+
+
+class CellAreaDelta(object):
+    """
+    The change of the running totals of one cell area, caused by the
+    cells inside it gaining, changing or losing their position.
+
+    Only the bounding boxes and last seen dates of the new cell values
+    are known, so the deltas can grow but never shrink them.
+
+    The `created` time is taken before the cell changes are committed.
+    A full update of the area after this time might already include the
+    changes, so the delta must not be applied on top of it.
+    """
+
+    def __init__(
+        self,
+        area,
+        num_cells=0,
+        sum_lat=0.0,
+        sum_lon=0.0,
+        sum_radius=0,
+        num_radius=0,
+        regions=None,
+        max_lat=None,
+        min_lat=None,
+        max_lon=None,
+        min_lon=None,
+        last_seen=None,
+        created=None,
+    ):
+        self.area = tuple(area)
+        self.num_cells = num_cells
+        self.sum_lat = sum_lat
+        self.sum_lon = sum_lon
+        self.sum_radius = sum_radius
+        self.num_radius = num_radius
+        self.regions = defaultdict(int, regions or {})
+        self.max_lat = max_lat
+        self.min_lat = min_lat
+        self.max_lon = max_lon
+        self.min_lon = min_lon
+        self.last_seen = last_seen
+        self.created = created
+
+    def add(self, cell, sign=1):
+        """
+        Add the contribution of an :class:`AreaCell`, or remove it if
+        `sign` is -1.
+        """
+        self.num_cells += sign
+        self.sum_lat += sign * cell.lat
+        self.sum_lon += sign * cell.lon
+        if cell.radius is not None:
+            self.sum_radius += sign * cell.radius
+            self.num_radius += sign
+        self.regions[cell.region] += sign
+        if sign > 0:
+            self.extend(
+                max_lat=cell.max_lat,
+                min_lat=cell.min_lat,
+                max_lon=cell.max_lon,
+                min_lon=cell.min_lon,
+                last_seen=cell.last_seen,
+            )
+
+    def extend(self, max_lat, min_lat, max_lon, min_lon, last_seen):
+        """Grow the bounding box and last seen date."""
+        # Like the full update, the bounding box is based on the
+        # bounding boxes of the cells.
+        lats = [
+            v for v in (self.max_lat, self.min_lat, max_lat, min_lat) if v is not None
+        ]
+        lons = [
+            v for v in (self.max_lon, self.min_lon, max_lon, min_lon) if v is not None
+        ]
+        if lats:
+            self.max_lat = max(lats)
+            self.min_lat = min(lats)
+        if lons:
+            self.max_lon = max(lons)
+            self.min_lon = min(lons)
+        if last_seen is not None and (
+            self.last_seen is None or last_seen > self.last_seen
+        ):
+            self.last_seen = last_seen
+
+    def merge(self, other):
+        """Merge another delta of the same area into this one."""
+        self.num_cells += other.num_cells
+        self.sum_lat += other.sum_lat
+        self.sum_lon += other.sum_lon
+        self.sum_radius += other.sum_radius
+        self.num_radius += other.num_radius
+        for region, count in other.regions.items():
+            self.regions[region] += count
+        self.extend(
+            max_lat=other.max_lat,
+            min_lat=other.min_lat,
+            max_lon=other.max_lon,
+            min_lon=other.min_lon,
+            last_seen=other.last_seen,
+        )
+        # Keep the oldest time, any of the merged changes might be part
+        # of a later full update.
+        if self.created is None or other.created is None:
+            self.created = None
+        else:
+            self.created = min(self.created, other.created)
+
+    def to_json(self):
+        radio, mcc, mnc, lac = self.area
+        return {
+            "area": [int(radio), mcc, mnc, lac],
+            "num_cells": self.num_cells,
+            "sum_lat": float(self.sum_lat),
+            "sum_lon": float(self.sum_lon),
+            "sum_radius": int(self.sum_radius),
+            "num_radius": self.num_radius,
+            "regions": dict(
+                [
+                    (region or "", count)
+                    for region, count in self.regions.items()
+                    if count
+                ]
+            ),
+            "max_lat": _float_or_none(self.max_lat),
+            "min_lat": _float_or_none(self.min_lat),
+            "max_lon": _float_or_none(self.max_lon),
+            "min_lon": _float_or_none(self.min_lon),
+            "last_seen": (
+                self.last_seen.isoformat() if self.last_seen is not None else None
+            ),
+            "created": (self.created.isoformat() if self.created is not None else None),
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        radio, mcc, mnc, lac = data["area"]
+        last_seen = data["last_seen"]
+        # Deltas queued before the created time was added have none.
+        created = data.get("created")
+        return cls(
+            (Radio(radio), mcc, mnc, lac),
+            num_cells=data["num_cells"],
+            sum_lat=data["sum_lat"],
+            sum_lon=data["sum_lon"],
+            sum_radius=data["sum_radius"],
+            num_radius=data["num_radius"],
+            regions=dict(
+                [(region or None, count) for region, count in data["regions"].items()]
+            ),
+            max_lat=data["max_lat"],
+            min_lat=data["min_lat"],
+            max_lon=data["max_lon"],
+            min_lon=data["min_lon"],
+            last_seen=(
+                date.fromisoformat(last_seen) if last_seen is not None else None
+            ),
+            created=(datetime.fromisoformat(created) if created is not None else None),
+        )
+
 
 class CellAreaUpdater(object):
+    """
+    Update the cell areas from the cells inside them.
+
+    In the batched mode, the cells of all areas in a batch are aggregated
+    by one grouped query per cell shard, and all area rows are written
+    by a single insert or update statement.
+
+    Both modes also store the running totals of the areas, which the
+    :class:`CellAreaDeltaUpdater` keeps up to date in between.
+    """
 
     area_table = CellArea.__table__
     cell_model = CellShard
     queue_name = "update_cellarea"
+    batched = settings("cellarea_update_batched")
+
+    # Fields which aren't changed when updating an existing area row.
+    _key_fields = ("areaid", "radio", "mcc", "mnc", "lac", "created")
 
     def __init__(self, task):
         self.task = task
@@ -22,8 +255,9 @@ class CellAreaUpdater(object):
         self.utcnow = util.utcnow()
 
     def __call__(self):
-        areaids = self.queue.dequeue()
-        self.update_areas(areaids)
+        with self.queue.processing():
+            areaids = self.queue.dequeue()
+            self.update_areas(areaids)
         if self.queue.ready():
             self.task.apply_async()
 
@@ -42,23 +276,35 @@ class CellAreaUpdater(object):
             ).fetchall()
             existing_areas = set(row[0] for row in rows)
 
+            if self.batched:
+                self.update_areas_batched(session, areaid_set, existing_areas)
+                return
+
             # Update each cellarea row from cell tables
             for areaid in areaid_set:
                 area_is_new = decode_cellarea(areaid) not in existing_areas
                 self.update_area(session, areaid, area_is_new)
 
+    def region_counts(self, cells):
+        grouped_regions = defaultdict(int)
+        for cell in cells:
+            grouped_regions[cell.region] += 1
+        return grouped_regions
+
     def region(self, ctr_lat, ctr_lon, mcc, cells):
+        return self.majority_region(ctr_lat, ctr_lon, mcc, self.region_counts(cells))
+
+    def majority_region(self, ctr_lat, ctr_lon, mcc, grouped_regions):
+        """
+        Return the area region, given a mapping of the cell regions to
+        the number of cells in them.
+        """
         region = None
-        regions = [cell.region for cell in cells]
-        unique_regions = set(regions)
-        if len(unique_regions) == 1:
-            region = regions[0]
+        if len(grouped_regions) == 1:
+            region = list(grouped_regions.keys())[0]
         else:
             # Choose the area region based on the majority of cells
             # inside each region.
-            grouped_regions = defaultdict(int)
-            for reg in regions:
-                grouped_regions[reg] += 1
             max_count = max(grouped_regions.values())
             max_regions = sorted(
                 [k for k, v in grouped_regions.items() if v == max_count],
@@ -104,6 +350,9 @@ class CellAreaUpdater(object):
             .where(shard.__table__.c.lat.isnot(None))
             .where(shard.__table__.c.lon.isnot(None))
         ).fetchall()
+        # Taken after reading the cells, all cell changes committed
+        # before this time are part of the totals.
+        totals_modified = util.utcnow()
 
         if len(cells) == 0:
             # If there are no more underlying cells, delete the area entry
@@ -148,7 +397,8 @@ class CellAreaUpdater(object):
         )
         avg_cell_radius = int(round(numpy.nanmean(cell_radii)))
         num_cells = len(cells)
-        region = self.region(ctr_lat, ctr_lon, mcc, cells)
+        grouped_regions = self.region_counts(cells)
+        region = self.majority_region(ctr_lat, ctr_lon, mcc, grouped_regions)
 
         last_seen = None
         cell_last_seen = set(
@@ -157,6 +407,20 @@ class CellAreaUpdater(object):
         if cell_last_seen:
             last_seen = max(cell_last_seen)
 
+        radii = [cell.radius for cell in cells if cell.radius is not None]
+        totals = {
+            "sum_lat": float(sum([cell.lat for cell in cells])),
+            "sum_lon": float(sum([cell.lon for cell in cells])),
+            "sum_radius": sum(radii),
+            "num_radius": len(radii),
+            "max_lat": _none_if_nan(max_lat),
+            "min_lat": _none_if_nan(min_lat),
+            "max_lon": _none_if_nan(max_lon),
+            "min_lon": _none_if_nan(min_lon),
+            "region_counts": encode_region_counts(grouped_regions),
+            "totals_modified": totals_modified,
+        }
+
         if area_is_new:
             session.execute(
                 self.area_table.insert().values(
@@ -174,6 +438,7 @@ class CellAreaUpdater(object):
                     avg_cell_radius=avg_cell_radius,
                     num_cells=num_cells,
                     last_seen=last_seen,
+                    **totals,
                 )
                 # If there was an unexpected insert, log warning instead of error
                 .prefix_with("IGNORE", dialect="mysql")
@@ -191,5 +456,365 @@ class CellAreaUpdater(object):
                     avg_cell_radius=avg_cell_radius,
                     num_cells=num_cells,
                     last_seen=last_seen,
+                    **totals,
+                )
+            )
+
+    def update_areas_batched(self, session, areaids, existing_areas):
+        """
+        Update the given areas from aggregates of their cells, and delete
+        the areas without any cells.
+        """
+        areas = [decode_cellarea(areaid) for areaid in areaids]
+        aggregates = self.area_aggregates(session, areas)
+        totals_modified = util.utcnow()
+
+        values = []
+        for area in areas:
+            if area in aggregates:
+                values.append(self.area_values(area, aggregates[area], totals_modified))
+
+        if values:
+            # The existing rows are locked, but a new area can still be
+            # inserted concurrently, so update it if it exists.
+            stmt = insert(self.area_table).values(values)
+            session.execute(
+                stmt.on_duplicate_key_update(
+                    **dict(
+                        [
+                            (name, stmt.inserted[name])
+                            for name in values[0].keys()
+                            if name not in self._key_fields
+                        ]
+                    )
                 )
             )
+
+        removed = [
+            encode_cellarea(*area)
+            for area in areas
+            if area not in aggregates and area in existing_areas
+        ]
+        if removed:
+            # If there are no more underlying cells, delete the area entries
+            session.execute(
+                delete(self.area_table).where(self.area_table.c.areaid.in_(removed))
+            )
+
+    def area_aggregates(self, session, areas):
+        """
+        Return a dictionary mapping the given (radio, mcc, mnc, lac) area
+        tuples to a list of cell aggregates, one for each region of the
+        cells with a position inside the area.
+        """
+        shard_areas = defaultdict(list)
+        for area in areas:
+            shard_areas[self.cell_model.shard_model(area[0])].append(area)
+
+        aggregates = defaultdict(list)
+        for shard, keys in shard_areas.items():
+            columns = shard.__table__.c
+            rows = session.execute(
+                select(
+                    [
+                        columns.radio,
+                        columns.mcc,
+                        columns.mnc,
+                        columns.lac,
+                        columns.region,
+                        func.count().label("num_cells"),
+                        func.sum(columns.lat).label("sum_lat"),
+                        func.sum(columns.lon).label("sum_lon"),
+                        func.max(columns.max_lat).label("max_max_lat"),
+                        func.max(columns.min_lat).label("max_min_lat"),
+                        func.max(columns.max_lon).label("max_max_lon"),
+                        func.max(columns.min_lon).label("max_min_lon"),
+                        func.min(columns.max_lat).label("min_max_lat"),
+                        func.min(columns.min_lat).label("min_min_lat"),
+                        func.min(columns.max_lon).label("min_max_lon"),
+                        func.min(columns.min_lon).label("min_min_lon"),
+                        func.sum(columns.radius).label("sum_radius"),
+                        func.count(columns.radius).label("num_radius"),
+                        func.max(columns.last_seen).label("last_seen"),
+                    ]
+                )
+                .where(
+                    tuple_(columns.radio, columns.mcc, columns.mnc, columns.lac).in_(
+                        keys
+                    )
+                )
+                .where(columns.lat.isnot(None))
+                .where(columns.lon.isnot(None))
+                .group_by(
+                    columns.radio,
+                    columns.mcc,
+                    columns.mnc,
+                    columns.lac,
+                    columns.region,
+                )
+            ).fetchall()
+            for row in rows:
+                aggregates[(row.radio, row.mcc, row.mnc, row.lac)].append(row)
+        return aggregates
+
+    def area_values(self, area, aggregates, totals_modified):
+        """
+        Return the area row values based on its cell aggregates, read
+        before the `totals_modified` time.
+        """
+
+        def extreme(func, *names):
+            values = [
+                getattr(row, name)
+                for row in aggregates
+                for name in names
+                if getattr(row, name) is not None
+            ]
+            return func(values) if values else numpy.nan
+
+        radio, mcc, mnc, lac = area
+        num_cells = sum([row.num_cells for row in aggregates])
+        sum_lat = float(sum([row.sum_lat for row in aggregates]))
+        sum_lon = float(sum([row.sum_lon for row in aggregates]))
+        ctr_lat = sum_lat / num_cells
+        ctr_lon = sum_lon / num_cells
+
+        max_lat = extreme(max, "max_max_lat", "max_min_lat")
+        max_lon = extreme(max, "max_max_lon", "max_min_lon")
+        min_lat = extreme(min, "min_max_lat", "min_min_lat")
+        min_lon = extreme(min, "min_max_lon", "min_min_lon")
+        radius = circle_radius(ctr_lat, ctr_lon, max_lat, max_lon, min_lat, min_lon)
+
+        avg_cell_radius = None
+        sum_radius = 0
+        num_radius = sum([row.num_radius for row in aggregates])
+        if num_radius:
+            sum_radius = sum([int(row.sum_radius or 0) for row in aggregates])
+            avg_cell_radius = int(round(sum_radius / num_radius))
+
+        grouped_regions = dict([(row.region, row.num_cells) for row in aggregates])
+        region = self.majority_region(ctr_lat, ctr_lon, mcc, grouped_regions)
+
+        cell_last_seen = [row.last_seen for row in aggregates if row.last_seen]
+        last_seen = max(cell_last_seen) if cell_last_seen else None
+
+        return {
+            "areaid": encode_cellarea(radio, mcc, mnc, lac),
+            "radio": radio,
+            "mcc": mcc,
+            "mnc": mnc,
+            "lac": lac,
+            "created": self.utcnow,
+            "modified": self.utcnow,
+            "lat": ctr_lat,
+            "lon": ctr_lon,
+            "radius": radius,
+            "region": region,
+            "avg_cell_radius": avg_cell_radius,
+            "num_cells": num_cells,
+            "last_seen": last_seen,
+            "sum_lat": sum_lat,
+            "sum_lon": sum_lon,
+            "sum_radius": sum_radius,
+            "num_radius": num_radius,
+            "max_lat": _none_if_nan(max_lat),
+            "min_lat": _none_if_nan(min_lat),
+            "max_lon": _none_if_nan(max_lon),
+            "min_lon": _none_if_nan(min_lon),
+            "region_counts": encode_region_counts(grouped_regions),
+            "totals_modified": totals_modified,
+        }
+
+
+class CellAreaDeltaUpdater(CellAreaUpdater):
+    """
+    Update the cell areas incrementally, by applying the deltas of their
+    running totals queued by the :class:`~ichnaea.data.station.CellUpdater`.
+
+    New areas, areas without running totals and areas whose totals no
+    longer add up are queued for a full update instead. So are the areas
+    of deltas created before the last full update of the area, whose
+    totals might already include them. Deltas can't
+    shrink the bounding box of an area, so all areas changed by deltas
+    are fully updated once a day by the :class:`CellAreaDriftCorrector`.
+    """
+
+    queue_name = "update_cellarea_delta"
+    full_queue_name = "update_cellarea"
+
+    def __call__(self):
+        with self.queue.processing():
+            deltas = {}
+            for data in self.queue.dequeue():
+                delta = CellAreaDelta.from_json(data)
+                if delta.area in deltas:
+                    deltas[delta.area].merge(delta)
+                else:
+                    deltas[delta.area] = delta
+
+            if deltas:
+                updated, full_updates = self.apply_deltas(deltas)
+                with self.task.redis_pipeline() as pipe:
+                    if updated:
+                        pipe.sadd(DELTA_AREAS_KEY, *updated)
+                    if full_updates:
+                        self.task.app.data_queues[self.full_queue_name].enqueue(
+                            full_updates, pipe=pipe
+                        )
+        if self.queue.ready():
+            self.task.apply_async()
+
+    @retry_on_mysql_lock_fail(
+        metric="data.station.dberror", metric_tags=["type:cellarea"]
+    )
+    def apply_deltas(self, deltas):
+        """
+        Apply the deltas to the running totals of their areas.
+
+        Return a tuple of the ids of the updated areas and the ids of the
+        areas which need a full update.
+        """
+        areaids = [encode_cellarea(*area) for area in deltas.keys()]
+        with self.task.db_session() as session:
+            rows = session.execute(
+                select([self.area_table])
+                .where(self.area_table.c.areaid.in_(areaids))
+                .with_for_update()
+            ).fetchall()
+            existing_areas = dict([(row.areaid, row) for row in rows])
+
+            updates = []
+            full_updates = []
+            for area, delta in deltas.items():
+                values = None
+                if area in existing_areas:
+                    values = self.delta_values(existing_areas[area], delta)
+                if values is None:
+                    full_updates.append(encode_cellarea(*area))
+                else:
+                    updates.append(values)
+
+            if updates:
+                session.bulk_update_mappings(CellArea, updates)
+
+        return ([values["areaid"] for values in updates], full_updates)
+
+    def delta_values(self, row, delta):
+        """
+        Return the changed values of an area row after applying a delta,
+        or None if the area needs a full update.
+        """
+        if (
+            row.region_counts is None
+            or row.num_cells is None
+            or row.totals_modified is None
+        ):
+            # The row hasn't been written by a full update yet.
+            return None
+
+        if delta.created is None or delta.created <= row.totals_modified:
+            # The full update might have counted the changes already,
+            # repeat it instead of counting them twice.
+            return None
+
+        num_cells = row.num_cells + delta.num_cells
+        num_radius = row.num_radius + delta.num_radius
+        sum_radius = row.sum_radius + delta.sum_radius
+        grouped_regions = defaultdict(int, decode_region_counts(row.region_counts))
+        for region, count in delta.regions.items():
+            grouped_regions[region] += count
+        grouped_regions = dict([(k, v) for k, v in grouped_regions.items() if v])
+
+        if (
+            num_cells <= 0
+            or num_radius < 0
+            or sum_radius < 0
+            or min(grouped_regions.values(), default=0) < 0
+            or sum(grouped_regions.values()) != num_cells
+        ):
+            # The area lost all its cells or the totals have drifted,
+            # let the full update delete or repair it.
+            return None
+
+        totals = CellAreaDelta(
+            delta.area,
+            max_lat=row.max_lat,
+            min_lat=row.min_lat,
+            max_lon=row.max_lon,
+            min_lon=row.min_lon,
+            last_seen=row.last_seen,
+        )
+        totals.extend(
+            max_lat=delta.max_lat,
+            min_lat=delta.min_lat,
+            max_lon=delta.max_lon,
+            min_lon=delta.min_lon,
+            last_seen=delta.last_seen,
+        )
+
+        def nan_if_none(value):
+            return numpy.nan if value is None else value
+
+        sum_lat = row.sum_lat + delta.sum_lat
+        sum_lon = row.sum_lon + delta.sum_lon
+        ctr_lat = sum_lat / num_cells
+        ctr_lon = sum_lon / num_cells
+        radius = circle_radius(
+            ctr_lat,
+            ctr_lon,
+            nan_if_none(totals.max_lat),
+            nan_if_none(totals.max_lon),
+            nan_if_none(totals.min_lat),
+            nan_if_none(totals.min_lon),
+        )
+
+        avg_cell_radius = None
+        if num_radius:
+            avg_cell_radius = int(round(sum_radius / num_radius))
+
+        return {
+            "areaid": encode_cellarea(*delta.area),
+            "modified": self.utcnow,
+            "lat": ctr_lat,
+            "lon": ctr_lon,
+            "radius": radius,
+            "region": self.majority_region(
+                ctr_lat, ctr_lon, delta.area[1], grouped_regions
+            ),
+            "avg_cell_radius": avg_cell_radius,
+            "num_cells": num_cells,
+            "last_seen": totals.last_seen,
+            "sum_lat": sum_lat,
+            "sum_lon": sum_lon,
+            "sum_radius": sum_radius,
+            "num_radius": num_radius,
+            "max_lat": totals.max_lat,
+            "min_lat": totals.min_lat,
+            "max_lon": totals.max_lon,
+            "min_lon": totals.min_lon,
+            "region_counts": encode_region_counts(grouped_regions),
+        }
+
+
+class CellAreaDriftCorrector(object):
+    """
+    Queue a full update of all cell areas changed by incremental updates
+    since the last run, correcting any drift of their running totals.
+    """
+
+    queue_name = "update_cellarea"
+
+    def __init__(self, task):
+        self.task = task
+        self.queue = self.task.app.data_queues[self.queue_name]
+
+    def __call__(self):
+        with self.task.redis_pipeline(execute=False) as pipe:
+            # Read and clear the set in one transaction, so no area
+            # changed in between is lost.
+            pipe.smembers(DELTA_AREAS_KEY)
+            pipe.delete(DELTA_AREAS_KEY)
+            areaids, _ = pipe.execute()
+
+        if areaids:
+            self.queue.enqueue(sorted(areaids))
@@ -82,12 +82,13 @@ class DataMapUpdater(object):
 
     def __call__(self):
         queue = self.task.app.data_queues["update_datamap_" + self.shard_id]
-        grids = queue.dequeue()
-        grids = list(set(grids))
-        if not grids or not self.shard:
-            return 0
+        with queue.processing():
+            grids = queue.dequeue()
+            grids = list(set(grids))
+            if not grids or not self.shard:
+                return 0
 
-        self._update_shards(grids)
+            self._update_shards(grids)
 
         if queue.ready():
             self.task.apply_countdown(kwargs={"shard_id": self.shard_id})
@@ -58,24 +58,25 @@ class IncomingQueue(object):
     def __call__(self, export_task):
         redis_client = self.task.redis_client
         data_queue = self.task.app.data_queues["update_incoming"]
-        data = data_queue.dequeue()
-
-        grouped = defaultdict(list)
-        for item in data:
-            grouped[(item["api_key"], item.get("source", "gnss"))].append(
-                {"api_key": item["api_key"], "report": item["report"]}
-            )
-
-        with self.task.db_session(commit=False) as session:
-            export_configs = ExportConfig.all(session)
-
-        with self.task.redis_pipeline() as pipe:
-            for (api_key, source), items in grouped.items():
-                for config in export_configs:
-                    if config.allowed(api_key, source):
-                        queue_key = config.queue_key(api_key, source)
-                        queue = config.queue(queue_key, redis_client)
-                        queue.enqueue(items, pipe=pipe)
+        with data_queue.processing():
+            data = data_queue.dequeue()
+
+            grouped = defaultdict(list)
+            for item in data:
+                grouped[(item["api_key"], item.get("source", "gnss"))].append(
+                    {"api_key": item["api_key"], "report": item["report"]}
+                )
+
+            with self.task.db_session(commit=False) as session:
+                export_configs = ExportConfig.all(session)
+
+            with self.task.redis_pipeline() as pipe:
+                for (api_key, source), items in grouped.items():
+                    for config in export_configs:
+                        if config.allowed(api_key, source):
+                            queue_key = config.queue_key(api_key, source)
+                            queue = config.queue(queue_key, redis_client)
+                            queue.enqueue(items, pipe=pipe)
 
         for config in export_configs:
             # Check all queues if they now contain enough data or
@@ -348,48 +349,57 @@ class InternalTransform(object):
 
 
 class InternalExporter(ReportExporter):
+    """
+    Validates the reports and routes their observations to the station
+    update queues.
+
+    The reports are processed in chunks of `chunk_size` reports. The
+    observations of a chunk are written to Redis before the next chunk
+    is processed, so the memory used for intermediate data doesn't grow
+    with the batch size. If sending fails, a retry continues with the
+    first chunk which wasn't written yet.
+    """
 
     _retriable = (IOError, redis.exceptions.RedisError, sqlalchemy.exc.InternalError)
     transform = InternalTransform()
+    chunk_size = 500
 
-    def send(self, queue_items):
-        api_keys = set()
-        api_keys_known = set()
-        metrics = {}
-
-        items = []
-        for item in queue_items:
-            # preprocess items and extract set of API keys
-            item["report"] = self.transform(item["report"])
-            if item["report"]:
-                items.append(item)
-                api_keys.add(item["api_key"])
-
-        for api_key in api_keys:
-            metrics[api_key] = {}
-            for type_ in ("report", "blue", "cell", "wifi"):
-                for action in ("drop", "upload"):
-                    metrics[api_key]["%s_%s" % (type_, action)] = 0
-
-        with self.task.db_session(commit=False) as session:
-            # limit database session to get API keys
-            keys = [key for key in api_keys if key]
-            if keys:
-                columns = ApiKey.__table__.c
-                rows = session.execute(
-                    select([columns.valid_key]).where(columns.valid_key.in_(keys))
-                ).fetchall()
-
-                for row in rows:
-                    api_keys_known.add(row.valid_key)
+    def __init__(self, task, config, queue_key):
+        super(InternalExporter, self).__init__(task, config, queue_key)
+        self._sent = 0
+        self._metrics = defaultdict(lambda: defaultdict(int))
+        self._grids = set()
 
+    def send(self, queue_items):
+        for start in range(self._sent, len(queue_items), self.chunk_size):
+            chunk = queue_items[start : start + self.chunk_size]
+            metrics = defaultdict(lambda: defaultdict(int))
+            with self.task.redis_pipeline() as pipe:
+                grids = self.send_chunk(pipe, chunk, metrics)
+
+            # The chunk was written, only count it now.
+            self._sent = start + len(chunk)
+            self._grids.update(grids)
+            for api_key, key_metrics in metrics.items():
+                for name, count in key_metrics.items():
+                    self._metrics[api_key][name] += count
+
+        self.emit_metrics(self.known_api_keys(self._metrics.keys()), self._metrics)
+
+    def send_chunk(self, pipe, queue_items, metrics):
+        """
+        Process the reports of one chunk and add their observations to
+        the pipeline. Return the data map grids added to the pipeline.
+        """
         positions = []
         observations = {"blue": [], "cell": [], "wifi": []}
 
-        for item in items:
-            api_key = item["api_key"]
-            report = item["report"]
+        for item in queue_items:
+            report = self.transform(item["report"])
+            if not report:
+                continue
 
+            api_key = item["api_key"]
             obs, malformed_obs = self.process_report(report)
 
             any_data = False
@@ -406,12 +416,24 @@ class InternalExporter(ReportExporter):
             else:
                 metrics[api_key]["report_drop"] += 1
 
-        with self.task.redis_pipeline() as pipe:
-            self.queue_observations(pipe, observations)
-            if _map_content_enabled and positions:
-                self.process_datamap(pipe, positions)
+        self.queue_observations(pipe, observations)
+        if _map_content_enabled and positions:
+            return self.process_datamap(pipe, positions, skip=self._grids)
+        return set()
 
-        self.emit_metrics(api_keys_known, metrics)
+    def known_api_keys(self, api_keys):
+        """Return the subset of the API keys which exist in the database."""
+        keys = [key for key in api_keys if key]
+        if not keys:
+            return set()
+
+        # limit database session to get API keys
+        with self.task.db_session(commit=False) as session:
+            columns = ApiKey.__table__.c
+            rows = session.execute(
+                select([columns.valid_key]).where(columns.valid_key.in_(keys))
+            ).fetchall()
+        return set([row.valid_key for row in rows])
 
     def queue_observations(self, pipe, observations):
         for datatype, shard_model, shard_key, queue_prefix in (
@@ -494,11 +516,16 @@ class InternalExporter(ReportExporter):
         }
         return (obs, malformed)
 
-    def process_datamap(self, pipe, positions):
+    def process_datamap(self, pipe, positions, skip=frozenset()):
+        """
+        Queue the data map grids of the positions, except for those in
+        `skip`. Return the queued grids.
+        """
         grids = set()
         for lat, lon in positions:
             if lat is not None and lon is not None:
                 grids.add(DataMap.scale(lat, lon))
+        grids -= skip
 
         shards = defaultdict(set)
         for lat, lon in grids:
@@ -507,3 +534,4 @@ class InternalExporter(ReportExporter):
         for shard_id, values in shards.items():
             queue = self.task.app.data_queues["update_datamap_" + shard_id]
             queue.enqueue(list(values), pipe=pipe)
+        return grids
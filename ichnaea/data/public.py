@@ -1,19 +1,33 @@
 from collections import defaultdict, Counter
+from concurrent.futures import as_completed, ThreadPoolExecutor
 from csv import reader
 from datetime import datetime, timedelta
+import gzip
+from itertools import islice
+import json
 import logging
 import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
 
 import boto3
 import colander
 from more_itertools import peekable
+import numpy
 from zoneinfo import ZoneInfo
+from sqlalchemy import func, literal_column, select
+from sqlalchemy.dialects.mysql import insert
 from sqlalchemy.sql import text
 from sqlalchemy.orm import load_only
 
 from ichnaea.cache import redis_pipeline
 from ichnaea.conf import settings
-from ichnaea.models import area_id, CellShard
+from ichnaea.geocode import GEOCODER
+from ichnaea.models import area_id, CellShard, encode_cellarea, encode_cellid, Radio
+from ichnaea.models import constants
 from ichnaea.models.constants import CELL_MAX_RADIUS
 from ichnaea import util
 
@@ -39,23 +53,9 @@ _FIELD_NAMES = [
 ]
 
 
-def write_stations_to_csv(session, path, today, start_time=None, end_time=None):
-    linesep = "\r\n"
+_LINESEP = "\r\n"
 
-    where = "lat IS NOT NULL AND lon IS NOT NULL"
-    if start_time is not None and end_time is not None:
-        where = where + ' AND modified >= "%s" AND modified < "%s"'
-        fmt = "%Y-%m-%d %H:%M:%S"
-        where = where % (start_time.strftime(fmt), end_time.strftime(fmt))
-    else:
-        # limit to cells modified in the last 12 months
-        one_year = today - timedelta(days=365)
-        where = where + ' AND modified >= "%s"' % one_year.strftime("%Y-%m-%d")
-
-    header_row = ",".join(_FIELD_NAMES) + linesep
-
-    tables = [shard.__tablename__ for shard in CellShard.shards().values()]
-    stmt = """SELECT
+_EXPORT_STMT = """SELECT
     `cellid`,
     CONCAT_WS(",",
         CASE radio
@@ -84,23 +84,398 @@ ORDER BY `cellid`
 LIMIT :limit
 """
 
-    with util.gzip_open(path, "w", compresslevel=5) as gzip_wrapper:
+
+def _export_where(today, start_time=None, end_time=None):
+    where = "lat IS NOT NULL AND lon IS NOT NULL"
+    if start_time is not None and end_time is not None:
+        where = where + ' AND modified >= "%s" AND modified < "%s"'
+        fmt = "%Y-%m-%d %H:%M:%S"
+        where = where % (start_time.strftime(fmt), end_time.strftime(fmt))
+    else:
+        # limit to cells modified in the last 12 months
+        one_year = today - timedelta(days=365)
+        where = where + ' AND modified >= "%s"' % one_year.strftime("%Y-%m-%d")
+    return where
+
+
+def _export_tables():
+    return [shard.__tablename__ for shard in CellShard.shards().values()]
+
+
+def _write_table_rows(
+    session, gzip_file, table, where, min_cellid="", max_cellid=None, limit=25000
+):
+    """
+    Write the rows of one cell shard table with a cellid greater than
+    `min_cellid` and, unless it is None, at most `max_cellid`. Return
+    the number of written rows.
+    """
+    params = {}
+    if max_cellid is not None:
+        where = where + " AND `cellid` <= :max_cellid"
+        params["max_cellid"] = max_cellid
+
+    table_stmt = text(_EXPORT_STMT % (table, where))
+    num_rows = 0
+    while True:
+        rows = session.execute(
+            table_stmt.bindparams(limit=limit, cellid=min_cellid, **params)
+        ).fetchall()
+        if rows:
+            buf = "".join(row.cell_value + _LINESEP for row in rows)
+            gzip_file.write(buf)
+            min_cellid = rows[-1].cellid
+            num_rows += len(rows)
+        else:
+            break
+    return num_rows
+
+
+def write_stations_to_csv(session, path, today, start_time=None, end_time=None):
+    """
+    Write the cell export to `path` and return the number of rows.
+
+    Instead of a file name, `path` can be a binary file object, like a
+    :class:`MultipartUpload`.
+    """
+    if isinstance(path, str):
+        with open(path, "wb") as fd:
+            return write_stations_to_csv(
+                session, fd, today, start_time=start_time, end_time=end_time
+            )
+
+    where = _export_where(today, start_time=start_time, end_time=end_time)
+    header_row = ",".join(_FIELD_NAMES) + _LINESEP
+
+    num_rows = 0
+    with gzip.open(path, "wt", compresslevel=5, encoding="utf-8") as gzip_file:
+        gzip_file.write(header_row)
+        for table in _export_tables():
+            num_rows += _write_table_rows(session, gzip_file, table, where)
+    return num_rows
+
+
+class MultipartUpload(object):
+    """
+    A binary file object, uploading all data written to it as one S3
+    object, with a multipart upload.
+
+    The data is split into parts of `part_size` bytes, which are
+    uploaded by `concurrency` threads while more data is written. Once
+    `max_pending` parts wait for their upload, writes block until one
+    of them is done, which bounds the memory used for the parts.
+
+    Used as a context manager, the upload is completed at the end of
+    the block, or aborted if the block raises an exception.
+    """
+
+    # S3 requires all parts but the last to be at least 5 MiB large.
+    min_part_size = 5 * 1024 * 1024
+
+    def __init__(
+        self,
+        client,
+        bucket,
+        key,
+        part_size=16 * 1024 * 1024,
+        concurrency=4,
+        max_pending=8,
+    ):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, self.min_part_size)
+        self._buffer = bytearray()
+        self._futures = []
+        self._error = None
+        self._pending = threading.BoundedSemaphore(max(max_pending, 1))
+        self._executor = ThreadPoolExecutor(max_workers=max(concurrency, 1))
+        self.upload_id = client.create_multipart_upload(Bucket=bucket, Key=key)[
+            "UploadId"
+        ]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.complete()
+        else:
+            self.abort()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self._error is not None:
+            raise self._error
+        self._buffer += data
+        while len(self._buffer) >= self.part_size:
+            self._submit(bytes(self._buffer[: self.part_size]))
+            del self._buffer[: self.part_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _submit(self, body):
+        self._pending.acquire()
+        part_number = len(self._futures) + 1
+        self._futures.append(
+            self._executor.submit(self._upload_part, part_number, body)
+        )
+
+    def _upload_part(self, part_number, body):
+        try:
+            response = self.client.upload_part(
+                Bucket=self.bucket,
+                Key=self.key,
+                PartNumber=part_number,
+                UploadId=self.upload_id,
+                Body=body,
+            )
+            return {"ETag": response["ETag"], "PartNumber": part_number}
+        except Exception as exc:
+            self._error = exc
+            raise
+        finally:
+            self._pending.release()
+
+    def complete(self):
+        """Upload the remaining data and complete the upload."""
+        if self._buffer or not self._futures:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        try:
+            parts = [future.result() for future in self._futures]
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+        except Exception:
+            self.abort()
+            raise
+        self._executor.shutdown()
+
+    def abort(self):
+        """Abort the upload, dropping all uploaded parts."""
+        self._executor.shutdown(cancel_futures=True)
+        self.client.abort_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+        )
+
+
+def cellid_ranges(session, table, rows_per_range):
+    """
+    Split a cell shard table into ranges of about `rows_per_range` rows.
+
+    Return a list of (min_cellid, max_cellid) tuples, each range
+    covering the cellids greater than its minimum and at most its
+    maximum. The maximum of the last range is None.
+    """
+    stmt = text(
+        "SELECT `cellid` FROM %s WHERE `cellid` > :cellid "
+        "ORDER BY `cellid` LIMIT 1 OFFSET :offset" % table
+    )
+    ranges = []
+    min_cellid = b""
+    while True:
+        row = session.execute(
+            stmt.bindparams(cellid=min_cellid, offset=max(rows_per_range - 1, 0))
+        ).first()
+        if row is None:
+            break
+        ranges.append((min_cellid, row.cellid))
+        min_cellid = row.cellid
+    ranges.append((min_cellid, None))
+    return ranges
+
+
+def write_range_to_csv(session, path, table, where, min_cellid, max_cellid):
+    """
+    Write the rows of a cellid range of one cell shard table to a new
+    gzip file, without a header row. Return the number of rows.
+
+    The file is written under a temporary name and only renamed to
+    `path` once it is complete.
+    """
+    temp_path = path + ".tmp"
+    with util.gzip_open(temp_path, "w", compresslevel=5) as gzip_wrapper:
         with gzip_wrapper as gzip_file:
-            gzip_file.write(header_row)
-            for table in tables:
-                table_stmt = text(stmt % (table, where))
-                min_cellid = ""
-                limit = 25000
-                while True:
-                    rows = session.execute(
-                        table_stmt.bindparams(limit=limit, cellid=min_cellid)
-                    ).fetchall()
-                    if rows:
-                        buf = "".join(row.cell_value + linesep for row in rows)
-                        gzip_file.write(buf)
-                        min_cellid = rows[-1].cellid
-                    else:
-                        break
+            num_rows = _write_table_rows(
+                session,
+                gzip_file,
+                table,
+                where,
+                min_cellid=min_cellid,
+                max_cellid=max_cellid,
+            )
+    os.replace(temp_path, path)
+    return num_rows
+
+
+class ExportCheckpoint(object):
+    """
+    The progress of a parallel cell export, kept in a JSON file.
+
+    It holds the cellid ranges of the export and the number of rows
+    written for each finished range. A checkpoint is only used again
+    for the same export, identified by `key`.
+    """
+
+    def __init__(self, path, key, ranges=None, done=None):
+        self.path = path
+        self.key = key
+        self.ranges = ranges
+        self.done = done if done is not None else {}
+
+    @classmethod
+    def load(cls, path, key):
+        """Load the checkpoint at `path`, or start a new one."""
+        try:
+            with open(path, "r") as fd:
+                data = json.load(fd)
+        except (OSError, ValueError):
+            return cls(path, key)
+
+        if data.get("key") != key:
+            return cls(path, key)
+
+        ranges = [
+            (
+                table,
+                bytes.fromhex(min_cellid),
+                bytes.fromhex(max_cellid) if max_cellid is not None else None,
+            )
+            for table, min_cellid, max_cellid in data["ranges"]
+        ]
+        done = dict([(int(index), rows) for index, rows in data["done"].items()])
+        return cls(path, key, ranges=ranges, done=done)
+
+    def save(self):
+        data = {
+            "key": self.key,
+            "ranges": [
+                (
+                    table,
+                    min_cellid.hex(),
+                    max_cellid.hex() if max_cellid is not None else None,
+                )
+                for table, min_cellid, max_cellid in self.ranges
+            ],
+            "done": self.done,
+        }
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as fd:
+            json.dump(data, fd)
+        os.replace(temp_path, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _export_range(job, db_uri=None):
+    index, path, table, where, min_cellid, max_cellid = job
+    env = dict(os.environ)
+    if db_uri is not None:
+        env["DB_READONLY_URI"] = db_uri
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "ichnaea.scripts.export_range",
+            path,
+            table,
+            where,
+            min_cellid.hex(),
+            max_cellid.hex() if max_cellid is not None else "",
+        ],
+        env=env,
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    return (index, int(result.stdout))
+
+
+def write_stations_to_csv_parallel(
+    session,
+    path,
+    today,
+    start_time=None,
+    end_time=None,
+    processes=1,
+    db_uri=None,
+    rows_per_range=250000,
+):
+    """
+    Write the same cell export as :func:`write_stations_to_csv`, and
+    return the number of rows.
+
+    The cell shard tables are split into cellid ranges, which are
+    written to separate gzip files by up to `processes` processes at a
+    time, each connected to the database at `db_uri`. The processes run
+    the ``ichnaea.scripts.export_range`` script, as a Celery worker
+    process can't start a multiprocessing pool. The files are then
+    concatenated as members of the gzip export file. Unlike the
+    sequential export, the ranges aren't read in a single transaction.
+
+    The progress is kept in a checkpoint file next to `path`. If the
+    export is interrupted, writing it again to the same path only writes
+    the unfinished ranges.
+    """
+    where = _export_where(today, start_time=start_time, end_time=end_time)
+    checkpoint = ExportCheckpoint.load(
+        path + ".checkpoint", key="%s %s" % (os.path.basename(path), where)
+    )
+    if checkpoint.ranges is None:
+        checkpoint.ranges = [
+            (table, min_cellid, max_cellid)
+            for table in _export_tables()
+            for min_cellid, max_cellid in cellid_ranges(session, table, rows_per_range)
+        ]
+        checkpoint.save()
+
+    part_paths = ["%s.%d" % (path, index) for index in range(len(checkpoint.ranges))]
+    jobs = [
+        (index, part_paths[index], table, where, min_cellid, max_cellid)
+        for index, (table, min_cellid, max_cellid) in enumerate(checkpoint.ranges)
+        if not (index in checkpoint.done and os.path.exists(part_paths[index]))
+    ]
+    if jobs:
+        LOGGER.info(
+            "Exporting %d of %d cell ranges.", len(jobs), len(checkpoint.ranges)
+        )
+
+    if processes > 1 and len(jobs) > 1:
+        with ThreadPoolExecutor(min(processes, len(jobs))) as executor:
+            futures = [executor.submit(_export_range, job, db_uri) for job in jobs]
+            for future in as_completed(futures):
+                index, num_rows = future.result()
+                checkpoint.done[index] = num_rows
+                checkpoint.save()
+    else:
+        for job in jobs:
+            checkpoint.done[job[0]] = write_range_to_csv(session, *job[1:])
+            checkpoint.save()
+
+    # A gzip file may consist of multiple members, which are decompressed
+    # as one stream, so the range files are simply appended.
+    header_row = ",".join(_FIELD_NAMES) + _LINESEP
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as fd:
+        fd.write(util.encode_gzip(header_row.encode("utf-8"), compresslevel=5))
+        for part_path in part_paths:
+            with open(part_path, "rb") as part_fd:
+                shutil.copyfileobj(part_fd, fd)
+    os.replace(temp_path, path)
+
+    for part_path in part_paths:
+        os.remove(part_path)
+    checkpoint.remove()
+    return sum(checkpoint.done.values())
 
 
 class InvalidCSV(ValueError):
@@ -261,6 +636,328 @@ def read_stations_from_csv(session, file_handle, redis_client, cellarea_queue):
         )
 
 
+# UMTS was the original name for WCDMA stations
+_IMPORT_RADIO_TYPES = {"UMTS": Radio.wcdma, "GSM": Radio.gsm, "LTE": Radio.lte}
+
+_IMPORT_MCCS = numpy.array(sorted(constants.ALL_VALID_MCCS), dtype=numpy.int64)
+
+# The fields of existing stations replaced by a newer imported station
+_IMPORT_UPDATE_FIELDS = ("psc", "lon", "lat", "radius", "samples", "created")
+
+
+def _parse_column(rows, index, dtype, default=None):
+    """
+    Convert one column of the CSV rows to an array. Return the array and
+    a boolean array marking the values which could be converted.
+    """
+    texts = [row[index] if len(row) > index else "" for row in rows]
+    if default is not None:
+        texts = [value or default for value in texts]
+    try:
+        # Let numpy convert all values at once, which fails for the
+        # entire column if any single value is invalid.
+        return (numpy.array(texts).astype(dtype), numpy.ones(len(texts), dtype=bool))
+    except (OverflowError, ValueError):
+        pass
+
+    convert = int if numpy.issubdtype(dtype, numpy.integer) else float
+    values = numpy.zeros(len(texts), dtype=dtype)
+    valid = numpy.ones(len(texts), dtype=bool)
+    for i, value in enumerate(texts):
+        try:
+            values[i] = convert(value)
+        except (OverflowError, ValueError):
+            valid[i] = False
+    return (values, valid)
+
+
+def _parse_stations(rows):
+    """
+    Parse and validate a chunk of CSV rows, with the same rules as
+    :func:`read_stations_from_csv` applies to single rows.
+
+    Return a tuple of the parsed columns and an array of row states,
+    1 for valid rows, 0 for invalid rows and -1 for rows with an unknown
+    radio type.
+    """
+    radios = numpy.full(len(rows), -1, dtype=numpy.int64)
+    for i, row in enumerate(rows):
+        name = row[0] if row else ""
+        if name in _IMPORT_RADIO_TYPES:
+            radios[i] = _IMPORT_RADIO_TYPES[name]
+        elif name:
+            raise InvalidCSV("Unknown radio type in row: %s" % row)
+
+    columns = {"radio": radios}
+    valid = radios >= 0
+    for name, index, dtype, default in (
+        ("mcc", 1, numpy.int64, None),
+        ("mnc", 2, numpy.int64, None),
+        ("lac", 3, numpy.int64, None),
+        ("cid", 4, numpy.int64, None),
+        ("psc", 5, numpy.int64, "0"),
+        ("lon", 6, numpy.double, None),
+        ("lat", 7, numpy.double, None),
+        ("radius", 8, numpy.int64, None),
+        ("samples", 9, numpy.int64, None),
+        # row[10] is "changable", always 1 and not imported
+        ("created", 11, numpy.int64, None),
+        ("modified", 12, numpy.int64, None),
+    ):
+        columns[name], parsed = _parse_column(rows, index, dtype, default=default)
+        valid &= parsed
+
+    # GSM cell ids beyond the GSM range are WCDMA cells
+    radios[(radios == Radio.gsm) & (columns["cid"] > constants.MAX_CID_GSM)] = int(
+        Radio.wcdma
+    )
+
+    valid &= numpy.isin(columns["mcc"], _IMPORT_MCCS)
+    valid &= (columns["mnc"] >= constants.MIN_MNC) & (
+        columns["mnc"] <= constants.MAX_MNC
+    )
+    valid &= (columns["lac"] >= constants.MIN_LAC) & (
+        columns["lac"] <= constants.MAX_LAC
+    )
+    valid &= (columns["cid"] >= constants.MIN_CID) & (
+        columns["cid"] <= constants.MAX_CID
+    )
+    valid &= (columns["lat"] >= constants.MIN_LAT) & (
+        columns["lat"] <= constants.MAX_LAT
+    )
+    valid &= (columns["lon"] >= constants.MIN_LON) & (
+        columns["lon"] <= constants.MAX_LON
+    )
+    valid &= (columns["radius"] >= 0) & (columns["samples"] >= 0)
+    # Some exported radiuses exceed the max and fail validation
+    columns["radius"] = numpy.minimum(columns["radius"], CELL_MAX_RADIUS)
+
+    # Invalid primary scrambling codes or physical cell ids are dropped
+    psc = columns["psc"]
+    columns["psc_valid"] = (
+        (psc >= constants.MIN_PSC)
+        & (psc <= constants.MAX_PSC)
+        & ((radios != Radio.lte) | (psc <= constants.MAX_PSC_LTE))
+    )
+
+    states = valid.astype(numpy.int64)
+    states[radios < 0] = -1
+    return (columns, states)
+
+
+def _timestamps(values, valid):
+    """Convert an array of unix timestamps to datetimes."""
+    result = []
+    for i, value in enumerate(values.tolist()):
+        try:
+            result.append(datetime.fromtimestamp(value, UTC))
+        except (OSError, OverflowError, ValueError):
+            result.append(None)
+            valid[i] = False
+    return result
+
+
+def _import_stations(session, shard, stations, counts, areas):
+    """
+    Write the parsed stations of one shard to the database.
+
+    Stations which aren't in the database yet are inserted, existing
+    stations are only replaced by stations with a newer modified time.
+    Station rows are compared to the database before writing, to only
+    send the changed rows and to count the operations. The upsert
+    statement repeats the modified time check, in case a station
+    changed in the meantime.
+    """
+    table = shard.__table__
+    existing = {}
+    cellids = list(stations.keys())
+    for i in range(0, len(cellids), 10000):
+        rows = session.execute(
+            select([table.c.cellid, table.c.modified]).where(
+                table.c.cellid.in_(cellids[i : i + 10000])
+            )
+        )
+        existing.update([(row.cellid, row.modified) for row in rows])
+
+    values = []
+    for cellid, station in stations.items():
+        modified = existing.get(cellid)
+        if modified is None:
+            operation = "new"
+        elif modified < station["modified"]:
+            operation = "updated"
+        else:
+            operation = "found"
+        counts[station["radio"].name][operation] += 1
+        if operation != "found":
+            values.append(station)
+            areas.add(
+                encode_cellarea(
+                    station["radio"], station["mcc"], station["mnc"], station["lac"]
+                )
+            )
+
+    for i in range(0, len(values), 5000):
+        stmt = insert(table).values(values[i : i + 5000])
+        # SQLAlchemy renders any inserted column inside an update value as
+        # the VALUES() of the updated column, so name the column directly.
+        newer = table.c.modified < literal_column("VALUES(`modified`)")
+        # MySQL assigns the columns in order, so the modified time has to
+        # be the last one, for the check to see the old value.
+        update = [
+            (name, func.IF(newer, stmt.inserted[name], table.c[name]))
+            for name in _IMPORT_UPDATE_FIELDS
+        ]
+        update.append(
+            ("modified", func.IF(newer, stmt.inserted.modified, table.c.modified))
+        )
+        session.execute(stmt.on_duplicate_key_update(update))
+
+
+def read_stations_from_csv_bulk(
+    session, file_handle, redis_client, cellarea_queue, chunk_size=50000, progress=None
+):
+    """
+    Read stations from a public cell export CSV, with the same result as
+    :func:`read_stations_from_csv`, but in chunks of rows.
+
+    Each chunk is validated at once, and written with one upsert
+    statement per cell shard. The cell areas of all new and updated
+    stations are queued for an update after all stations are written.
+
+    :arg session: a database session
+    :arg file_handle: an open file handle for the CSV data
+    :arg redis_client: a Redis client
+    :arg cellarea_queue: the DataQueue for updating cellarea IDs
+    :arg chunk_size: the number of rows read and written at once
+    :arg progress: an optional callable, called with the number of
+        processed rows after each chunk
+    :return: the number of processed stations
+    """
+    # Avoid circular imports
+    from ichnaea.data.tasks import update_cellarea, update_statregion
+
+    csv_content = peekable(reader(file_handle))
+
+    counts = defaultdict(Counter)
+    areas = set()
+    total = 0
+    rows_read = 0
+
+    if not csv_content:
+        LOGGER.warning("Nothing to process.")
+        return 0
+
+    first_row = csv_content.peek()
+    if first_row == _FIELD_NAMES:
+        # Skip the first row because it's a header row
+        next(csv_content)
+    else:
+        LOGGER.warning("Expected header row, got data: %s", first_row)
+
+    while True:
+        rows = list(islice(csv_content, max(chunk_size, 1)))
+        if not rows:
+            break
+        rows_read += len(rows)
+
+        columns, states = _parse_stations(rows)
+        valid = states == 1
+        created = _timestamps(columns["created"], valid)
+        modified = _timestamps(columns["modified"], valid)
+
+        if total == 0:
+            # Like the row by row import, check the rows with a known radio
+            # up to the first valid one, which includes invalid timestamps.
+            known = numpy.flatnonzero(states >= 0)
+            invalid = known[~valid[known]]
+            if valid.any():
+                invalid = invalid[invalid < numpy.flatnonzero(valid)[0]]
+            if len(invalid):
+                # If the first row is invalid, it's likely the rest of the
+                # file is, too--drop out here.
+                raise InvalidCSV("first row %s is invalid" % rows[int(invalid[0])])
+
+        for i in numpy.flatnonzero(states < 0).tolist():
+            LOGGER.warning("Skipping unknown radio: %s", rows[i])
+        for i in numpy.flatnonzero((states >= 0) & ~valid).tolist():
+            LOGGER.warning("row %s is invalid", rows[i])
+
+        indices = numpy.flatnonzero(valid)
+        regions = GEOCODER.regions_for_cells(
+            columns["lat"][indices], columns["lon"][indices], columns["mcc"][indices]
+        )
+
+        shard_stations = defaultdict(dict)
+        for i, region in zip(indices.tolist(), regions):
+            radio = Radio(int(columns["radio"][i]))
+            mcc, mnc, lac, cid = [
+                int(columns[name][i]) for name in ("mcc", "mnc", "lac", "cid")
+            ]
+            lat = float(columns["lat"][i])
+            lon = float(columns["lon"][i])
+            cellid = encode_cellid(radio, mcc, mnc, lac, cid)
+            stations = shard_stations[CellShard.shard_model(radio)]
+            if cellid in stations and stations[cellid]["modified"] >= modified[i]:
+                # Only keep the newest row of a station repeated in a chunk
+                continue
+            stations[cellid] = {
+                "cellid": cellid,
+                "radio": radio,
+                "mcc": mcc,
+                "mnc": mnc,
+                "lac": lac,
+                "cid": cid,
+                "psc": int(columns["psc"][i]) if columns["psc_valid"][i] else None,
+                "lat": lat,
+                "lon": lon,
+                "max_lat": lat,
+                "min_lat": lat,
+                "max_lon": lon,
+                "min_lon": lon,
+                "radius": int(columns["radius"][i]),
+                "region": region,
+                "samples": int(columns["samples"][i]),
+                "created": created[i],
+                "modified": modified[i],
+            }
+
+        for shard, stations in shard_stations.items():
+            _import_stations(session, shard, stations, counts, areas)
+        session.commit()
+
+        total += len(indices)
+        if progress is not None:
+            progress(rows_read)
+
+    # Update the cell areas, in batches to keep each task short
+    areas = sorted(areas)
+    for i in range(0, len(areas), 1000):
+        with redis_pipeline(redis_client) as pipe:
+            cellarea_queue.enqueue(areas[i : i + 1000], pipe=pipe)
+        update_cellarea.delay()
+
+    # Now that we've updated all the cell areas, we need to update the
+    # statregion
+    update_statregion.delay()
+
+    # Summarize results
+    LOGGER.info("Complete, processed %d station%s:", total, "" if total == 1 else "s")
+    for radio_type, op_counts in sorted(counts.items()):
+        LOGGER.info(
+            "  %s: %d new, %d updated, %d already loaded",
+            radio_type,
+            op_counts["new"],
+            op_counts["updated"],
+            op_counts["found"],
+        )
+    if areas:
+        LOGGER.info(
+            "  %d station area%s updated", len(areas), "" if len(areas) == 1 else "s"
+        )
+    return total
+
+
 class CellExport(object):
     def __init__(self, task):
         self.task = task
@@ -291,13 +988,58 @@ class CellExport(object):
         filename = "MLS-%s-cell-export-" % file_type
         filename = filename + file_time.strftime("%Y-%m-%dT%H0000.csv.gz")
 
-        with util.selfdestruct_tempdir() as temp_dir:
-            path = os.path.join(temp_dir, filename)
-            with self.task.db_session(commit=False) as session:
-                write_stations_to_csv(
-                    session, path, today, start_time=start_time, end_time=end_time
+        processes = settings("cell_export_processes")
+        work_dir = settings("cell_export_work_dir")
+        if processes <= 1 and settings("cell_export_streaming"):
+            with MultipartUpload(
+                boto3.client("s3"), bucket, "export/" + filename
+            ) as fd:
+                self.write_stations(fd, filename, today, start_time, end_time)
+        elif hourly or processes <= 1 or not work_dir:
+            with util.selfdestruct_tempdir() as temp_dir:
+                path = os.path.join(temp_dir, filename)
+                self.write_stations(
+                    path, filename, today, start_time, end_time, processes=processes
                 )
+                self.write_stations_to_s3(path, bucket)
+        else:
+            # Keep the partial files of a parallel export, so it can be
+            # resumed by the next run of the task, but drop those of
+            # earlier exports.
+            os.makedirs(work_dir, exist_ok=True)
+            for name in os.listdir(work_dir):
+                if not name.startswith(filename):
+                    os.remove(os.path.join(work_dir, name))
+            path = os.path.join(work_dir, filename)
+            self.write_stations(
+                path, filename, today, start_time, end_time, processes=processes
+            )
             self.write_stations_to_s3(path, bucket)
+            os.remove(path)
+
+    def write_stations(self, path, filename, today, start_time, end_time, processes=1):
+        start = time.monotonic()
+        with self.task.db_session(commit=False) as session:
+            if start_time is None and processes > 1:
+                num_rows = write_stations_to_csv_parallel(
+                    session,
+                    path,
+                    today,
+                    processes=processes,
+                    db_uri=self.task.app.db.uri,
+                )
+            else:
+                num_rows = write_stations_to_csv(
+                    session, path, today, start_time=start_time, end_time=end_time
+                )
+        duration = time.monotonic() - start
+        LOGGER.info(
+            "Exported %d cells to %s in %.1f seconds (%d rows/sec).",
+            num_rows,
+            filename,
+            duration,
+            num_rows / max(duration, 0.001),
+        )
 
     def write_stations_to_s3(self, path, bucketname):
         s3 = boto3.resource("s3")
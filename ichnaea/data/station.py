@@ -4,12 +4,16 @@ from datetime import timedelta
 import markus
 import numpy
 
-from geocalc import circle_radius, distance
+from geocalc import circle_radii, circle_radius, distance, distances
+from ichnaea.cache import station_cache_key
+from ichnaea.conf import settings
+from ichnaea.data.area import AreaCell, CellAreaDelta
 from ichnaea.db import retry_on_mysql_lock_fail
 from ichnaea.geocode import GEOCODER
 from ichnaea.models import (
     decode_cellid,
     encode_cellarea,
+    encode_mac,
     BlueObservation,
     CellObservation,
     WifiObservation,
@@ -24,6 +28,8 @@ from ichnaea import util
 
 METRICS = markus.get_metrics()
 
+_MISSING = object()
+
 
 class StationState(object):
 
@@ -31,7 +37,51 @@ class StationState(object):
     MAX_OLD_WEIGHT = 10000.0
     MAX_OLD_DAYS = 365
 
-    def __init__(self, station_key, station, source, observations, now, today):
+    # Maps (station_state, obs_state) to the name of the transition method.
+    TRANSITIONS = {
+        ("none", "gnss_consistent"): "new",
+        ("none", "query_consistent"): "new",
+        ("none", "gnss_inconsistent"): "new_block",
+        ("none", "query_inconsistent"): "new_block",
+        ("no_position", "gnss_consistent"): "change",
+        ("no_position", "query_consistent"): "change",
+        ("no_position", "gnss_inconsistent"): None,
+        ("no_position", "query_inconsistent"): None,
+        ("agree_gnss_position", "gnss_consistent"): "change",
+        ("agree_gnss_position", "query_consistent"): "confirm",
+        ("agree_gnss_position", "gnss_inconsistent"): "block",
+        ("agree_gnss_position", "query_inconsistent"): "block",
+        ("agree_query_position", "gnss_consistent"): "replace",
+        ("agree_query_position", "query_consistent"): "change",
+        ("agree_query_position", "gnss_inconsistent"): "block",
+        ("agree_query_position", "query_inconsistent"): "block",
+        ("disagree_position", "gnss_consistent"): "block",
+        ("disagree_position", "query_consistent"): "block",
+        ("disagree_position", "gnss_inconsistent"): "block",
+        ("disagree_position", "query_inconsistent"): "block",
+        ("disagree_old_position", "gnss_consistent"): "replace",
+        ("disagree_old_position", "query_consistent"): "replace",
+        ("disagree_old_position", "gnss_inconsistent"): "block",
+        ("disagree_old_position", "query_inconsistent"): "block",
+    }
+
+    def __init__(
+        self,
+        station_key,
+        station,
+        source,
+        observations,
+        now,
+        today,
+        obs_data=_MISSING,
+        confirmed=None,
+    ):
+        """
+        :param obs_data: The result of :meth:`aggregate_obs`, if it has
+            already been calculated.
+        :param confirmed: The result of :meth:`confirm_station_obs`, if
+            it has already been calculated.
+        """
         self.station_key = station_key
         self.station = station
         self.source = source
@@ -39,7 +89,10 @@ class StationState(object):
         self.now = now
         self.today = today
         self.one_year = today - timedelta(days=self.MAX_OLD_DAYS)
-        self.obs_data = self.aggregate_obs()
+        if obs_data is _MISSING:
+            obs_data = self.aggregate_obs()
+        self.obs_data = obs_data
+        self.confirmed = confirmed
 
     def base_key(self):
         raise NotImplementedError()
@@ -92,36 +145,15 @@ class StationState(object):
             else:
                 obs_state = "query_inconsistent"
 
-        transitions = {
-            # (station_state, obs_state)
-            ("none", "gnss_consistent"): self.new,
-            ("none", "query_consistent"): self.new,
-            ("none", "gnss_inconsistent"): self.new_block,
-            ("none", "query_inconsistent"): self.new_block,
-            ("no_position", "gnss_consistent"): self.change,
-            ("no_position", "query_consistent"): self.change,
-            ("no_position", "gnss_inconsistent"): None,
-            ("no_position", "query_inconsistent"): None,
-            ("agree_gnss_position", "gnss_consistent"): self.change,
-            ("agree_gnss_position", "query_consistent"): self.confirm,
-            ("agree_gnss_position", "gnss_inconsistent"): self.block,
-            ("agree_gnss_position", "query_inconsistent"): self.block,
-            ("agree_query_position", "gnss_consistent"): self.replace,
-            ("agree_query_position", "query_consistent"): self.change,
-            ("agree_query_position", "gnss_inconsistent"): self.block,
-            ("agree_query_position", "query_inconsistent"): self.block,
-            ("disagree_position", "gnss_consistent"): self.block,
-            ("disagree_position", "query_consistent"): self.block,
-            ("disagree_position", "gnss_inconsistent"): self.block,
-            ("disagree_position", "query_inconsistent"): self.block,
-            ("disagree_old_position", "gnss_consistent"): self.replace,
-            ("disagree_old_position", "query_consistent"): self.replace,
-            ("disagree_old_position", "gnss_inconsistent"): self.block,
-            ("disagree_old_position", "query_inconsistent"): self.block,
-        }
-        return transitions.get((station_state, obs_state))
+        name = self.TRANSITIONS.get((station_state, obs_state))
+        if name is None:
+            return None
+        return getattr(self, name)
 
     def confirm_station_obs(self):
+        if self.confirmed is not None:
+            return self.confirmed
+
         confirm = False
         if self.has_position():
             # station with position
@@ -244,7 +276,8 @@ class StationState(object):
         )
         return ("new_block", values)
 
-    def bounded_samples_weight(self, samples, weight):
+    @staticmethod
+    def bounded_samples_weight(samples, weight):
         # put in maximum value to avoid overflow of DB column
         return (min(samples, 4294967295), min(weight, 1000000000.0))
 
@@ -399,6 +432,8 @@ class CellState(StationState):
 
 class StationUpdater(object):
 
+    # Aggregate the observations of all stations in grouped array operations.
+    columnar = settings("station_update_columnar")
     obs_model = None
     station_state = None
     station_type = None
@@ -416,9 +451,12 @@ class StationUpdater(object):
     def query_shard(self, session, shard, keys):
         raise NotImplementedError()
 
-    def add_area_update(self, updated_areas, key):
+    def add_area_update(self, updated_areas, key, station=None, values=None):
         pass
 
+    def cache_key(self, shard, key):
+        return station_cache_key(shard.__tablename__, key)
+
     def queue_area_updates(self, pipe, updated_areas):
         pass
 
@@ -452,15 +490,13 @@ class StationUpdater(object):
 
         return (blocklist, stations)
 
-    def update_shard(self, session, shard, shard_values, stats_counter):
-        updated_areas = set()
-        new_data = defaultdict(list)
-        blocklist, stations = self.query_stations(session, shard, shard_values)
-
+    def group_observations(self, shard_values, blocklist, stations):
+        """
+        Yield a tuple of the station key, the station row or None, the
+        report source and the observations of that source for each
+        station which isn't blocklisted.
+        """
         for station_key, observations in shard_values.items():
-            # Count all observations.
-            stats_counter["obs"] += len(observations)
-
             if blocklist.get(station_key, False):
                 # Drop observations for blocklisted stations.
                 continue
@@ -473,16 +509,179 @@ class StationUpdater(object):
                     # treat fused, fixed as gnss
                     grouped_obs[ReportSource.gnss].append(obs)
 
-            station = stations.get(station_key, None)
             source = ReportSource.gnss
             if not grouped_obs[source]:
                 # Only query observations.
                 source = ReportSource.query
 
-            state = self.station_state(
-                station_key, station, source, grouped_obs[source], self.now, self.today
+            yield (station_key, stations.get(station_key), source, grouped_obs[source])
+
+    def station_states(self, shard_values, blocklist, stations):
+        """Yield a station state for each station which isn't blocklisted."""
+        for station_key, station, source, observations in self.group_observations(
+            shard_values, blocklist, stations
+        ):
+            yield self.station_state(
+                station_key, station, source, observations, self.now, self.today
             )
 
+    def columnar_station_states(self, shard_values, blocklist, stations):
+        """
+        Yield the same station states as :meth:`station_states`.
+
+        Instead of aggregating the observations station by station, the
+        observations of all stations are packed into arrays, with the
+        observations of each station in one consecutive group. The
+        bounding boxes, weighted means and distance checks are then
+        calculated for all groups at once.
+        """
+        groups = list(self.group_observations(shard_values, blocklist, stations))
+        if not groups:
+            return
+
+        state_type = self.station_state
+        max_dist = state_type.MAX_DIST_METERS
+        all_obs = [obs for group in groups for obs in group[3]]
+        counts = numpy.array([len(group[3]) for group in groups], dtype=numpy.intp)
+        ends = numpy.cumsum(counts)
+        starts = ends - counts
+
+        positions = numpy.array(
+            [(obs.lat, obs.lon) for obs in all_obs], dtype=numpy.double
+        )
+        weights = numpy.array([obs.weight for obs in all_obs], dtype=numpy.double)
+
+        max_pos = numpy.maximum.reduceat(positions, starts, axis=0)
+        min_pos = numpy.minimum.reduceat(positions, starts, axis=0)
+        box_distances = distances(
+            min_pos[:, 0], min_pos[:, 1], max_pos[:, 0], max_pos[:, 1]
+        )
+        consistent = numpy.flatnonzero(~(box_distances > max_dist))
+
+        # Weighted means, summed up in the same order as numpy.average
+        # does for a single station, so the results are identical.
+        # Sums of one or two values don't depend on the order.
+        weighted = positions * weights[:, None]
+        pos_sums = numpy.add.reduceat(weighted, starts, axis=0)
+        weight_sums = numpy.add.reduceat(weights, starts)
+        for i in numpy.flatnonzero(counts > 2).tolist():
+            pos_sums[i] = weighted[starts[i] : ends[i]].sum(axis=0)
+            weight_sums[i] = weights[starts[i] : ends[i]].sum()
+        means = pos_sums / weight_sums[:, None]
+
+        obs_data = [None] * len(groups)
+        if len(consistent):
+            lats = means[consistent, 0]
+            lons = means[consistent, 1]
+            radii = circle_radii(
+                lats,
+                lons,
+                max_pos[consistent, 0],
+                max_pos[consistent, 1],
+                min_pos[consistent, 0],
+                min_pos[consistent, 1],
+            )
+            regions = GEOCODER.regions(lats, lons)
+            for i, lat, lon, max_lat, max_lon, min_lat, min_lon, radius, region in zip(
+                consistent.tolist(),
+                lats.tolist(),
+                lons.tolist(),
+                max_pos[consistent, 0].tolist(),
+                max_pos[consistent, 1].tolist(),
+                min_pos[consistent, 0].tolist(),
+                min_pos[consistent, 1].tolist(),
+                radii.tolist(),
+                regions,
+            ):
+                start, end = starts[i], ends[i]
+                samples, weight = state_type.bounded_samples_weight(
+                    int(counts[i]), float(weight_sums[i])
+                )
+                obs_data[i] = {
+                    "positions": positions[start:end],
+                    "weights": weights[start:end],
+                    "lat": lat,
+                    "lon": lon,
+                    "max_lat": max_lat,
+                    "min_lat": min_lat,
+                    "max_lon": max_lon,
+                    "min_lon": min_lon,
+                    "radius": radius,
+                    "region": region,
+                    "samples": samples,
+                    "weight": weight,
+                }
+
+        # Check all observations against the position of their station.
+        confirmed = [None] * len(groups)
+        with_position = [
+            i
+            for i, group in enumerate(groups)
+            if group[1] is not None
+            and group[1].lat is not None
+            and group[1].lon is not None
+        ]
+        if with_position:
+            indices = numpy.array(with_position, dtype=numpy.intp)
+            group_counts = counts[indices]
+            obs_indices = numpy.concatenate(
+                [numpy.arange(starts[i], ends[i]) for i in with_position]
+            )
+            station_lats = numpy.array(
+                [groups[i][1].lat for i in with_position], dtype=numpy.double
+            )
+            station_lons = numpy.array(
+                [groups[i][1].lon for i in with_position], dtype=numpy.double
+            )
+            too_far = (
+                distances(
+                    positions[obs_indices, 0],
+                    positions[obs_indices, 1],
+                    numpy.repeat(station_lats, group_counts),
+                    numpy.repeat(station_lons, group_counts),
+                )
+                > max_dist
+            )
+            group_starts = numpy.cumsum(group_counts) - group_counts
+            any_too_far = numpy.logical_or.reduceat(too_far, group_starts)
+            for i, value in zip(with_position, any_too_far.tolist()):
+                confirmed[i] = not value
+
+        for i, (station_key, station, source, observations) in enumerate(groups):
+            yield state_type(
+                station_key,
+                station,
+                source,
+                observations,
+                self.now,
+                self.today,
+                obs_data=obs_data[i],
+                confirmed=confirmed[i],
+            )
+
+    def update_shard(self, session, shard, shard_values, stats_counter):
+        """
+        Update the stations of one shard.
+
+        Return a tuple of the area keys which need to be updated and the
+        shared locate cache keys of all changed stations.
+        """
+        updated_areas = set()
+        updated_stations = set()
+        new_data = defaultdict(list)
+        blocklist, stations = self.query_stations(session, shard, shard_values)
+
+        # Count all observations.
+        for observations in shard_values.values():
+            stats_counter["obs"] += len(observations)
+
+        if self.columnar:
+            states = self.columnar_station_states(shard_values, blocklist, stations)
+        else:
+            states = self.station_states(shard_values, blocklist, stations)
+
+        for state in states:
+            station_key = state.station_key
             transition = state.transition()
             if transition is not None:
                 status, result = transition()
@@ -501,9 +700,10 @@ class StationUpdater(object):
             if status in ("block", "new_block"):
                 stats_counter["block"] += 1
 
-            # track potential updates to dependent areas
+            # track potential updates to dependent areas and cache entries
             if status != "confirm":
-                self.add_area_update(updated_areas, station_key)
+                self.add_area_update(updated_areas, station_key, state.station, result)
+                updated_stations.add(self.cache_key(shard, station_key))
 
         if new_data["new"]:
             session.execute(
@@ -526,7 +726,7 @@ class StationUpdater(object):
         if new_data["confirm"]:
             session.bulk_update_mappings(shard, new_data["confirm"])
 
-        return updated_areas
+        return (updated_areas, updated_stations)
 
     def shard_observations(self, observations):
         sharded_obs = {}
@@ -543,18 +743,24 @@ class StationUpdater(object):
         return sharded_obs
 
     def __call__(self):
-        sharded_obs = self.shard_observations(self.data_queue.dequeue())
-        if not sharded_obs:
-            return
+        with self.data_queue.processing():
+            sharded_obs = self.shard_observations(self.data_queue.dequeue())
+            if not sharded_obs:
+                return
 
-        retry_wrapper = retry_on_mysql_lock_fail(
-            metric="data.station.dberror", metric_tags=[f"type:{self.station_type}"]
-        )(self.update_observations)
-        updated_areas, stats = retry_wrapper(sharded_obs)
+            retry_wrapper = retry_on_mysql_lock_fail(
+                metric="data.station.dberror",
+                metric_tags=[f"type:{self.station_type}"],
+            )(self.update_observations)
+            updated_areas, updated_stations, stats = retry_wrapper(sharded_obs)
 
         with self.task.redis_pipeline() as pipe:
             if updated_areas:
                 self.queue_area_updates(pipe, updated_areas)
+            if updated_stations:
+                # Drop shared locate cache entries only after the
+                # database transaction has been committed.
+                pipe.delete(*updated_stations)
             self.emit_stats(pipe, stats)
 
         if self.data_queue.ready():
@@ -564,15 +770,20 @@ class StationUpdater(object):
         """Update the station data based on per-shard observations."""
         stats = defaultdict(int)
         updated_areas = set()
+        updated_stations = set()
 
         with self.task.db_session() as session:
             for shard, shard_values in sharded_observations.items():
-                areas = self.update_shard(session, shard, shard_values, stats)
+                areas, stations = self.update_shard(session, shard, shard_values, stats)
                 updated_areas.update(areas)
-        return updated_areas, stats
+                updated_stations.update(stations)
+        return updated_areas, updated_stations, stats
 
 
 class MacUpdater(StationUpdater):
+    def cache_key(self, shard, key):
+        return station_cache_key(shard.__tablename__, encode_mac(key))
+
     def query_shard(self, session, shard, keys):
         return (
             (session.query(shard).filter(shard.mac.in_(keys))).with_for_update().all()
@@ -608,6 +819,9 @@ class CellUpdater(StationUpdater):
     stat_obs_key = StatKey.cell
     stat_station_key = StatKey.unique_cell
 
+    # Queue deltas of the area running totals instead of area ids.
+    incremental_areas = settings("cellarea_update_incremental")
+
     def query_shard(self, session, shard, keys):
         return (
             (session.query(shard).filter(shard.cellid.in_(keys)))
@@ -615,9 +829,47 @@ class CellUpdater(StationUpdater):
             .all()
         )
 
-    def add_area_update(self, updated_areas, key):
-        updated_areas.add(encode_cellarea(*decode_cellid(key)[:4]))
+    def area_cell(self, values):
+        """
+        Return the :class:`~ichnaea.data.area.AreaCell` of a cell row or
+        a mapping of new cell values, or None if it has no position.
+        """
+        if isinstance(values, dict):
+            values = [values.get(field) for field in AreaCell._fields]
+        else:
+            values = [getattr(values, field) for field in AreaCell._fields]
+        cell = AreaCell(*values)
+        if cell.lat is None or cell.lon is None:
+            return None
+        return cell
+
+    def add_area_update(self, updated_areas, key, station=None, values=None):
+        area = decode_cellid(key)[:4]
+        if not self.incremental_areas:
+            updated_areas.add(encode_cellarea(*area))
+            return
+
+        # Track the cell contribution to its area before and after the
+        # update, the key keeps equal changes of two cells apart.
+        old = self.area_cell(station) if station is not None else None
+        new = self.area_cell(values) if values is not None else None
+        if old != new:
+            updated_areas.add((area, key, old, new))
 
     def queue_area_updates(self, pipe, updated_areas):
-        data_queue = self.data_queues["update_cellarea"]
-        data_queue.enqueue(list(updated_areas), pipe=pipe)
+        if not self.incremental_areas:
+            data_queue = self.data_queues["update_cellarea"]
+            data_queue.enqueue(list(updated_areas), pipe=pipe)
+            return
+
+        deltas = {}
+        for area, _, old, new in updated_areas:
+            if area not in deltas:
+                deltas[area] = CellAreaDelta(area, created=self.now)
+            if old is not None:
+                deltas[area].add(old, sign=-1)
+            if new is not None:
+                deltas[area].add(new)
+
+        data_queue = self.data_queues["update_cellarea_delta"]
+        data_queue.enqueue([delta.to_json() for delta in deltas.values()], pipe=pipe)
@@ -0,0 +1,190 @@
+"""
+A long-running worker updating the station tables.
+
+Instead of one celery task per batch of observations, the worker owns
+the shard queues of the configured station types and drains them
+continuously. The shard queues are split into groups, each processed
+by one worker process. As every shard table is only updated by the one
+process owning it, the row locks taken by the station updaters never
+contend between processes.
+"""
+
+import signal
+import time
+from multiprocessing import Event, Process
+
+import markus
+import structlog
+
+from ichnaea.cache import redis_pipeline
+from ichnaea.data.station import BlueUpdater, CellUpdater, WifiUpdater
+from ichnaea.db import db_worker_session
+from ichnaea.models import BlueShard, CellShard, WifiShard
+from ichnaea.taskapp.app import celery_app
+from ichnaea.taskapp.config import init_worker, shutdown_worker
+
+LOG = structlog.get_logger("ichnaea.data.station_worker")
+METRICS = markus.get_metrics()
+
+# Maps the station type to its updater and shard model.
+STATION_UPDATERS = {
+    "blue": (BlueUpdater, BlueShard),
+    "cell": (CellUpdater, CellShard),
+    "wifi": (WifiUpdater, WifiShard),
+}
+
+
+def shard_groups(station_types, processes):
+    """
+    Split the shards of the given station types into at most
+    `processes` groups. Each group is a list of (station type, shard id)
+    tuples, and each shard is part of exactly one group.
+    """
+    shards = []
+    for station_type in sorted(station_types):
+        shard_model = STATION_UPDATERS[station_type][1]
+        for shard_id in sorted(shard_model.shards().keys()):
+            shards.append((station_type, shard_id))
+
+    groups = [shards[i :: max(processes, 1)] for i in range(max(processes, 1))]
+    return [group for group in groups if group]
+
+
+class StationWorkerTask(object):
+    """
+    Takes the place of the celery task passed to a station updater,
+    giving access to the connections of the worker process.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.ready = False
+
+    def apply_async(self, args=None, kwargs=None, **options):
+        # The updater found the queue ready for another batch. Instead of
+        # scheduling a task, the worker picks up the queue again.
+        self.ready = True
+
+    def db_session(self, commit=True, isolation_level=None):
+        return db_worker_session(
+            self.app.db, commit=commit, isolation_level=isolation_level
+        )
+
+    def redis_pipeline(self, execute=True):
+        return redis_pipeline(self.app.redis_client, execute=execute)
+
+    @property
+    def redis_client(self):
+        return self.app.redis_client
+
+
+class StationWorker(object):
+    """
+    Update the stations of a group of shards, until told to stop.
+
+    A shard is updated right away while its queue holds a full batch of
+    observations. Otherwise it is updated once `interval` seconds have
+    passed since its last update, same as the scheduled celery tasks.
+    """
+
+    def __init__(self, app, group, interval=40.0, idle_wait=1.0, stop_event=None):
+        self.app = app
+        self.group = list(group)
+        self.interval = interval
+        self.idle_wait = idle_wait
+        self.stop_event = stop_event if stop_event is not None else Event()
+        self._due = dict([(shard, 0.0) for shard in self.group])
+
+    def update(self, station_type, shard_id):
+        """
+        Update one batch of observations for one shard. Return True if
+        the queue is ready for another batch.
+        """
+        updater_type = STATION_UPDATERS[station_type][0]
+        task = StationWorkerTask(self.app)
+        with METRICS.timer("task", tags=["task:data.update_" + station_type]):
+            try:
+                updater_type(task, shard_id=shard_id)()
+            except Exception:
+                self.app.raven_client.captureException()
+                return False
+        return task.ready
+
+    def run_once(self):
+        """Update all due shards and return the number of updates."""
+        updates = 0
+        for shard in self.group:
+            if self._due[shard] > time.monotonic():
+                continue
+            if self.stop_event.is_set():
+                break
+
+            if self.update(*shard):
+                self._due[shard] = 0.0
+            else:
+                self._due[shard] = time.monotonic() + self.interval
+            updates += 1
+        return updates
+
+    def run(self):
+        while not self.stop_event.is_set():
+            if not self.run_once():
+                wait = min(self._due.values()) - time.monotonic()
+                self.stop_event.wait(min(max(wait, 0.0), self.idle_wait))
+
+
+def _run_worker_process(group, interval, stop_event):
+    # Only the parent process reacts to interrupts, the worker processes
+    # finish their current batch once the stop event is set.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    init_worker(celery_app)
+    try:
+        StationWorker(celery_app, group, interval=interval, stop_event=stop_event).run()
+    finally:
+        shutdown_worker(celery_app)
+
+
+def run_station_workers(station_types, processes, interval=40.0):
+    """
+    Start one worker process per shard group and wait for them to stop,
+    which they do once the parent process gets a SIGINT or SIGTERM.
+    """
+    stop_event = Event()
+    workers = [
+        Process(
+            target=_run_worker_process,
+            args=(group, interval, stop_event),
+            name="station_worker_%s" % i,
+        )
+        for i, group in enumerate(shard_groups(station_types, processes))
+    ]
+
+    def stop(signum, frame):
+        LOG.info("Stopping station workers.")
+        stop_event.set()
+
+    previous = {
+        signum: signal.signal(signum, stop)
+        for signum in (signal.SIGINT, signal.SIGTERM)
+    }
+    try:
+        for worker in workers:
+            worker.start()
+        LOG.info(
+            "Started station workers.",
+            station_types=sorted(station_types),
+            processes=len(workers),
+        )
+        while any([worker.is_alive() for worker in workers]):
+            for worker in workers:
+                worker.join(timeout=1.0)
+                if worker.exitcode and not stop_event.is_set():
+                    LOG.error("Station worker failed.", name=worker.name)
+                    stop_event.set()
+    finally:
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+
+    return max([worker.exitcode or 0 for worker in workers] + [0])
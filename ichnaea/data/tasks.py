@@ -6,13 +6,16 @@ automatic statsd timer metrics to track the runtime of each task.
 """
 
 from datetime import timedelta
+from functools import partial
 
 from celery.schedules import crontab
 
 from ichnaea import models
 from ichnaea.data import (
+    _cellarea_incremental_enabled,
     _cell_export_enabled,
     _map_content_enabled,
+    _station_task_enabled,
     area,
     datamap,
     export,
@@ -113,6 +116,7 @@ def export_reports(self, name, queue_key):
     expires=30,
     _schedule=timedelta(seconds=48),
     _shard_model=models.BlueShard,
+    _enabled=partial(_station_task_enabled, "blue"),
 )
 def update_blue(self, shard_id=None):
     station.BlueUpdater(self, shard_id=shard_id)()
@@ -125,6 +129,7 @@ def update_blue(self, shard_id=None):
     expires=30,
     _schedule=timedelta(seconds=41),
     _shard_model=models.CellShard,
+    _enabled=partial(_station_task_enabled, "cell"),
 )
 def update_cell(self, shard_id=None):
     station.CellUpdater(self, shard_id=shard_id)()
@@ -137,6 +142,7 @@ def update_cell(self, shard_id=None):
     expires=30,
     _schedule=timedelta(seconds=40),
     _shard_model=models.WifiShard,
+    _enabled=partial(_station_task_enabled, "wifi"),
 )
 def update_wifi(self, shard_id=None):
     station.WifiUpdater(self, shard_id=shard_id)()
@@ -153,6 +159,30 @@ def update_cellarea(self):
     area.CellAreaUpdater(self)()
 
 
+@celery_app.task(
+    base=BaseTask,
+    bind=True,
+    queue="celery_cell",
+    expires=30,
+    _schedule=timedelta(seconds=46),
+    _enabled=_cellarea_incremental_enabled,
+)
+def update_cellarea_delta(self):
+    area.CellAreaDeltaUpdater(self)()
+
+
+@celery_app.task(
+    base=BaseTask,
+    bind=True,
+    queue="celery_cell",
+    expires=3600,
+    _schedule=crontab(hour=0, minute=47),
+    _enabled=_cellarea_incremental_enabled,
+)
+def correct_cellarea_drift(self):
+    area.CellAreaDriftCorrector(self)()
+
+
 @celery_app.task(
     base=BaseTask,
     bind=True,
@@ -1,6 +1,21 @@
 from datetime import timedelta
-
-from ichnaea.data.tasks import update_cellarea
+import json
+from unittest import mock
+
+import pytest
+
+from ichnaea.data.area import (
+    AreaCell,
+    CellAreaDelta,
+    CellAreaUpdater,
+    decode_region_counts,
+    DELTA_AREAS_KEY,
+)
+from ichnaea.data.tasks import (
+    correct_cellarea_drift,
+    update_cellarea,
+    update_cellarea_delta,
+)
 from ichnaea.models import area_id, encode_cellarea, CellArea, Radio
 from ichnaea.tests.factories import CellAreaFactory, CellShardFactory
 from ichnaea import util
@@ -35,6 +50,12 @@ class TestArea(object):
         assert area.avg_cell_radius == cell.radius
         assert area.num_cells == 1
         assert area.last_seen == cell.last_seen
+        assert area.sum_lat == cell.lat
+        assert area.sum_radius == cell.radius
+        assert area.num_radius == 1
+        assert area.max_lat == cell.max_lat
+        assert area.min_lon == cell.min_lon
+        assert decode_region_counts(area.region_counts) == {"GB": 1}
 
     def test_remove(self, celery, session):
         area = self.area_factory()
@@ -286,3 +307,272 @@ class TestArea(object):
 
         area = session.query(self.area_model).one()
         assert area.region is None
+
+
+class TestAreaBatched(TestArea):
+    @pytest.fixture(autouse=True)
+    def batched(self):
+        with mock.patch.object(CellAreaUpdater, "batched", True):
+            yield
+
+    def test_batch(self, celery, session):
+        today = util.utcnow().date()
+        new_cell = self.cell_factory(radio=Radio.gsm, lac=1, radius=100)
+        updated = self.area_factory(radio=Radio.lte, lac=2, num_cells=5)
+        removed = self.area_factory(radio=Radio.lte, lac=3)
+        area_key = {
+            "radio": updated.radio,
+            "mcc": updated.mcc,
+            "mnc": updated.mnc,
+            "lac": updated.lac,
+        }
+        for radius in (100, 201):
+            cell = self.cell_factory(
+                lat=updated.lat + 0.001, lon=updated.lon, radius=radius, **area_key
+            )
+        session.commit()
+
+        self.area_queue(celery).enqueue(
+            [
+                area_id(new_cell),
+                encode_cellarea(*updated.areaid),
+                encode_cellarea(*removed.areaid),
+            ]
+        )
+        self.task.delay().get()
+
+        areas = dict(
+            [(area.areaid, area) for area in session.query(self.area_model).all()]
+        )
+        assert set(areas.keys()) == set(
+            [
+                (new_cell.radio, new_cell.mcc, new_cell.mnc, new_cell.lac),
+                updated.areaid,
+            ]
+        )
+        new_area = areas[(new_cell.radio, new_cell.mcc, new_cell.mnc, new_cell.lac)]
+        assert new_area.lat == new_cell.lat
+        assert new_area.num_cells == 1
+        assert new_area.avg_cell_radius == 100
+
+        session.refresh(updated)
+        assert updated.lat == cell.lat
+        assert updated.num_cells == 2
+        assert updated.avg_cell_radius == 150
+        assert updated.last_seen == today
+
+
+class TestCellAreaDelta(object):
+    def cell(self, lat, lon, radius=100, region="GB", last_seen=None):
+        return AreaCell(
+            lat=lat,
+            lon=lon,
+            max_lat=lat + 0.01,
+            min_lat=lat - 0.01,
+            max_lon=lon + 0.01,
+            min_lon=lon - 0.01,
+            radius=radius,
+            region=region,
+            last_seen=last_seen,
+        )
+
+    def test_add(self):
+        today = util.utcnow().date()
+        delta = CellAreaDelta((Radio.gsm, 234, 5, 6))
+        delta.add(self.cell(51.0, -1.0, last_seen=today))
+        delta.add(self.cell(52.0, -2.0, radius=None, region=None))
+        delta.add(self.cell(53.0, -3.0, last_seen=today), sign=-1)
+
+        assert delta.num_cells == 1
+        assert round(delta.sum_lat, 7) == 50.0
+        assert delta.sum_radius == 0
+        assert delta.num_radius == 0
+        assert dict(delta.regions) == {"GB": 0, None: 1}
+        # Removed cells don't shrink or grow the bounding box.
+        assert delta.max_lat == 52.01
+        assert delta.min_lat == 50.99
+        assert delta.max_lon == -0.99
+        assert delta.min_lon == -2.01
+        assert delta.last_seen == today
+
+    def test_json(self):
+        now = util.utcnow()
+        today = now.date()
+        delta = CellAreaDelta((Radio.lte, 234, 5, 6), created=now)
+        delta.add(self.cell(51.0, -1.0, last_seen=today))
+        delta.add(self.cell(52.0, -2.0, region=None), sign=-1)
+
+        data = CellAreaDelta.from_json(json.loads(json.dumps(delta.to_json())))
+        assert data.area == (Radio.lte, 234, 5, 6)
+        assert data.num_cells == 0
+        assert data.sum_radius == 0
+        assert dict(data.regions) == {"GB": 1, None: -1}
+        assert data.max_lat == delta.max_lat
+        assert data.last_seen == today
+        assert data.created == now
+
+        data = delta.to_json()
+        del data["created"]
+        assert CellAreaDelta.from_json(data).created is None
+
+    def test_merge(self):
+        now = util.utcnow()
+        yesterday = now.date() - timedelta(days=1)
+        first = CellAreaDelta((Radio.gsm, 234, 5, 6), created=now)
+        first.add(self.cell(51.0, -1.0, last_seen=yesterday))
+        second = CellAreaDelta(
+            (Radio.gsm, 234, 5, 6), created=now - timedelta(seconds=10)
+        )
+        second.add(self.cell(51.0, -1.0), sign=-1)
+        second.add(self.cell(50.0, -1.5, radius=300))
+
+        first.merge(second)
+        assert first.num_cells == 1
+        assert first.sum_lat == 50.0
+        assert first.sum_radius == 300
+        assert first.num_radius == 1
+        assert dict(first.regions) == {"GB": 1}
+        assert first.min_lat == 49.99
+        assert first.max_lat == 51.01
+        assert first.last_seen == yesterday
+        assert first.created == now - timedelta(seconds=10)
+
+
+class TestAreaDelta(object):
+
+    area_model = CellArea
+    cell_factory = CellShardFactory
+
+    def delta_queue(self, celery):
+        return celery.data_queues["update_cellarea_delta"]
+
+    def full_queue(self, celery):
+        return celery.data_queues["update_cellarea"]
+
+    def area_key(self, cell):
+        return (cell.radio, cell.mcc, cell.mnc, cell.lac)
+
+    def area_cell(self, cell):
+        return AreaCell(*[getattr(cell, field) for field in AreaCell._fields])
+
+    def full_update(self, celery, *areaids):
+        self.full_queue(celery).enqueue(list(areaids))
+        update_cellarea.delay().get()
+
+    def test_empty(self, celery, session):
+        update_cellarea_delta.delay().get()
+
+    def test_apply(self, celery, redis, session):
+        today = util.utcnow().date()
+        cell = self.cell_factory(radio=Radio.gsm, radius=100)
+        area_key = {
+            "radio": cell.radio,
+            "mcc": cell.mcc,
+            "mnc": cell.mnc,
+            "lac": cell.lac,
+        }
+        session.commit()
+        self.full_update(celery, area_id(cell))
+
+        added = self.cell_factory(
+            lat=cell.lat + 0.01, lon=cell.lon, radius=300, last_seen=today, **area_key
+        )
+        session.commit()
+        created = session.query(self.area_model).one().totals_modified
+        delta = CellAreaDelta(
+            self.area_key(cell), created=created + timedelta(seconds=1)
+        )
+        delta.add(self.area_cell(added))
+        self.delta_queue(celery).enqueue([delta.to_json()])
+        update_cellarea_delta.delay().get()
+
+        area = session.query(self.area_model).one()
+        delta_values = dict(
+            [(name, getattr(area, name)) for name in ("num_cells", "avg_cell_radius")]
+        )
+        delta_values.update(
+            dict([(name, round(getattr(area, name), 7)) for name in ("lat", "lon")])
+        )
+        assert delta_values == {
+            "num_cells": 2,
+            "avg_cell_radius": 200,
+            "lat": round(cell.lat + 0.005, 7),
+            "lon": round(cell.lon, 7),
+        }
+        assert area.radius > 0
+        assert area.last_seen == today
+        assert redis.smembers(DELTA_AREAS_KEY) == set([area_id(cell)])
+
+        # A full update arrives at the same values.
+        radius = area.radius
+        self.full_update(celery, area_id(cell))
+        session.refresh(area)
+        assert area.num_cells == 2
+        assert area.avg_cell_radius == 200
+        assert round(area.lat, 7) == round(cell.lat + 0.005, 7)
+        assert area.radius == radius
+
+    def test_before_full_update(self, celery, session):
+        cell = self.cell_factory()
+        session.commit()
+        self.full_update(celery, area_id(cell))
+        area = session.query(self.area_model).one()
+        assert area.totals_modified is not None
+
+        # The delta was created before the full update, which might
+        # have counted the cell already.
+        delta = CellAreaDelta(
+            self.area_key(cell), created=area.totals_modified - timedelta(seconds=1)
+        )
+        delta.add(self.area_cell(cell))
+        self.delta_queue(celery).enqueue([delta.to_json()])
+        update_cellarea_delta.delay().get()
+
+        session.refresh(area)
+        assert area.num_cells == 1
+        assert self.full_queue(celery).dequeue() == [area_id(cell)]
+
+    def test_new_area(self, celery, session):
+        cell = self.cell_factory()
+        session.commit()
+
+        delta = CellAreaDelta(self.area_key(cell))
+        delta.add(self.area_cell(cell))
+        self.delta_queue(celery).enqueue([delta.to_json()])
+        update_cellarea_delta.delay().get()
+
+        assert session.query(self.area_model).count() == 0
+        assert self.full_queue(celery).dequeue() == [area_id(cell)]
+
+    def test_without_totals(self, celery, session):
+        area = CellAreaFactory(num_cells=2)
+        session.commit()
+
+        delta = CellAreaDelta(area.areaid, num_cells=-1, regions={"GB": -1})
+        self.delta_queue(celery).enqueue([delta.to_json()])
+        update_cellarea_delta.delay().get()
+
+        session.refresh(area)
+        assert area.num_cells == 2
+        assert self.full_queue(celery).dequeue() == [encode_cellarea(*area.areaid)]
+
+    def test_remove_last(self, celery, session):
+        cell = self.cell_factory()
+        session.commit()
+        self.full_update(celery, area_id(cell))
+
+        delta = CellAreaDelta(self.area_key(cell))
+        delta.add(self.area_cell(cell), sign=-1)
+        self.delta_queue(celery).enqueue([delta.to_json()])
+        update_cellarea_delta.delay().get()
+
+        # The area is left to the full update, which deletes it.
+        assert self.full_queue(celery).dequeue() == [area_id(cell)]
+
+    def test_correct_drift(self, celery, redis, session):
+        areaids = [encode_cellarea(Radio.gsm, 234, 5, lac) for lac in (1, 2)]
+        redis.sadd(DELTA_AREAS_KEY, *areaids)
+
+        correct_cellarea_drift.delay().get()
+        assert set(self.full_queue(celery).dequeue()) == set(areaids)
+        assert not redis.exists(DELTA_AREAS_KEY)
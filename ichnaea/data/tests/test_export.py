@@ -4,9 +4,10 @@ from unittest import mock
 
 import boto3
 import pytest
+import redis.exceptions
 import requests_mock
 
-from ichnaea.data.export import DummyExporter, InternalTransform
+from ichnaea.data.export import DummyExporter, InternalExporter, InternalTransform
 from ichnaea.data.tasks import update_blue, update_cell, update_incoming, update_wifi
 from ichnaea.models import BlueShard, CellShard, WifiShard
 from ichnaea.tests.factories import (
@@ -697,3 +698,47 @@ class TestInternal(BaseExportTest):
         self.add_reports(celery, 1, set_position=False)
         self._update_all(session)
         metricsmock.assert_incr_once("data.report.drop", tags=["key:test"])
+
+    def _wifi_queue_sizes(self, celery):
+        return sum(
+            [
+                celery.data_queues["update_wifi_" + shard_id].size()
+                for shard_id in WifiShard.shards().keys()
+            ]
+        )
+
+    def test_chunks(self, celery, session, metricsmock):
+        self.add_reports(celery, 5, cell_factor=0, wifi_factor=2, lat=50.0, lon=10.0)
+        with mock.patch.object(InternalExporter, "chunk_size", 2):
+            self._update_all(session, datamap_only=True)
+
+        assert self._wifi_queue_sizes(celery) == 10
+        # The data map grid is only queued once for all chunks.
+        assert celery.data_queues["update_datamap_ne"].size() == 1
+        metricsmock.assert_incr_once("data.report.upload", value=5, tags=["key:test"])
+        metricsmock.assert_incr_once(
+            "data.observation.upload", value=10, tags=["type:wifi", "key:test"]
+        )
+
+    def test_retry_chunks(self, celery, session, metricsmock):
+        self.add_reports(celery, 5, cell_factor=0, wifi_factor=2)
+        orig_queue_observations = InternalExporter.queue_observations
+        calls = []
+
+        def queue_observations(self, pipe, observations):
+            calls.append(len(observations["wifi"]))
+            if len(calls) == 2:
+                raise redis.exceptions.ConnectionError()
+            orig_queue_observations(self, pipe, observations)
+
+        with mock.patch.object(InternalExporter, "chunk_size", 2):
+            with mock.patch.object(InternalExporter, "_retry_wait", 0.001):
+                with mock.patch.object(
+                    InternalExporter, "queue_observations", queue_observations
+                ):
+                    self._update_all(session, datamap_only=True)
+
+        # The first chunk isn't sent again after the failure.
+        assert calls == [4, 4, 4, 2]
+        assert self._wifi_queue_sizes(celery) == 10
+        metricsmock.assert_incr_once("data.report.upload", value=5, tags=["key:test"])
@@ -191,6 +191,7 @@ class TestMonitorQueueSizeAndRateControl:
         "update_cell_lte": ["data", "cell"],
         "update_cell_wcdma": ["data", "cell"],
         "update_cellarea": ["data", "cellarea"],
+        "update_cellarea_delta": ["data", "cellarea_delta"],
         "update_datamap_ne": ["data", "datamap"],
         "update_datamap_nw": ["data", "datamap"],
         "update_datamap_se": ["data", "datamap"],
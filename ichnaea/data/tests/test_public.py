@@ -1,4 +1,7 @@
 import csv
+from functools import partial
+import gzip
+import json
 import os
 import re
 from datetime import datetime, timedelta
@@ -10,10 +13,15 @@ import pytest
 from zoneinfo import ZoneInfo
 from sqlalchemy import func
 
+from ichnaea.data import public
 from ichnaea.data.public import (
     read_stations_from_csv,
+    read_stations_from_csv_bulk,
     write_stations_to_csv,
+    write_stations_to_csv_parallel,
+    ExportCheckpoint,
     InvalidCSV,
+    MultipartUpload,
 )
 from ichnaea.data.tasks import cell_export_full, cell_export_diff
 from ichnaea.models import Radio, CellArea, CellShard, RegionStat
@@ -45,6 +53,38 @@ class FakeTask(object):
         self.app = app
 
 
+class FakeS3Client(object):
+    """An in-memory stand-in for the S3 multipart upload API."""
+
+    def __init__(self, fail_part=None):
+        self.fail_part = fail_part
+        self.parts = {}
+        self.objects = {}
+        self.aborted = []
+
+    def create_multipart_upload(self, Bucket, Key):
+        return {"UploadId": "upload-id"}
+
+    def upload_part(self, Bucket, Key, PartNumber, UploadId, Body):
+        assert UploadId == "upload-id"
+        if PartNumber == self.fail_part:
+            raise ValueError("upload failed")
+        self.parts[PartNumber] = Body
+        return {"ETag": '"etag-%d"' % PartNumber}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = MultipartUpload["Parts"]
+        assert [part["PartNumber"] for part in parts] == list(range(1, len(parts) + 1))
+        for part in parts:
+            assert part["ETag"] == '"etag-%d"' % part["PartNumber"]
+        self.objects[(Bucket, Key)] = b"".join(
+            [self.parts[part["PartNumber"]] for part in parts]
+        )
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted.append((Bucket, Key))
+
+
 class TestExport(object):
     def test_local_export(self, celery, session):
         now = util.utcnow()
@@ -106,6 +146,120 @@ class TestExport(object):
 
                     assert cells == exported_cells
 
+    def read_export(self, path):
+        with util.gzip_open(path, "r") as gzip_wrapper:
+            with gzip_wrapper as gzip_file:
+                return gzip_file.read()
+
+    def test_parallel_export(self, celery, session):
+        today = util.utcnow().date()
+        for radio in (Radio.gsm, Radio.wcdma, Radio.lte):
+            CellShardFactory.create_batch(7, radio=radio)
+        session.commit()
+
+        with util.selfdestruct_tempdir() as temp_dir:
+            path = os.path.join(temp_dir, "export.csv.gz")
+            parallel_path = os.path.join(temp_dir, "parallel.csv.gz")
+            assert write_stations_to_csv(session, path, today) == 21
+            num_rows = write_stations_to_csv_parallel(
+                session, parallel_path, today, rows_per_range=3
+            )
+            assert num_rows == 21
+            assert self.read_export(parallel_path) == self.read_export(path)
+            assert sorted(os.listdir(temp_dir)) == [
+                "export.csv.gz",
+                "parallel.csv.gz",
+            ]
+
+    def test_parallel_export_processes(self, clean_db):
+        """The ranges are written by separate processes."""
+        today = util.utcnow().date()
+        # The export processes have their own database connections, so
+        # the stations have to be committed, clean_db removes them again.
+        session = clean_db.session()
+        try:
+            for radio in (Radio.gsm, Radio.wcdma, Radio.lte):
+                session.add_all(CellShardFactory.build_batch(7, radio=radio))
+            session.commit()
+
+            with util.selfdestruct_tempdir() as temp_dir:
+                path = os.path.join(temp_dir, "export.csv.gz")
+                parallel_path = os.path.join(temp_dir, "parallel.csv.gz")
+                assert write_stations_to_csv(session, path, today) == 21
+                num_rows = write_stations_to_csv_parallel(
+                    session,
+                    parallel_path,
+                    today,
+                    processes=2,
+                    db_uri=clean_db.uri,
+                    rows_per_range=3,
+                )
+                assert num_rows == 21
+                assert self.read_export(parallel_path) == self.read_export(path)
+        finally:
+            session.close()
+
+    def test_parallel_export_resume(self, celery, session):
+        today = util.utcnow().date()
+        CellShardFactory.create_batch(10, radio=Radio.gsm)
+        session.commit()
+
+        write_range = public.write_range_to_csv
+
+        def crash_second(*args):
+            if crash_second.calls == 1:
+                raise ValueError("crash")
+            crash_second.calls += 1
+            return write_range(*args)
+
+        crash_second.calls = 0
+
+        with util.selfdestruct_tempdir() as temp_dir:
+            path = os.path.join(temp_dir, "export.csv.gz")
+            write_stations_to_csv(session, path, today)
+
+            parallel_path = os.path.join(temp_dir, "parallel.csv.gz")
+            with mock.patch.object(public, "write_range_to_csv", crash_second):
+                with pytest.raises(ValueError):
+                    write_stations_to_csv_parallel(
+                        session, parallel_path, today, rows_per_range=4
+                    )
+            with open(parallel_path + ".checkpoint") as fd:
+                checkpoint = json.load(fd)
+            assert list(checkpoint["done"].keys()) == ["0"]
+
+            with mock.patch.object(
+                public, "write_range_to_csv", side_effect=write_range
+            ) as write_mock:
+                num_rows = write_stations_to_csv_parallel(
+                    session, parallel_path, today, rows_per_range=4
+                )
+            assert num_rows == 10
+            # The finished range isn't written again.
+            assert write_mock.call_count == len(checkpoint["ranges"]) - 1
+            assert self.read_export(parallel_path) == self.read_export(path)
+            assert not os.path.exists(parallel_path + ".checkpoint")
+
+    def test_export_full_streaming(self, celery, session):
+        CellShardFactory.create_batch(10, radio=Radio.gsm)
+        session.commit()
+
+        client = FakeS3Client()
+        with mock.patch.object(boto3, "client", return_value=client):
+            with mock.patch.object(public, "settings") as mock_settings:
+                mock_settings.side_effect = {
+                    "cell_export_processes": 1,
+                    "cell_export_streaming": True,
+                    "cell_export_work_dir": "",
+                }.get
+                cell_export_full(_bucket="bucket")
+
+        ((bucket, key),) = client.objects.keys()
+        assert bucket == "bucket"
+        assert re.match(r"export/MLS-full-cell-export-[\d-]+T000000\.csv\.gz", key)
+        rows = gzip.decompress(client.objects[(bucket, key)]).decode("utf-8")
+        assert len(rows.splitlines()) == 11
+
     def test_export_diff(self, celery, session):
         CellShardFactory.create_batch(10, radio=Radio.gsm)
         session.commit()
@@ -161,8 +315,17 @@ def cellarea_queue(redis_client, celery):
     return configure_data(redis_client)["update_cellarea"]
 
 
+@pytest.fixture(params=["rows", "bulk"])
+def read_stations(request):
+    """Return the row by row or the bulk import function."""
+    if request.param == "bulk":
+        # A tiny chunk size, to read the test files in multiple chunks
+        return partial(read_stations_from_csv_bulk, chunk_size=2)
+    return read_stations_from_csv
+
+
 class TestImport:
-    def test_unexpected_csv(self, session, redis_client, cellarea_queue):
+    def test_unexpected_csv(self, session, redis_client, cellarea_queue, read_stations):
         """An unexpected CSV input exits early."""
 
         csv = StringIO(
@@ -173,9 +336,9 @@ UK,United Kingdom
 """
         )
         with pytest.raises(InvalidCSV):
-            read_stations_from_csv(session, csv, redis_client, cellarea_queue)
+            read_stations(session, csv, redis_client, cellarea_queue)
 
-    def test_new_stations(self, session, redis_client, cellarea_queue):
+    def test_new_stations(self, session, redis_client, cellarea_queue, read_stations):
         """New stations are imported, creating cell areas and region stats."""
         csv = StringIO(
             """\
@@ -185,7 +348,7 @@ GSM,208,10,30014,20669,,2.5112670,46.5992450,0,78,1,1566307030,1570119413,
 LTE,202,1,2120,12842,,23.4123167,38.8574351,0,6,1,1568220588,1570120328,
 """
         )
-        read_stations_from_csv(session, csv, redis_client, cellarea_queue)
+        read_stations(session, csv, redis_client, cellarea_queue)
 
         # Check the details of the WCDMA station
         wcdma = session.query(CellShard.shard_model(Radio.wcdma)).one()
@@ -228,7 +391,9 @@ LTE,202,1,2120,12842,,23.4123167,38.8574351,0,6,1,1568220588,1570120328,
         expected = [("FR", 1, 0, 0, 0, 0), ("GR", 0, 1, 1, 0, 0)]
         assert actual == expected
 
-    def test_modified_station(self, session, redis_client, cellarea_queue):
+    def test_modified_station(
+        self, session, redis_client, cellarea_queue, read_stations
+    ):
         """A modified station updates existing records."""
         station_data = {
             "radio": Radio.wcdma,
@@ -257,7 +422,7 @@ radio,mcc,net,area,cell,unit,lon,lat,range,samples,changeable,created,updated,av
 UMTS,202,1,2120,12842,,23.4123167,38.8574351,0,6,1,1568220564,1570120316,
 """
         )
-        read_stations_from_csv(session, csv, redis_client, cellarea_queue)
+        read_stations(session, csv, redis_client, cellarea_queue)
 
         # Check the details of the updated station
         wcdma = session.query(CellShard.shard_model(Radio.wcdma)).one()
@@ -284,7 +449,9 @@ UMTS,202,1,2120,12842,,23.4123167,38.8574351,0,6,1,1568220564,1570120316,
         assert stat.region == "GR"
         assert stat.wcdma == 1
 
-    def test_outdated_station(self, session, redis_client, cellarea_queue):
+    def test_outdated_station(
+        self, session, redis_client, cellarea_queue, read_stations
+    ):
         """An older statuon record does not update existing station records."""
         station_data = {
             "radio": Radio.wcdma,
@@ -309,7 +476,7 @@ radio,mcc,net,area,cell,unit,lon,lat,range,samples,changeable,created,updated,av
 UMTS,202,1,2120,12842,,23.4123167,38.8574351,0,6,1,1568220564,1570120316,
 """
         )
-        read_stations_from_csv(session, csv, redis_client, cellarea_queue)
+        read_stations(session, csv, redis_client, cellarea_queue)
 
         # The existing station is unmodified
         wcdma = session.query(CellShard.shard_model(Radio.wcdma)).one()
@@ -322,7 +489,9 @@ UMTS,202,1,2120,12842,,23.4123167,38.8574351,0,6,1,1568220564,1570120316,
         assert session.query(func.count(CellArea.areaid)).scalar() == 0
         assert session.query(func.count(RegionStat.region)).scalar() == 0
 
-    def test_unexpected_radio_halts(self, session, redis_client, cellarea_queue):
+    def test_unexpected_radio_halts(
+        self, session, redis_client, cellarea_queue, read_stations
+    ):
         """
         A row with an unexpected radio type halts processing of the CSV.
 
@@ -339,9 +508,29 @@ GSM,208,10,30014,20669,,2.5112670,46.5992450,0,78,1,1566307030,1570119413,
 """
         )
         with pytest.raises(InvalidCSV):
-            read_stations_from_csv(session, csv, redis_client, cellarea_queue)
+            read_stations(session, csv, redis_client, cellarea_queue)
+
+    def test_first_rows_invalid(
+        self, session, redis_client, cellarea_queue, read_stations
+    ):
+        """Invalid rows before the first valid row halt processing."""
+        # The first two rows have out of range timestamps
+        csv = StringIO(
+            """\
+radio,mcc,net,area,cell,unit,lon,lat,range,samples,changeable,created,updated,averageSignal
+UMTS,202,1,2120,12842,,23.4123167,38.8574351,0,6,1,999999999999,1570120316,
+GSM,208,10,30014,20669,,2.5112670,46.5992450,0,78,1,1566307030,999999999999,
+GSM,208,10,30014,20670,,2.5112670,46.5992450,0,78,1,1566307030,1570119413,
+"""
+        )
+        with pytest.raises(InvalidCSV):
+            read_stations(session, csv, redis_client, cellarea_queue)
+        gsm_model = CellShard.shard_model(Radio.gsm)
+        assert session.query(func.count(gsm_model.cellid)).scalar() == 0
 
-    def test_empty_radio_skipped(self, session, redis_client, cellarea_queue):
+    def test_empty_radio_skipped(
+        self, session, redis_client, cellarea_queue, read_stations
+    ):
         """
         A empty string for the radio type causes the row to be skipped.
 
@@ -357,7 +546,7 @@ UMTS,202,1,2120,12842,,23.4123167,38.8574351,0,6,1,1568220564,1570120316,
 GSM,208,10,30014,20669,,2.5112670,46.5992450,0,78,1,1566307030,1570119413,
 """
         )
-        read_stations_from_csv(session, csv, redis_client, cellarea_queue)
+        read_stations(session, csv, redis_client, cellarea_queue)
 
         # The empty radio row is skipped, but the following row is processed.
         wcdma = session.query(CellShard.shard_model(Radio.wcdma)).one()
@@ -368,7 +557,9 @@ GSM,208,10,30014,20669,,2.5112670,46.5992450,0,78,1,1566307030,1570119413,
         assert session.query(func.count(CellArea.areaid)).scalar() == 2
         assert session.query(func.count(RegionStat.region)).scalar() == 2
 
-    def test_invalid_row_skipped(self, session, redis_client, cellarea_queue):
+    def test_invalid_row_skipped(
+        self, session, redis_client, cellarea_queue, read_stations
+    ):
         """A row that fails validation is skipped."""
         # In GSM row, the longitude 202.5 is greater than max of 180
         csv = StringIO(
@@ -379,7 +570,7 @@ GSM,208,10,30014,20669,,202.5,46.5992450,0,78,1,1566307030,1570119413,
 LTE,202,1,2120,12842,,23.4123167,38.8574351,0,6,1,1568220588,1570120328,
 """
         )
-        read_stations_from_csv(session, csv, redis_client, cellarea_queue)
+        read_stations(session, csv, redis_client, cellarea_queue)
 
         # The invalid GSM row is skipped
         gsm_model = CellShard.shard_model(Radio.gsm)
@@ -393,7 +584,9 @@ LTE,202,1,2120,12842,,23.4123167,38.8574351,0,6,1,1568220588,1570120328,
         assert session.query(func.count(CellArea.areaid)).scalar() == 2
         assert session.query(func.count(RegionStat.region)).scalar() == 1
 
-    def test_bad_data_skipped(self, session, redis_client, cellarea_queue):
+    def test_bad_data_skipped(
+        self, session, redis_client, cellarea_queue, read_stations
+    ):
         """A row that has invalid data (like a string for a number) is skipped."""
         # In GSM row, the mcc field should be a number, not a string
         csv = StringIO(
@@ -404,7 +597,7 @@ GSM,"MCC",10,30014,20669,,2.5112670,46.5992450,0,78,1,1566307030,1570119413,
 LTE,202,1,2120,12842,,23.4123167,38.8574351,0,6,1,1568220588,1570120328,
 """
         )
-        read_stations_from_csv(session, csv, redis_client, cellarea_queue)
+        read_stations(session, csv, redis_client, cellarea_queue)
 
         # The invalid GSM row is skipped
         gsm_model = CellShard.shard_model(Radio.gsm)
@@ -417,3 +610,154 @@ LTE,202,1,2120,12842,,23.4123167,38.8574351,0,6,1,1568220588,1570120328,
         assert session.query(func.count(lte_model.cellid)).scalar() == 1
         assert session.query(func.count(CellArea.areaid)).scalar() == 2
         assert session.query(func.count(RegionStat.region)).scalar() == 1
+
+    def test_bulk_progress(self, session, redis_client, cellarea_queue):
+        """The bulk import reports its progress and keeps the newest rows."""
+        csv = StringIO(
+            """\
+radio,mcc,net,area,cell,unit,lon,lat,range,samples,changeable,created,updated,averageSignal
+UMTS,202,1,2120,12842,,23.4123167,38.8574351,0,6,1,1568220564,1570120316,
+UMTS,202,1,2120,12842,,23.4123168,38.8574352,0,7,1,1568220564,1570120317,
+UMTS,202,1,2120,12842,,23.4123169,38.8574353,0,8,1,1568220564,1570120315,
+GSM,208,10,30014,20669,,2.5112670,46.5992450,0,78,1,1566307030,1570119413,
+"""
+        )
+        progress = []
+        total = read_stations_from_csv_bulk(
+            session,
+            csv,
+            redis_client,
+            cellarea_queue,
+            chunk_size=3,
+            progress=progress.append,
+        )
+        assert total == 4
+        assert progress == [3, 4]
+
+        wcdma = session.query(CellShard.shard_model(Radio.wcdma)).one()
+        assert wcdma.lat == 38.8574352
+        assert wcdma.samples == 7
+        assert wcdma.modified == datetime(2019, 10, 3, 16, 31, 57, tzinfo=UTC)
+        assert session.query(func.count(CellArea.areaid)).scalar() == 2
+
+
+class TestParseStations:
+    def test_parse(self):
+        rows = [
+            row.split(",")
+            for row in (
+                "GSM,208,10,30014,70669,,2.5,46.5,0,78,1,1566307030,1570119413,",
+                "LTE,202,1,2120,12842,510,23.4,38.8,200000,6,1,1568220588,1570120328,",
+                "UMTS,202,1,2120,12842,511,23.4,38.8,0,6,1,1568220564,1570120316,",
+                "UMTS,202,1,0,12842,,23.4,38.8,0,6,1,1568220564,1570120316,",
+                "GSM,208,10,30014,20669,,2.5,46.5,-1,78,1,1566307030,1570119413,",
+                "GSM,208,10,30014,20669,,nan,46.5,0,78,1,1566307030,1570119413,",
+                "GSM,MCC,10,30014,20669,,2.5,46.5,0,78,1,1566307030,1570119413,",
+                "GSM,208,10,30014",
+                ",208,10,30014,20669,,2.5,46.5,0,78,1,1566307030,1570119413,",
+            )
+        ]
+        columns, states = public._parse_stations(rows)
+        assert states.tolist() == [1, 1, 1, 0, 0, 0, 0, 0, -1]
+        # A large GSM cell id is a WCDMA cell
+        assert columns["radio"][0] == Radio.wcdma
+        assert columns["radio"][1] == Radio.lte
+        # The radius is limited, the psc is dropped if invalid
+        assert columns["radius"][1] == 100000
+        assert columns["psc_valid"][:3].tolist() == [True, False, True]
+        assert columns["psc"][2] == 511
+
+    def test_unknown_radio(self):
+        rows = [["WCDMA", "202", "1", "2120", "12842"]]
+        with pytest.raises(InvalidCSV):
+            public._parse_stations(rows)
+
+
+class TestExportCheckpoint:
+    def test_load(self, tmp_path):
+        path = str(tmp_path / "export.checkpoint")
+        checkpoint = ExportCheckpoint.load(path, "key")
+        assert checkpoint.ranges is None
+        assert checkpoint.done == {}
+
+        checkpoint.ranges = [
+            ("cell_gsm", b"", b"\x00\x01"),
+            ("cell_gsm", b"\x00\x01", None),
+        ]
+        checkpoint.done[1] = 25
+        checkpoint.save()
+
+        loaded = ExportCheckpoint.load(path, "key")
+        assert loaded.ranges == checkpoint.ranges
+        assert loaded.done == {1: 25}
+
+        assert ExportCheckpoint.load(path, "other").ranges is None
+        loaded.remove()
+        assert not os.path.exists(path)
+
+
+class TestMultipartUpload:
+    @pytest.fixture(autouse=True)
+    def small_parts(self):
+        with mock.patch.object(MultipartUpload, "min_part_size", 1):
+            yield
+
+    def test_upload(self):
+        client = FakeS3Client()
+        data = bytes(range(256)) * 10
+        with MultipartUpload(
+            client, "bucket", "key", part_size=100, concurrency=3, max_pending=2
+        ) as upload:
+            for i in range(0, len(data), 7):
+                upload.write(data[i : i + 7])
+
+        assert len(client.parts) == 26
+        assert client.objects[("bucket", "key")] == data
+        assert not client.aborted
+
+    def test_empty(self):
+        client = FakeS3Client()
+        with MultipartUpload(client, "bucket", "key"):
+            pass
+        assert client.objects[("bucket", "key")] == b""
+
+    def test_gzip(self):
+        client = FakeS3Client()
+        with MultipartUpload(client, "bucket", "key", part_size=64) as upload:
+            with gzip.open(upload, "wt", encoding="utf-8") as gzip_file:
+                for i in range(1000):
+                    gzip_file.write("%d,cell\r\n" % i)
+
+        text = gzip.decompress(client.objects[("bucket", "key")]).decode("utf-8")
+        assert text.splitlines()[-1] == "999,cell"
+
+    def test_abort(self):
+        client = FakeS3Client()
+        with pytest.raises(ValueError):
+            with MultipartUpload(client, "bucket", "key", part_size=10) as upload:
+                upload.write(b"x" * 25)
+                raise ValueError("export failed")
+
+        assert client.objects == {}
+        assert client.aborted == [("bucket", "key")]
+
+    def test_part_failure(self):
+        client = FakeS3Client(fail_part=2)
+        with pytest.raises(ValueError):
+            with MultipartUpload(
+                client, "bucket", "key", part_size=10, concurrency=1
+            ) as upload:
+                for i in range(100):
+                    upload.write(b"x" * 10)
+
+        assert client.objects == {}
+        assert client.aborted == [("bucket", "key")]
+
+    def test_last_part_failure(self):
+        client = FakeS3Client(fail_part=3)
+        with pytest.raises(ValueError):
+            with MultipartUpload(client, "bucket", "key", part_size=10) as upload:
+                upload.write(b"x" * 25)
+
+        assert client.objects == {}
+        assert client.aborted == [("bucket", "key")]
@@ -2,17 +2,21 @@ from collections import defaultdict
 from datetime import datetime, timedelta
 from unittest import mock
 
+import numpy
 import pytest
 from pymysql.err import MySQLError
 from zoneinfo import ZoneInfo
 from sqlalchemy.exc import InterfaceError
 
 from geocalc import destination
-from ichnaea.data.station import CellUpdater
+from ichnaea.cache import station_cache_key
+from ichnaea.data.area import CellAreaDelta
+from ichnaea.data.station import BlueUpdater, CellUpdater, WifiUpdater
 from ichnaea.data.tasks import update_blue, update_cell, update_wifi
 from ichnaea.models import (
     decode_cellid,
     encode_cellarea,
+    encode_mac,
     BlueShard,
     CellShard,
     Radio,
@@ -28,6 +32,8 @@ from ichnaea.tests.factories import (
     BlueShardFactory,
     CellObservationFactory,
     CellShardFactory,
+    GB_LAT,
+    GB_LON,
     WifiObservationFactory,
     WifiShardFactory,
 )
@@ -200,6 +206,10 @@ class StationTest(BaseStationTest):
     def check_areas(self, celery, obs):
         pass
 
+    def cache_key(self, model):
+        key = getattr(model, self.unique_key)
+        return station_cache_key(self.shard_model.shard_model(key).__tablename__, key)
+
     def check_blocked(self, station, first=None, last=None, count=None):
         assert station.block_first == first
         assert station.block_last == last
@@ -278,6 +288,26 @@ class StationTest(BaseStationTest):
         )
         metricsmock.assert_incr_once("data.station.new", value=1, tags=[self.type_tag])
 
+    def test_shared_cache(self, celery, redis, session):
+        obs = self.make_obs(distance=1.0)
+        self.station_factory(**self.key(obs[0]))
+        confirm = self.obs_factory.build(source=ReportSource.query)
+        self.station_factory(
+            created=self.ten_days,
+            modified=self.ten_days,
+            last_seen=self.ten_days.date(),
+            **self.key(confirm),
+        )
+        session.commit()
+        redis.set(self.cache_key(obs[0]), b"")
+        redis.set(self.cache_key(confirm), b"")
+        self.queue_and_update(celery, obs + [confirm])
+
+        # The blocked station is dropped from the shared locate cache,
+        # the only confirmed station is kept.
+        assert not redis.exists(self.cache_key(obs[0]))
+        assert redis.exists(self.cache_key(confirm))
+
     @pytest.mark.parametrize("source", (ReportSource.gnss, ReportSource.query))
     def test_new_block(self, celery, session, source):
         obs = self.make_obs(source=source, distance=1.0)
@@ -557,6 +587,10 @@ class StationMacTest(StationTest):
     def key(self, model):
         return {"mac": model.mac}
 
+    def cache_key(self, model):
+        shard = self.shard_model.shard_model(model.mac)
+        return station_cache_key(shard.__tablename__, encode_mac(model.mac))
+
 
 class TestBlue(StationMacTest):
 
@@ -809,3 +843,137 @@ class TestCell(StationTest):
         assert station.samples == 3
         assert station.source == source
         assert station.weight == pytest.approx(9.2452954)
+
+    def test_incremental_areas(self, celery, session):
+        moved = self.station_factory(radio=Radio.gsm, samples=1, weight=1.0)
+        area_key = {
+            "radio": moved.radio,
+            "mcc": moved.mcc,
+            "mnc": moved.mnc,
+            "lac": moved.lac,
+        }
+        blocked = self.station_factory(
+            lat=moved.lat, lon=moved.lon, samples=1, weight=1.0, **area_key
+        )
+        new_key = dict(area_key, cid=moved.cid + 100)
+        obs = [
+            self.obs_factory(lat=moved.lat, lon=moved.lon + 0.0002, **self.key(moved)),
+            self.obs_factory(lat=moved.lat + 1.0, lon=moved.lon, **self.key(blocked)),
+            self.obs_factory(lat=moved.lat, lon=moved.lon - 0.0002, **new_key),
+        ]
+        session.commit()
+        with mock.patch.object(CellUpdater, "incremental_areas", True):
+            self.queue_and_update(celery, obs)
+
+        assert celery.data_queues["update_cellarea"].size() == 0
+        deltas = celery.data_queues["update_cellarea_delta"].dequeue()
+        assert len(deltas) == 1
+        delta = CellAreaDelta.from_json(deltas[0])
+        assert delta.area == (moved.radio, moved.mcc, moved.mnc, moved.lac)
+        # One new cell, one blocked cell and one moved cell.
+        assert delta.num_cells == 0
+        assert delta.sum_lat == pytest.approx(0.0)
+        assert delta.sum_lon == pytest.approx(0.0, abs=0.001)
+        assert dict(delta.regions) == {"GB": 0}
+        assert delta.last_seen == self.today
+        assert delta.created is not None
+
+
+class TestColumnar:
+    def station_batch(self, obs_factory, station_factory, key_fields):
+        # Return observations and stations covering all transitions,
+        # with groups of observations of various sizes and spreads.
+        random = numpy.random.RandomState(42)
+        now = util.utcnow()
+        shard_values = defaultdict(list)
+        stations = {}
+        for i in range(300):
+            lat = GB_LAT + random.uniform(-0.5, 0.5)
+            lon = GB_LON + random.uniform(-0.5, 0.5)
+            station = station_factory.build(
+                lat=lat,
+                lon=lon,
+                max_lat=lat + 0.001,
+                min_lat=lat - 0.001,
+                max_lon=lon + 0.001,
+                min_lon=lon - 0.001,
+                source=(ReportSource.gnss, ReportSource.query)[i % 2],
+                samples=int(random.randint(1, 100)),
+                weight=random.uniform(0.5, 20000.0),
+                last_seen=(now - timedelta(days=10)).date(),
+            )
+            key = {field: getattr(station, field) for field in key_fields}
+            kind = i % 6
+            if kind == 1:
+                station.lat = station.lon = None
+            elif kind == 2:
+                station.modified = now - timedelta(days=400)
+            elif kind == 3:
+                station.last_seen = now.date()
+            if kind:
+                stations[station.unique_key] = station
+
+            sources = [
+                [ReportSource.gnss],
+                [ReportSource.query],
+                [ReportSource.gnss, ReportSource.query, ReportSource.fused],
+            ][i % 5 % 3]
+            spread = [0.0, 0.0, 50.0, 3000.0, 30000.0, 300000.0][i % 7 % 6]
+            for j in range([1, 2, 3, 5, 9, 17, 40][i % 11 % 7]):
+                obs_lat, obs_lon = destination(
+                    lat, lon, random.uniform(0, 360), random.uniform(0, spread)
+                )
+                obs = obs_factory.build(
+                    lat=obs_lat,
+                    lon=obs_lon,
+                    accuracy=random.uniform(5.0, 100.0),
+                    source=sources[j % len(sources)],
+                    **key,
+                )
+                if obs is not None:
+                    # Positions outside of all regions are invalid.
+                    shard_values[obs.unique_key].append(obs)
+
+        blocklist = {
+            key: station_blocked(station, now.date())
+            for key, station in stations.items()
+        }
+        return (shard_values, blocklist, stations)
+
+    @pytest.mark.parametrize(
+        "updater_type,obs_factory,station_factory,key_fields",
+        [
+            (BlueUpdater, BlueObservationFactory, BlueShardFactory, ["mac"]),
+            (
+                CellUpdater,
+                CellObservationFactory,
+                CellShardFactory,
+                ["radio", "mcc", "mnc", "lac", "cid"],
+            ),
+            (WifiUpdater, WifiObservationFactory, WifiShardFactory, ["mac"]),
+        ],
+    )
+    def test_same_results(self, updater_type, obs_factory, station_factory, key_fields):
+        task = mock.Mock()
+        task.app.data_queues = defaultdict(mock.Mock)
+        updater = updater_type(task, shard_id="0")
+        shard_values, blocklist, stations = self.station_batch(
+            obs_factory, station_factory, key_fields
+        )
+
+        def results(states):
+            result = []
+            for state in states:
+                transition = state.transition()
+                status, values = transition() if transition else (None, None)
+                result.append((state.station_key, status, values))
+            return result
+
+        expected = results(updater.station_states(shard_values, blocklist, stations))
+        columnar = results(
+            updater.columnar_station_states(shard_values, blocklist, stations)
+        )
+        assert columnar == expected
+        assert set(status for _, status, _ in expected) == set(
+            [None, "block", "change", "confirm", "new", "new_block", "replace"]
+        )
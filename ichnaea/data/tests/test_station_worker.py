@@ -0,0 +1,90 @@
+from unittest import mock
+
+from ichnaea.data.station import WifiUpdater
+from ichnaea.data.station_worker import (
+    shard_groups,
+    StationWorker,
+    StationWorkerTask,
+)
+from ichnaea.models import BlueShard, CellShard, WifiShard
+from ichnaea.tests.factories import WifiObservationFactory
+
+
+class TestShardGroups(object):
+    def test_all_shards(self):
+        groups = shard_groups(["blue", "cell", "wifi"], 4)
+        assert len(groups) == 4
+        shards = [shard for group in groups for shard in group]
+        expected = (
+            [("blue", shard_id) for shard_id in BlueShard.shards()]
+            + [("cell", shard_id) for shard_id in CellShard.shards()]
+            + [("wifi", shard_id) for shard_id in WifiShard.shards()]
+        )
+        assert len(shards) == len(expected)
+        assert set(shards) == set(expected)
+
+    def test_more_processes_than_shards(self):
+        groups = shard_groups(["wifi"], 100)
+        assert len(groups) == len(WifiShard.shards())
+        assert all([len(group) == 1 for group in groups])
+
+    def test_stable(self):
+        assert shard_groups(["wifi", "cell"], 3) == shard_groups(["cell", "wifi"], 3)
+
+
+class TestStationWorker(object):
+    def _queue(self, celery, observations):
+        shard_id = WifiShard.shard_id(observations[0].mac)
+        queue = celery.data_queues["update_wifi_" + shard_id]
+        queue.enqueue([obs.to_json() for obs in observations])
+        return (shard_id, queue)
+
+    def test_run_once(self, celery, session):
+        obs = WifiObservationFactory.build()
+        shard_id, queue = self._queue(celery, [obs])
+        worker = StationWorker(celery, [("wifi", shard_id)], interval=60.0)
+
+        assert worker.run_once() == 1
+        assert queue.size() == 0
+        shard = WifiShard.shard_model(obs.mac)
+        assert session.query(shard).filter(shard.mac == obs.mac).count() == 1
+
+        # The shard isn't due again before the interval has passed.
+        assert worker.run_once() == 0
+
+    def test_ready(self, celery, session):
+        obs = WifiObservationFactory.build()
+        shard_id, queue = self._queue(celery, [obs] * 4)
+        worker = StationWorker(celery, [("wifi", shard_id)], interval=60.0)
+
+        with mock.patch.object(queue, "batch", 2):
+            assert worker.run_once() == 1
+            assert queue.size() == 2
+            # The queue still holds a full batch, so the shard is due again.
+            assert worker.run_once() == 1
+            assert queue.size() == 0
+            assert worker.run_once() == 0
+
+    def test_error(self, celery, raven):
+        worker = StationWorker(celery, [("wifi", "0"), ("wifi", "1")])
+        with mock.patch.object(
+            WifiUpdater, "__call__", side_effect=ValueError("broken")
+        ):
+            assert worker.run_once() == 2
+        raven.check([("ValueError", 2)])
+
+    def test_run_stops(self, celery):
+        worker = StationWorker(celery, [("wifi", "0")], idle_wait=0.01)
+        worker.stop_event.set()
+        with mock.patch.object(worker, "run_once") as run_once:
+            worker.run()
+        assert not run_once.called
+
+
+class TestStationWorkerTask(object):
+    def test_apply_async(self, celery):
+        task = StationWorkerTask(celery)
+        assert not task.ready
+        task.apply_async(kwargs={"shard_id": "0"})
+        assert task.ready
+        assert task.redis_client is celery.redis_client
@@ -2,6 +2,7 @@
 
 import os
 from contextlib import contextmanager
+from contextvars import ContextVar
 
 from alembic.config import main as alembic_main
 import backoff
@@ -22,6 +23,9 @@ from ichnaea.conf import settings
 DB_TYPE = {"ro": settings("db_readonly_uri"), "rw": settings("db_readwrite_uri")}
 METRICS = markus.get_metrics()
 
+# Holds the LockRetries counter of the current count_mysql_lock_retries block.
+_LOCK_RETRIES = ContextVar("lock_retries", default=None)
+
 
 class SqlAlchemyUrlNotSpecified(Exception):
     """Raised when SQLALCHEMY_URL is not specified in environment."""
@@ -275,6 +279,29 @@ def drop_db(uri=None):
         conn.execute(f"DROP DATABASE IF EXISTS {db_to_drop}")
 
 
+class LockRetries(object):
+    """The number of MySQL lock failures retried in a block of code."""
+
+    def __init__(self):
+        self.count = 0
+
+
+@contextmanager
+def count_mysql_lock_retries():
+    """
+    Count the MySQL lock failures handled by :func:`retry_on_mysql_lock_fail`
+    inside the with block.
+
+    :return: A :class:`LockRetries` instance, updated while the block runs
+    """
+    retries = LockRetries()
+    token = _LOCK_RETRIES.set(retries)
+    try:
+        yield retries
+    finally:
+        _LOCK_RETRIES.reset(token)
+
+
 def retry_on_mysql_lock_fail(metric=None, metric_tags=None):
     """Function decorator to backoff and retry on MySQL lock failures.
 
@@ -323,6 +350,9 @@ def retry_on_mysql_lock_fail(metric=None, metric_tags=None):
         if is_mysql_lock_error(exception):
             if metric:
                 count_exception(exception)
+            retries = _LOCK_RETRIES.get()
+            if retries is not None:
+                retries.count += 1
             return False  # Retry if possible
         return True  # Give up on other unknown errors.
 
@@ -5,14 +5,23 @@ codes.
 
 import atexit
 from collections import namedtuple
+import hashlib
 import json
+import math
+import mmap
 import os
+import struct
 
+from cachetools import LRUCache
 import genc
 import mobile_codes
+import numpy
 from shapely import geometry
 from shapely import prepared
+from shapely import vectorized
+from shapely import wkb
 from rtree import index
+from scipy.spatial import cKDTree
 
 import geocalc
 from ichnaea import util
@@ -23,6 +32,14 @@ REGIONS_FILE = os.path.join(
 REGIONS_BUFFER_FILE = os.path.join(
     os.path.abspath(os.path.dirname(__file__)), "regions_buffer.geojson.gz"
 )
+REGIONS_INDEX_FILE = os.path.join(
+    os.path.abspath(os.path.dirname(__file__)), "regions.idx"
+)
+
+# A region index file starts with a magic number and the length of a
+# JSON header, followed by the WKB shapes and the RTree envelopes.
+INDEX_HEADER = struct.Struct("<8sI")
+INDEX_MAGIC = b"ICHREG01"
 
 DATELINE_EAST = geometry.box(180.0, -90.0, 270.0, 90.0)
 DATELINE_WEST = geometry.box(-270.0, -90.0, -180.0, 90.0)
@@ -33,28 +50,126 @@ MCC_TO_GENC_MAP = {"PS": "XW"}
 Region = namedtuple("Region", "code name radius")
 
 
+def _unit_vectors(lats, lons):
+    """Return the ECEF coordinates of positions on the unit sphere."""
+    lats = numpy.radians(lats)
+    lons = numpy.radians(lons)
+    return numpy.stack(
+        (
+            numpy.cos(lats) * numpy.cos(lons),
+            numpy.cos(lats) * numpy.sin(lons),
+            numpy.sin(lats),
+        ),
+        axis=-1,
+    )
+
+
+# Grid cells are enlarged by this many degrees, so points on the cell
+# border are inside the cell despite floating point rounding.
+GRID_MARGIN = 1e-9
+
+
+class _LazyDict(dict):
+    """A dictionary creating the values for the known keys on first access."""
+
+    def __init__(self, keys, factory):
+        super(_LazyDict, self).__init__()
+        self._keys = frozenset(keys)
+        self._factory = factory
+
+    def __missing__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        value = self[key] = self._factory(key)
+        return value
+
+
 class Geocoder(object):
     """
     The Geocoder offers reverse geocoding lat/lon positions
     into region codes.
+
+    The region data is loaded on first use. If a region index file
+    created by :func:`build_region_index` matches the GeoJSON files, it
+    is memory-mapped and each region shape is only parsed once a lookup
+    needs it. Otherwise the GeoJSON files are loaded.
     """
 
-    _buffered_shapes = None  # maps region code to a buffered prepared shape
-    _prepared_shapes = None  # maps region code to a precise prepared shape
-    _shapes = None  # maps region code to a precise shape
-    _tree = None  # RTree of buffered region envelopes
-    _tree_ids = None  # maps RTree entry id to region code
-    _valid_regions = None  # Set of known and valid region codes
-    _radii = None  # A cache of region radii
+    # Region data attributes, loaded on first use:
+    # _buffered_shapes maps region code to a buffered prepared shape
+    # _prepared_shapes maps region code to a precise prepared shape
+    # _shapes maps region code to a precise shape
+    # _tree is the RTree of buffered region envelopes
+    # _tree_ids maps RTree entry id to region code
+    # _valid_regions is the set of known and valid region codes
+    # _radii is a cache of region radii
+    _lazy_attributes = frozenset(
+        [
+            "_buffered_shapes",
+            "_prepared_shapes",
+            "_shapes",
+            "_tree",
+            "_tree_ids",
+            "_valid_regions",
+            "_radii",
+        ]
+    )
+
+    _envelopes = None  # RTree entries, kept when loading the GeoJSON files
+    _grid = None  # maps grid cell to a region code, None or candidate codes
+    _boundaries = None  # maps region code to a KD-tree of boundary vertices
+    _index = None  # memory-mapped region index file
+
+    def __init__(
+        self,
+        regions_file=REGIONS_FILE,
+        buffer_file=REGIONS_BUFFER_FILE,
+        grid_resolution=0.01,
+        grid_size=100000,
+        index_file=REGIONS_INDEX_FILE,
+    ):
+        """
+        :param grid_resolution: Size of the grid cells in degrees, used
+            to cache the region lookups, 0 disables the grid.
+        :param grid_size: The maximum number of cached grid cells.
+        :param index_file: Path of the region index file, None to always
+            load the GeoJSON files.
+        """
+        self._regions_file = regions_file
+        self._buffer_file = buffer_file
+        self._index_file = index_file
+        self._grid_resolution = grid_resolution
+        self._grid = LRUCache(maxsize=max(grid_size, 1))
+        self._boundaries = {}
+
+    def __getattr__(self, name):
+        # Only called for attributes which aren't set yet.
+        if name in self._lazy_attributes:
+            self._load()
+            return self.__dict__[name]
+        raise AttributeError(name)
 
-    def __init__(self, regions_file=REGIONS_FILE, buffer_file=REGIONS_BUFFER_FILE):
+    @property
+    def loaded(self):
+        return "_tree" in self.__dict__
+
+    def _load(self):
+        header = None
+        if self._index_file and os.path.exists(self._index_file):
+            header = self._open_index()
+        if header is not None:
+            self._load_index(header)
+        else:
+            self._load_geojson()
+
+    def _load_geojson(self):
         self._buffered_shapes = {}
         self._prepared_shapes = {}
         self._shapes = {}
         self._tree_ids = {}
         self._radii = {}
 
-        with util.gzip_open(regions_file, "r") as fd:
+        with util.gzip_open(self._regions_file, "r") as fd:
             regions_data = json.load(fd)
 
         genc_regions = frozenset([rec.alpha2 for rec in genc.REGIONS])
@@ -66,7 +181,7 @@ class Geocoder(object):
                 self._prepared_shapes[code] = prepared.prep(shape)
                 self._radii[code] = feature["properties"]["radius"]
 
-        with util.gzip_open(buffer_file, "r") as fd:
+        with util.gzip_open(self._buffer_file, "r") as fd:
             buffer_data = json.load(fd)
 
         i = 0
@@ -92,20 +207,88 @@ class Geocoder(object):
                     self._tree_ids[i] = code
                     i += 1
 
+        self._envelopes = envelopes
+        self._valid_regions = frozenset(self._shapes.keys())
+        self._tree = self._build_tree(envelopes)
+
+    def _open_index(self):
+        """
+        Memory-map the region index file and return its header, or None
+        if the file isn't an index of the current GeoJSON files.
+        """
+        with open(self._index_file, "rb") as fd:
+            index_map = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, header_length = INDEX_HEADER.unpack_from(index_map)
+            if magic != INDEX_MAGIC:
+                raise ValueError("Not a region index file.")
+            header = json.loads(
+                index_map[INDEX_HEADER.size : INDEX_HEADER.size + header_length]
+            )
+            if header["sources"] != _source_digests(
+                self._regions_file, self._buffer_file
+            ):
+                raise ValueError("Outdated region index file.")
+        except (KeyError, struct.error, ValueError):
+            index_map.close()
+            return None
+
+        self._index = index_map
+        header["offset"] = INDEX_HEADER.size + header_length
+        return header
+
+    def _load_index(self, header):
+        index_map = self._index
+        base = header["offset"]
+
+        def load_wkb(location):
+            start = base + location[0]
+            return wkb.loads(index_map[start : start + location[1]])
+
+        regions = header["regions"]
+        buffered = header["buffered"]
+        self._radii = dict(
+            [(code, region["radius"]) for code, region in regions.items()]
+        )
+        self._shapes = _LazyDict(
+            regions.keys(), lambda code: load_wkb(regions[code]["shape"])
+        )
+        self._prepared_shapes = _LazyDict(
+            regions.keys(), lambda code: prepared.prep(self._shapes[code])
+        )
+        self._buffered_shapes = _LazyDict(
+            buffered.keys(), lambda code: prepared.prep(load_wkb(buffered[code]))
+        )
+        self._valid_regions = frozenset(regions.keys())
+
+        offset, count = header["envelopes"]
+        bounds = numpy.frombuffer(
+            index_map, dtype=numpy.double, count=count * 4, offset=base + offset
+        ).reshape(count, 4)
+        self._tree_ids = dict(enumerate(header["tree_codes"]))
+        self._tree = self._build_tree(
+            [(i, tuple(bound), None) for i, bound in enumerate(bounds.tolist())]
+        )
+
+    def _build_tree(self, envelopes):
         props = index.Property()
         props.fill_factor = 0.9
         props.leaf_capacity = 20
-        self._tree = index.Index(envelopes, interleaved=True, properties=props)
+        tree = index.Index(envelopes, interleaved=True, properties=props)
         for envelope in envelopes:
-            self._tree.insert(*envelope)
-        self._valid_regions = frozenset(self._shapes.keys())
+            tree.insert(*envelope)
+        return tree
 
     def close(self):
         """
         Close the Geocoder and its handles on ctypes pointers.
         """
-        self._tree.properties.handle.destroy()
-        self._tree.close()
+        if self.loaded:
+            self._tree.properties.handle.destroy()
+            self._tree.close()
+        if self._index is not None:
+            self._index.close()
+            self._index = None
 
     @property
     def valid_regions(self):
@@ -116,23 +299,119 @@ class Geocoder(object):
         Return a region code matching the provided position.
         If the position is not found inside any region return None.
         """
-        # Look up point in RTree of buffered region envelopes.
-        # This is a coarse-grained but very fast match.
-        point = geometry.Point(lon, lat)
-        codes = set(
-            [self._tree_ids[id_] for id_ in self._tree.intersection(point.bounds)]
-        )
-
-        if not codes:
-            return None
+        candidates = self._grid_lookup(lat, lon)
+        if not isinstance(candidates, tuple):
+            return candidates
 
         # match point against the buffered polygon shapes
+        point = geometry.Point(lon, lat)
         buffered_codes = set(
-            [code for code in codes if self._buffered_shapes[code].contains(point)]
+            [code for code in candidates if self._buffered_shapes[code].contains(point)]
         )
         if len(buffered_codes) < 2:
             return tuple(buffered_codes)[0] if buffered_codes else None
 
+        return self._tie_break(lat, lon, point, buffered_codes)
+
+    def regions(self, lats, lons):
+        """
+        Return a list of region codes matching the provided positions,
+        the same as calling :meth:`region` for each position.
+        """
+        lats = numpy.asarray(lats, dtype=numpy.double)
+        lons = numpy.asarray(lons, dtype=numpy.double)
+        result = [None] * len(lats)
+
+        # Group the positions in border cells by their candidate codes.
+        border = {}
+        for i, (lat, lon) in enumerate(zip(lats.tolist(), lons.tolist())):
+            candidates = self._grid_lookup(lat, lon)
+            if isinstance(candidates, tuple):
+                border.setdefault(candidates, []).append(i)
+            else:
+                result[i] = candidates
+
+        for candidates, indices in border.items():
+            indices = numpy.array(indices)
+            matches = numpy.array(
+                [
+                    vectorized.contains(
+                        self._buffered_shapes[code], lons[indices], lats[indices]
+                    )
+                    for code in candidates
+                ]
+            ).reshape(len(candidates), len(indices))
+            for column, i in enumerate(indices.tolist()):
+                buffered_codes = set(
+                    [
+                        code
+                        for code, match in zip(candidates, matches[:, column])
+                        if match
+                    ]
+                )
+                if len(buffered_codes) == 1:
+                    result[i] = buffered_codes.pop()
+                elif len(buffered_codes) > 1:
+                    lat, lon = float(lats[i]), float(lons[i])
+                    result[i] = self._tie_break(
+                        lat, lon, geometry.Point(lon, lat), buffered_codes
+                    )
+
+        return result
+
+    def _tree_codes(self, bounds):
+        # Look up the bounds in the RTree of buffered region envelopes.
+        # This is a coarse-grained but very fast match.
+        return set([self._tree_ids[id_] for id_ in self._tree.intersection(bounds)])
+
+    def _grid_lookup(self, lat, lon):
+        """
+        Return the region code of all positions in the grid cell of
+        the position, None if the cell is outside all regions, or a
+        sorted tuple of candidate codes for cells on a region border.
+        """
+        resolution = self._grid_resolution
+        if not resolution:
+            point = geometry.Point(lon, lat)
+            return tuple(sorted(self._tree_codes(point.bounds)))
+
+        key = (math.floor(lat / resolution), math.floor(lon / resolution))
+        try:
+            return self._grid[key]
+        except KeyError:
+            pass
+
+        cell = geometry.box(
+            key[1] * resolution - GRID_MARGIN,
+            key[0] * resolution - GRID_MARGIN,
+            (key[1] + 1) * resolution + GRID_MARGIN,
+            (key[0] + 1) * resolution + GRID_MARGIN,
+        )
+        codes = tuple(
+            sorted(
+                [
+                    code
+                    for code in self._tree_codes(cell.bounds)
+                    if self._buffered_shapes[code].intersects(cell)
+                ]
+            )
+        )
+        if not codes:
+            value = None
+        elif len(codes) == 1 and self._buffered_shapes[codes[0]].contains_properly(
+            cell
+        ):
+            value = codes[0]
+        else:
+            value = codes
+        self._grid[key] = value
+        return value
+
+    def _tie_break(self, lat, lon, point, buffered_codes):
+        """
+        Return the region code for a position inside multiple buffered
+        regions.
+        """
         # match point against the precise polygon shapes
         precise_codes = set(
             [
@@ -146,38 +425,51 @@ class Geocoder(object):
             return tuple(precise_codes)[0]
 
         # Use distance from the border of each region as the tie-breaker.
-        distances = {}
-
         # point wasn't in any precise region, which one of the buffered
         # regions is it closest to?
         if not precise_codes:
-            for code in buffered_codes:
-                coords = []
-                if isinstance(
-                    self._shapes[code].boundary, geometry.base.BaseMultipartGeometry
-                ):
-                    for geom in self._shapes[code].boundary.geoms:
-                        coords.extend([coord for coord in geom.coords])
-                else:
-                    coords = self._shapes[code].boundary.coords
-                for coord in coords:
-                    distances[geocalc.distance(coord[1], coord[0], lat, lon)] = code
-            return distances[min(distances.keys())]
+            return min(
+                sorted(buffered_codes),
+                key=lambda code: self._boundary_distance(code, lat, lon),
+            )
 
         # point was in multiple overlapping regions, take the one where it
         # is farthest away from the border / the most inside a region
-        for code in precise_codes:
-            coords = []
-            if isinstance(
-                self._shapes[code].boundary, geometry.base.BaseMultipartGeometry
-            ):
-                for geom in self._shapes[code].boundary.geoms:
-                    coords.extend([coord for coord in geom.coords])
+        return max(
+            sorted(precise_codes),
+            key=lambda code: self._boundary_distance(code, lat, lon, farthest=True),
+        )
+
+    def _boundary_distance(self, code, lat, lon, farthest=False):
+        """
+        Return the distance in meters from the position to the closest,
+        or the farthest boundary vertex of the region.
+        """
+        tree, coords = self._boundary_tree(code)
+        # On a sphere the straight line distance grows with the great
+        # circle distance, the farthest vertex is the closest one to
+        # the antipode.
+        point = _unit_vectors(lat, lon)
+        if farthest:
+            point = -point
+        _, i = tree.query(point)
+        return geocalc.distance(coords[i][1], coords[i][0], lat, lon)
+
+    def _boundary_tree(self, code):
+        """
+        Return a KD-tree of the boundary vertices of the region and
+        the vertex coordinates. The trees are built on first use.
+        """
+        if code not in self._boundaries:
+            boundary = self._shapes[code].boundary
+            if isinstance(boundary, geometry.base.BaseMultipartGeometry):
+                geoms = boundary.geoms
             else:
-                coords = self._shapes[code].boundary.coords
-            for coord in coords:
-                distances[geocalc.distance(coord[1], coord[0], lat, lon)] = code
-        return distances[max(distances.keys())]
+                geoms = [boundary]
+            coords = numpy.concatenate([numpy.asarray(geom.coords) for geom in geoms])
+            tree = cKDTree(_unit_vectors(coords[:, 1], coords[:, 0]))
+            self._boundaries[code] = (tree, coords.tolist())
+        return self._boundaries[code]
 
     def any_region(self, lat, lon):
         """
@@ -282,6 +574,48 @@ class Geocoder(object):
         # fall back to lookup without the mcc/region code hint
         return self.region(lat, lon)
 
+    def regions_for_cells(self, lats, lons, mccs):
+        """
+        Return a list of region codes matching the provided mccs and
+        positions, the same as calling :meth:`region_for_cell` for each
+        cell.
+        """
+        lats = numpy.asarray(lats, dtype=numpy.double)
+        lons = numpy.asarray(lons, dtype=numpy.double)
+        mccs = numpy.asarray(mccs, dtype=numpy.int64)
+        result = [None] * len(lats)
+
+        fallback = []
+        for mcc in numpy.unique(mccs).tolist():
+            codes = [
+                code
+                for code in self.regions_for_mcc(mcc)
+                if code in self._valid_regions
+            ]
+            if not codes:
+                continue
+
+            indices = numpy.flatnonzero(mccs == mcc)
+            matches = numpy.array(
+                [
+                    vectorized.contains(
+                        self._buffered_shapes[code], lons[indices], lats[indices]
+                    )
+                    for code in codes
+                ]
+            ).reshape(len(codes), len(indices))
+            num_matches = matches.sum(axis=0)
+            for column in numpy.flatnonzero(num_matches == 1).tolist():
+                result[indices[column]] = codes[int(matches[:, column].argmax())]
+            fallback.extend(indices[num_matches > 1].tolist())
+
+        if fallback:
+            # fall back to lookup without the mcc/region code hint
+            for i, code in zip(fallback, self.regions(lats[fallback], lons[fallback])):
+                result[i] = code
+
+        return result
+
     def region_max_radius(self, code):
         """
         Return the maximum radius of a circle encompassing the largest
@@ -290,6 +624,75 @@ class Geocoder(object):
         return self._radii.get(code, None)
 
 
+def _source_digests(regions_file, buffer_file):
+    digests = []
+    for path in (regions_file, buffer_file):
+        with open(path, "rb") as fd:
+            digests.append(hashlib.sha1(fd.read()).hexdigest())
+    return digests
+
+
+def build_region_index(
+    index_file=REGIONS_INDEX_FILE,
+    regions_file=REGIONS_FILE,
+    buffer_file=REGIONS_BUFFER_FILE,
+):
+    """
+    Write a region index file for the region GeoJSON files, which lets
+    the :class:`Geocoder` start without parsing the GeoJSON files.
+    """
+    geocoder = Geocoder(regions_file, buffer_file, grid_size=1, index_file=None)
+    geocoder._load()
+
+    blobs = []
+    offset = 0
+
+    def add_blob(blob):
+        nonlocal offset
+        blobs.append(blob)
+        location = [offset, len(blob)]
+        offset += len(blob)
+        return location
+
+    regions = {}
+    for code in sorted(geocoder._shapes.keys()):
+        regions[code] = {
+            "radius": geocoder._radii[code],
+            "shape": add_blob(geocoder._shapes[code].wkb),
+        }
+    buffered = {}
+    for code in sorted(geocoder._buffered_shapes.keys()):
+        buffered[code] = add_blob(geocoder._buffered_shapes[code].context.wkb)
+
+    # Align the envelope array for the memory-mapped access.
+    add_blob(b"\0" * (-offset % 8))
+    envelopes = numpy.array(
+        [bounds for _, bounds, _ in geocoder._envelopes], dtype="<f8"
+    )
+    header = {
+        "sources": _source_digests(regions_file, buffer_file),
+        "regions": regions,
+        "buffered": buffered,
+        "envelopes": [offset, len(envelopes)],
+        "tree_codes": [geocoder._tree_ids[i] for i, _, _ in geocoder._envelopes],
+    }
+    add_blob(envelopes.tobytes())
+    geocoder.close()
+
+    header_data = json.dumps(header, sort_keys=True).encode("utf-8")
+    # Pad the header, so the data starts at an aligned offset.
+    header_data += b" " * (-(INDEX_HEADER.size + len(header_data)) % 8)
+
+    # Write to a temporary file first, so no one maps a partial file.
+    temp_file = index_file + ".tmp"
+    with open(temp_file, "wb") as fd:
+        fd.write(INDEX_HEADER.pack(INDEX_MAGIC, len(header_data)))
+        fd.write(header_data)
+        for blob in blobs:
+            fd.write(blob)
+    os.replace(temp_file, index_file)
+
+
 @atexit.register
 def geocode_exit():
     GEOCODER.close()
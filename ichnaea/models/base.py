@@ -2,6 +2,8 @@
 Model and schema related common classes.
 """
 
+from operator import attrgetter
+
 import colander
 from sqlalchemy.ext.declarative import declared_attr, declarative_base
 
@@ -26,20 +28,36 @@ class HashableDict(object):
     """
     A class representing a unique combination of fields, much like a
     namedtuple. Instances of this class can be used as dictionary keys.
+
+    Instances are treated as immutable, their hash is only calculated
+    once. Subclasses which aren't used as one of several bases of
+    another class can store their fields in ``__slots__``, these need
+    to include a ``_hash`` slot.
     """
 
+    __slots__ = ()
     _fields = ()
 
+    def __init_subclass__(cls, **kw):
+        super().__init_subclass__(**kw)
+        if len(cls._fields) == 1:
+            getter = attrgetter(cls._fields[0])
+            cls._values = property(lambda self: (getter(self),))
+        elif cls._fields:
+            cls._values = property(attrgetter(*cls._fields))
+
     def __init__(self, **kw):
         for field in self._fields:
-            if field in kw:
-                setattr(self, field, kw[field])
-            else:
-                setattr(self, field, None)
+            setattr(self, field, kw.get(field))
+
+    @property
+    def _values(self):
+        """A tuple of the instance values in the _fields order."""
+        return ()
 
     def __eq__(self, other):
         if isinstance(other, HashableDict):
-            return self.__dict__ == other.__dict__
+            return self._fields == other._fields and self._values == other._values
         return False
 
     def __ne__(self, other):
@@ -50,10 +68,36 @@ class HashableDict(object):
         Returns a hash of a tuple of the instance values in the same
         order as the _fields definition.
         """
-        value = ()
-        for field in self._fields:
-            value += (getattr(self, field, None),)
-        return hash(value)
+        try:
+            return self._hash
+        except AttributeError:
+            self._hash = value = hash(self._values)
+            return value
+
+
+class cached_slot_property(object):
+    """
+    A read-only property, whose value is calculated once and cached
+    in the instance attribute named after the property with a leading
+    underscore. For slotted classes this needs to be one of the slots.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.__doc__ = func.__doc__
+
+    def __set_name__(self, owner, name):
+        self.attribute = "_" + name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        try:
+            return getattr(instance, self.attribute)
+        except AttributeError:
+            value = self.func(instance)
+            setattr(instance, self.attribute, value)
+            return value
 
 
 class ValidationMixin(object):
@@ -61,6 +105,7 @@ class ValidationMixin(object):
     A mixin to tie a class and its valid colander schema together.
     """
 
+    __slots__ = ()
     _valid_schema = None
 
     @classmethod
@@ -84,6 +129,8 @@ class CreationMixin(ValidationMixin):
     keyword arguments before creating an instance of the class.
     """
 
+    __slots__ = ()
+
     @classmethod
     def create(cls, _raise_invalid=False, **kw):
         """
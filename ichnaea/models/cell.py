@@ -198,9 +198,15 @@ from sqlalchemy import (
     Index,
     PrimaryKeyConstraint,
     String,
+    Text,
     UniqueConstraint,
 )
-from sqlalchemy.dialects.mysql import INTEGER as Integer, SMALLINT as SmallInteger
+from sqlalchemy.dialects.mysql import (
+    BIGINT as BigInteger,
+    DOUBLE as Double,
+    INTEGER as Integer,
+    SMALLINT as SmallInteger,
+)
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.types import TypeDecorator
 
@@ -208,7 +214,7 @@ from ichnaea.geocode import GEOCODER
 from ichnaea.models.base import _Model, CreationMixin
 from ichnaea.models import constants
 from ichnaea.models.constants import Radio
-from ichnaea.models.sa_types import TinyIntEnum
+from ichnaea.models.sa_types import TinyIntEnum, TZDateTime as DateTime
 from ichnaea.models.schema import DateFromString, DefaultNode, ValidatorNode
 from ichnaea.models.station import (
     PositionMixin,
@@ -472,6 +478,22 @@ class CellAreaMixin(PositionMixin, TimeTrackingMixin, CreationMixin):
     num_cells = Column(Integer(unsigned=True))
     last_seen = Column(Date)
 
+    # Running totals of the cells with a position, maintained by the
+    # incremental area updates. The region counts are a JSON object
+    # mapping the cell regions to the number of cells in them. The
+    # totals modified time is set by the full updates only, older
+    # deltas might already be part of the totals.
+    sum_lat = Column(Double(asdecimal=False))
+    sum_lon = Column(Double(asdecimal=False))
+    sum_radius = Column(BigInteger(unsigned=True))
+    num_radius = Column(Integer(unsigned=True))
+    max_lat = Column(Double(asdecimal=False))
+    min_lat = Column(Double(asdecimal=False))
+    max_lon = Column(Double(asdecimal=False))
+    min_lon = Column(Double(asdecimal=False))
+    region_counts = Column(Text)
+    totals_modified = Column(DateTime)
+
     @declared_attr
     def __table_args__(cls):
         prefix = cls.__tablename__
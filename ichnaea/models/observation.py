@@ -9,7 +9,7 @@ from ichnaea.models.base import CreationMixin, ValidationMixin
 from ichnaea.models.blue import BlueShard
 from ichnaea.models.cell import CellShard, encode_cellid, ValidCellKeySchema
 from ichnaea.models import constants
-from ichnaea.models.base import HashableDict
+from ichnaea.models.base import cached_slot_property, HashableDict
 from ichnaea.models.mac import channel_frequency, MacNode
 from ichnaea.models.schema import (
     DefaultNode,
@@ -20,9 +20,16 @@ from ichnaea.models.schema import (
 from ichnaea.models.wifi import WifiShard
 
 
+def _enum_members(enum):
+    # Integer enum members compare and hash equal to their values,
+    # so the mapping also maps the members to themselves.
+    return dict([(member.value, member) for member in enum])
+
+
 class BaseReport(HashableDict, CreationMixin, ValidationMixin):
     """A base class for reports."""
 
+    __slots__ = ()
     _comparators = ()
 
     def better(self, other):
@@ -38,19 +45,35 @@ class BaseReport(HashableDict, CreationMixin, ValidationMixin):
 class BaseObservation(object):
     """A base class for observations."""
 
-    @classmethod
-    def _from_json_value(cls, dct):
-        if (
-            "source" in dct
-            and dct["source"] is not None
-            and not type(dct["source"]) == ReportSource
-        ):
-            dct["source"] = ReportSource(dct["source"])
-        return cls(**dct)
+    __slots__ = ()
+
+    # Maps a version to the binary record layout of the JSON
+    # representation, as used by :class:`ichnaea.queue.BinaryCodec`.
+    # Add a new version when changing a layout.
+    _binary_layouts = {}
+
+    # Maps the enum fields of the JSON representation to a mapping
+    # of the enum values to the enum members.
+    _json_enums = {"source": _enum_members(ReportSource)}
 
     @classmethod
     def from_json(cls, dct):
-        return cls._from_json_value(dct)
+        """
+        Create an instance from the JSON representation returned by
+        :meth:`to_json`.
+
+        Observations are only serialized after they passed validation,
+        so the JSON representation is trusted. It is neither validated
+        again nor passed through the constructor.
+        """
+        obs = cls.__new__(cls)
+        for field in cls._fields:
+            setattr(obs, field, dct.get(field))
+        for field, members in cls._json_enums.items():
+            value = dct.get(field)
+            if value is not None:
+                setattr(obs, field, members[value])
+        return obs
 
     def _to_json_value(self):
         # create a sparse representation of this instance
@@ -147,12 +170,24 @@ class Report(BaseReport):
         "source",
         "timestamp",
     )
+    _binary_fields = (
+        ("lat", "d"),
+        ("lon", "d"),
+        ("accuracy", "d"),
+        ("altitude", "d"),
+        ("altitude_accuracy", "d"),
+        ("heading", "d"),
+        ("pressure", "d"),
+        ("speed", "d"),
+        ("source", "B"),
+        ("timestamp", "q"),
+    )
 
     @classmethod
     def combine(cls, *reports):
         values = {}
         for report in reports:
-            values.update(report.__dict__)
+            values.update(zip(report._fields, report._values))
         return cls(**values)
 
     @property
@@ -218,7 +253,7 @@ class BlueReport(BaseReport):
     _fields = ("mac", "age", "signal")
     _comparators = (("signal", operator.gt), ("age", operator.lt))
 
-    @property
+    @cached_slot_property
     def unique_key(self):
         return self.mac
 
@@ -240,8 +275,12 @@ class BlueObservation(BlueReport, Report, BaseObservation):
 
     _valid_schema = ValidBlueObservationSchema()
     _fields = BlueReport._fields + Report._fields
+    __slots__ = _fields + ("_hash", "_unique_key", "_weight")
+    _binary_layouts = {
+        1: (("mac", "mac"), ("age", "i"), ("signal", "h")) + Report._binary_fields
+    }
 
-    @property
+    @cached_slot_property
     def weight(self):
         signal_weight = 1.0
         return signal_weight * self.base_weight
@@ -362,17 +401,17 @@ class CellReport(BaseReport):
         ("age", operator.lt),
     )
 
-    @property
+    @cached_slot_property
     def unique_key(self):
         return self.cellid
 
     @property
     def shard_id(self):
-        return CellShard.shard_id(self.cellid)
+        return CellShard.shard_id(self.unique_key)
 
     @property
     def shard_model(self):
-        return CellShard.shard_model(self.cellid)
+        return CellShard.shard_model(self.unique_key)
 
     @property
     def cellid(self):
@@ -400,16 +439,24 @@ class CellObservation(CellReport, Report, BaseObservation):
 
     _valid_schema = ValidCellObservationSchema()
     _fields = CellReport._fields + Report._fields
+    __slots__ = _fields + ("_hash", "_unique_key", "_weight")
+    _binary_layouts = {
+        1: (
+            ("radio", "B"),
+            ("mcc", "H"),
+            ("mnc", "H"),
+            ("lac", "I"),
+            ("cid", "I"),
+            ("psc", "H"),
+            ("age", "i"),
+            ("asu", "h"),
+            ("signal", "h"),
+            ("ta", "h"),
+        )
+        + Report._binary_fields
+    }
 
-    @classmethod
-    def _from_json_value(cls, dct):
-        if (
-            "radio" in dct
-            and dct["radio"] is not None
-            and not type(dct["radio"]) == Radio
-        ):
-            dct["radio"] = Radio(dct["radio"])
-        return super(CellObservation, cls)._from_json_value(dct)
+    _json_enums = dict(BaseObservation._json_enums, radio=_enum_members(Radio))
 
     def _to_json_value(self):
         dct = super(CellObservation, self)._to_json_value()
@@ -417,7 +464,7 @@ class CellObservation(CellReport, Report, BaseObservation):
             dct["radio"] = int(dct["radio"])
         return dct
 
-    @property
+    @cached_slot_property
     def weight(self):
         offsets = {
             # GSM median signal is -95
@@ -502,7 +549,7 @@ class WifiReport(BaseReport):
     _fields = ("mac", "age", "channel", "frequency", "signal", "snr")
     _comparators = (("signal", operator.gt), ("snr", operator.gt), ("age", operator.lt))
 
-    @property
+    @cached_slot_property
     def unique_key(self):
         return self.mac
 
@@ -524,8 +571,20 @@ class WifiObservation(WifiReport, Report, BaseObservation):
 
     _valid_schema = ValidWifiObservationSchema()
     _fields = WifiReport._fields + Report._fields
+    __slots__ = _fields + ("_hash", "_unique_key", "_weight")
+    _binary_layouts = {
+        1: (
+            ("mac", "mac"),
+            ("age", "i"),
+            ("channel", "H"),
+            ("frequency", "H"),
+            ("signal", "h"),
+            ("snr", "h"),
+        )
+        + Report._binary_fields
+    }
 
-    @property
+    @cached_slot_property
     def weight(self):
         # Default to -80 dBm for unknown signal strength
         signal = self.signal if self.signal is not None else -80
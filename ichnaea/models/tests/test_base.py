@@ -1,6 +1,6 @@
 import pytest
 
-from ichnaea.models.base import HashableDict
+from ichnaea.models.base import cached_slot_property, HashableDict
 
 
 class Single(HashableDict):
@@ -13,6 +13,19 @@ class Double(HashableDict):
     _fields = ("one", "two")
 
 
+class Slotted(HashableDict):
+
+    _fields = ("one", "two")
+    __slots__ = _fields + ("_hash", "_total")
+
+    calls = 0
+
+    @cached_slot_property
+    def total(self):
+        Slotted.calls += 1
+        return self.one + self.two
+
+
 class TestHashableDict(object):
     def test_empty(self):
         single = Single()
@@ -67,3 +80,23 @@ class TestHashableDict(object):
         assert empty is not None
         assert empty != {}
         assert empty != object()
+
+    def test_slots(self):
+        slotted = Slotted(one=1, two=2)
+        assert not hasattr(slotted, "__dict__")
+        assert slotted == Slotted(one=1, two=2)
+        assert slotted == Double(one=1, two=2)
+        assert slotted != Slotted(one=1)
+        assert hash(slotted) == hash(Double(one=1, two=2))
+        with pytest.raises(AttributeError):
+            slotted.extra = 1
+
+    def test_cached_property(self):
+        Slotted.calls = 0
+        slotted = Slotted(one=1, two=2)
+        assert slotted.total == 3
+        assert slotted.total == 3
+        assert Slotted.calls == 1
+        assert Slotted(one=2, two=2).total == 4
+        assert Slotted.calls == 2
+        assert isinstance(Slotted.total, cached_slot_property)
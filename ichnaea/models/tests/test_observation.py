@@ -233,6 +233,17 @@ class TestCellObservation(BaseTest):
         assert result.lon == obs.lon
         assert result.source is ReportSource.fixed
         assert type(result.source) is ReportSource
+        assert result == obs
+        assert hash(result) == hash(obs)
+
+    def test_json_trusted(self):
+        # The JSON representation isn't validated again.
+        result = CellObservation.from_json({"radio": 2, "mcc": 1, "lat": 91.0})
+        assert result.radio is Radio.wcdma
+        assert result.mcc == 1
+        assert result.lat == 91.0
+        assert result.cid is None
+        assert result.source is None
 
     def test_weight(self):
         obs_factory = CellObservationFactory.build
@@ -518,6 +529,18 @@ class TestWifiObservation(BaseTest):
         assert round(obs_factory(accuracy=0, speed=20.0).weight, 2) == 0.5
         assert round(obs_factory(accuracy=0, speed=50.1).weight, 2) == 0.0
 
+    def test_combine(self):
+        report = Report.create(lat=GB_LAT, lon=GB_LON, source="gnss")
+        wifi = WifiReport.create(mac="3680873e9b83", signal=-70)
+        obs = WifiObservation.combine(report, wifi)
+        assert obs.mac == "3680873e9b83"
+        assert obs.signal == -70
+        assert obs.lat == GB_LAT
+        assert obs.source is ReportSource.gnss
+        assert obs.unique_key == wifi.unique_key
+        assert obs.weight == WifiObservation.from_json(obs.to_json()).weight
+        assert set(WifiObservation.__slots__) >= set(WifiObservation._fields)
+
 
 class TestWifiReport(BaseTest):
     def sample(self, **kwargs):
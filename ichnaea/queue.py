@@ -2,11 +2,166 @@
 Functionality related to custom Redis based queues.
 """
 
+from contextlib import contextmanager
 import json
+import struct
+import time
+
+import markus
 
 from ichnaea.cache import redis_pipeline
+from ichnaea.db import count_mysql_lock_retries
 from ichnaea import util
 
+METRICS = markus.get_metrics()
+
+
+class BatchController(object):
+    """
+    Adapts the batch size of a queue consumer to the measured processing
+    time of each batch, the MySQL lock failures retried while processing
+    it and the number of items left in the queue.
+
+    The batch size is halved after lock failures, as smaller transactions
+    hold fewer locks for a shorter time. It shrinks towards the `target`
+    processing time in seconds if a batch took longer than that. It grows
+    while the queue holds a backlog of more than a batch and batches are
+    processed in less than half the target time. Once the backlog is gone,
+    it returns towards the configured batch size, keeping the latency low.
+
+    The batch size stays between `min_batch` and `max_batch`.
+    """
+
+    def __init__(self, batch, target, min_batch=None, max_batch=None):
+        self.base = batch
+        self.target = target
+        self.min_batch = min_batch or max(batch // 10, 1)
+        self.max_batch = max_batch or batch * 10
+
+    def adapt(self, batch, size, duration, retries, depth):
+        """
+        Return the next batch size.
+
+        :param batch: The current batch size.
+        :param size: The number of items processed.
+        :param duration: The processing time in seconds.
+        :param retries: The number of retried MySQL lock failures.
+        :param depth: The number of items left in the queue.
+        """
+        if retries:
+            batch = batch // 2
+        elif size and duration > self.target:
+            batch = int(batch * max(self.target / duration, 0.5))
+        elif depth > batch:
+            if duration < self.target / 2.0:
+                batch = int(batch * 1.5)
+        else:
+            batch = batch + int((self.base - batch) / 2)
+        return min(max(batch, self.min_batch), self.max_batch)
+
+
+class BinaryCodec(object):
+    """
+    Encodes flat dictionaries with a known set of fields into compact
+    binary records, as an alternative to JSON.
+
+    `layouts` maps a version number to a layout, a sequence of
+    (field, format) tuples. The format is a :mod:`struct` format
+    character, or ``mac`` for a MAC address given as a 12 character hex
+    string. A record starts with a header of a marker byte, which can't
+    start a JSON or gzip encoded item, the layout version and a bitmask
+    of the fields present in the record. The values of these fields
+    follow in layout order.
+
+    Records are encoded with the newest version and decoded with the
+    version given in their header, so records written by older
+    producers stay readable.
+    """
+
+    marker = 0xFF
+    header = struct.Struct("<BBI")
+
+    def __init__(self, layouts):
+        self.layouts = dict(layouts)
+        self.version = max(self.layouts.keys())
+        self._records = {}
+
+    @classmethod
+    def is_record(cls, value):
+        """Return True if the value starts with the record marker."""
+        return value[:1] == b"\xff"
+
+    def _record(self, version, mask):
+        # Return the struct and field formats of the given present fields.
+        record = self._records.get((version, mask))
+        if record is None:
+            layout = self.layouts[version]
+            fields = [
+                (field, fmt) for i, (field, fmt) in enumerate(layout) if mask & (1 << i)
+            ]
+            record_struct = struct.Struct(
+                "<" + "".join(["6s" if fmt == "mac" else fmt for _, fmt in fields])
+            )
+            record = self._records[(version, mask)] = (record_struct, fields)
+        return record
+
+    def encode(self, item):
+        """
+        Encode the item into a binary record. Return None if the item has
+        fields or values which don't fit the layout.
+        """
+        mask = 0
+        values = []
+        for i, (field, fmt) in enumerate(self.layouts[self.version]):
+            value = item.get(field)
+            if value is None:
+                continue
+            if fmt == "mac":
+                if not isinstance(value, str) or len(value) != 12:
+                    return None
+                try:
+                    value = bytes.fromhex(value)
+                except ValueError:
+                    return None
+            mask |= 1 << i
+            values.append(value)
+
+        if len(values) != sum([1 for value in item.values() if value is not None]):
+            return None
+
+        try:
+            return self.header.pack(self.marker, self.version, mask) + self._record(
+                self.version, mask
+            )[0].pack(*values)
+        except struct.error:
+            return None
+
+    def decode(self, value):
+        """
+        Decode a binary record into a sparse dictionary. Raise a
+        ValueError if the record can't be decoded.
+        """
+        try:
+            marker, version, mask = self.header.unpack_from(value)
+        except struct.error:
+            raise ValueError("Truncated record header.")
+        if marker != self.marker or version not in self.layouts:
+            raise ValueError("Unknown record version %s." % version)
+        if mask >> len(self.layouts[version]):
+            raise ValueError("Unknown fields in record.")
+
+        record_struct, fields = self._record(version, mask)
+        if len(value) != self.header.size + record_struct.size:
+            raise ValueError("Record has the wrong size.")
+
+        item = {}
+        values = record_struct.unpack_from(value, self.header.size)
+        for (field, fmt), field_value in zip(fields, values):
+            if fmt == "mac":
+                field_value = field_value.hex()
+            item[field] = field_value
+        return item
+
 
 class DataQueue(object):
     """
@@ -21,14 +176,40 @@ class DataQueue(object):
     queue_max_age = 3600  # Maximum age that data can sit in the queue.
 
     def __init__(
-        self, key, redis_client, data_type, batch=0, compress=False, json=True
+        self,
+        key,
+        redis_client,
+        data_type,
+        batch=0,
+        compress=False,
+        json=True,
+        batch_target=0,
+        codec=None,
+        binary=False,
     ):
+        """
+        :param batch_target: Target processing time of a batch in seconds.
+            If set, the batch size is adapted by a :class:`BatchController`
+            for the consumers using :meth:`processing`.
+        :param codec: A :class:`BinaryCodec` for the items of a JSON queue.
+            Binary records in the queue are decoded with it, JSON encoded
+            items can be mixed with them.
+        :param binary: Whether new items are encoded with the codec. Items
+            the codec can't encode are still JSON encoded.
+        """
         self.key = key
         self.redis_client = redis_client
         self.batch = batch
         self.compress = compress
         self.json = json
+        self.codec = codec
+        self.binary = bool(binary and codec is not None)
         self.tags = {"queue_type": "data", "data_type": data_type}
+        self.controller = None
+        if batch and batch_target > 0:
+            self.controller = BatchController(batch, batch_target)
+        self._size = 0
+        self._depth = 0
 
     def dequeue(self, batch=None):
         """
@@ -45,15 +226,73 @@ class DataQueue(object):
             else:
                 # special case for deleting everything
                 pipe.ltrim(self.key, 1, 0)
-            result = pipe.execute()[0]
+            pipe.llen(self.key)
+            result, _, self._depth = pipe.execute()
+            self._size = len(result)
 
             if self.compress:
                 result = [util.decode_gzip(item) for item in result]
             if self.json:
-                result = [json.loads(item.decode("utf-8")) for item in result]
+                result = self._decode(result)
+
+        return result
 
+    def _decode(self, items):
+        result = []
+        errors = 0
+        for item in items:
+            if self.codec is not None and BinaryCodec.is_record(item):
+                try:
+                    result.append(self.codec.decode(item))
+                except ValueError:
+                    errors += 1
+            else:
+                result.append(json.loads(item.decode("utf-8")))
+
+        if errors:
+            METRICS.incr(
+                "queue.decode_error",
+                errors,
+                tags=["queue:" + self.key, "data_type:" + self.tags["data_type"]],
+            )
         return result
 
+    def _encode(self, item):
+        if self.binary:
+            value = self.codec.encode(item)
+            if value is not None:
+                return value
+        return json.dumps(item).encode("utf-8")
+
+    @contextmanager
+    def processing(self):
+        """
+        Measure the processing of the batches dequeued inside the with
+        block, and adapt the batch size to it.
+
+        The batch size is only adapted if the block finishes without an
+        exception and the queue has a :class:`BatchController`.
+        """
+        self._size = 0
+        start = time.monotonic()
+        with count_mysql_lock_retries() as retries:
+            yield
+
+        if self.controller is None:
+            return
+        self.batch = self.controller.adapt(
+            self.batch,
+            self._size,
+            time.monotonic() - start,
+            retries.count,
+            self._depth,
+        )
+        METRICS.gauge(
+            "queue.batch",
+            self.batch,
+            tags=["queue:" + self.key, "data_type:" + self.tags["data_type"]],
+        )
+
     def _push(self, pipe, items, batch):
         for i in range(0, len(items), batch):
             pipe.rpush(self.key, *items[i : i + batch])
@@ -75,7 +314,7 @@ class DataQueue(object):
             batch = len(items)
 
         if self.json:
-            items = [json.dumps(item).encode("utf-8") for item in items]
+            items = [self._encode(item) for item in items]
 
         if self.compress:
             items = [util.encode_gzip(item) for item in items]
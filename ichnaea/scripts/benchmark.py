@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+"""
+Run micro-benchmarks for performance sensitive code paths.
+
+Each benchmark compares the current implementation against the simpler
+reference implementation it replaced, and prints one line per input size.
+
+Database benchmarks run against the read-only database.
+"""
+
+import argparse
+from datetime import timedelta
+import itertools
+import json
+import math
+import sys
+from timeit import default_timer
+import tracemalloc
+from types import SimpleNamespace
+
+import numpy
+from scipy.optimize import leastsq
+
+from geocalc import distance, pairwise_haversine_distance
+from ichnaea.api.locate.cache import MAC_FIELDS, query_shards
+from ichnaea.api.locate.mac import NETWORK_DTYPE, aggregate_mac_position
+from ichnaea.data.station import WifiUpdater
+from ichnaea.db import configure_db, db_worker_session
+from ichnaea.models import ReportSource, WifiObservation, WifiShard
+from ichnaea.queue import BinaryCodec
+from ichnaea import util
+
+
+def _timeit(func, repeat):
+    """Return the best of `repeat` runs of `func`, in milliseconds."""
+    best = None
+    for _ in range(repeat):
+        start = default_timer()
+        func()
+        duration = default_timer() - start
+        if best is None or duration < best:
+            best = duration
+    return best * 1000.0
+
+
+def _random_positions(num, seed=42):
+    """Return `num` random lat/lon positions within about 1 km."""
+    random = numpy.random.RandomState(seed)
+    lats = 51.5 + random.uniform(-0.005, 0.005, num)
+    lons = -0.1 + random.uniform(-0.005, 0.005, num)
+    return lats, lons
+
+
+def _print_row(label, reference, current):
+    speedup = reference / current if current else float("inf")
+    print("%-8s %12.3f %12.3f %9.1fx" % (label, reference, current, speedup))
+
+
+def _print_header(reference, current):
+    print("%-8s %12s %12s %10s" % ("n", reference + " ms", current + " ms", "speedup"))
+
+
+def benchmark_cluster(sizes, repeat):
+    """Condensed distance matrix used by cluster_networks."""
+
+    def loop(positions):
+        length = len(positions)
+        dist_matrix = numpy.zeros(length * (length - 1) // 2, dtype=numpy.double)
+        for i, (a, b) in enumerate(itertools.combinations(positions, 2)):
+            dist_matrix[i] = distance(a[0], a[1], b[0], b[1])
+        return dist_matrix
+
+    _print_header("loop", "batched")
+    for num in sizes:
+        lats, lons = _random_positions(num)
+        positions = numpy.column_stack((lats, lons))
+        reference = _timeit(lambda: loop(positions), repeat)
+        current = _timeit(lambda: pairwise_haversine_distance(lats, lons), repeat)
+        _print_row(num, reference, current)
+
+
+def benchmark_aggregate(sizes, repeat):
+    """Least squares position estimate used by aggregate_mac_position."""
+
+    def closure(networks):
+        def func(point, points):
+            return numpy.array(
+                [
+                    distance(p["lat"], p["lon"], point[0], point[1])
+                    * min(math.sqrt(2000.0 / p["age"]), 1.0)
+                    / math.pow(p["signalStrength"], 2)
+                    for p in points
+                ]
+            )
+
+        points = numpy.array(
+            [(net["lat"], net["lon"]) for net in networks], dtype=numpy.double
+        )
+        weights = numpy.array(
+            [
+                net["score"]
+                * min(math.sqrt(2000.0 / net["age"]), 1.0)
+                / math.pow(net["signalStrength"], 2)
+                for net in networks
+            ],
+            dtype=numpy.double,
+        )
+        initial = numpy.average(points, axis=0, weights=weights)
+        (lat, lon), cov_x, info, mesg, ier = leastsq(
+            func, initial, args=networks, full_output=True
+        )
+        distances = numpy.array(
+            [distance(lat, lon, net["lat"], net["lon"]) for net in networks],
+            dtype=numpy.double,
+        )
+        return (lat, lon, numpy.percentile(distances, 95))
+
+    _print_header("closure", "vector")
+    random = numpy.random.RandomState(42)
+    for num in sizes:
+        lats, lons = _random_positions(num)
+        networks = numpy.array(
+            [
+                (lat, lon, 10.0, age, signal, score, b"", False)
+                for lat, lon, age, signal, score in zip(
+                    lats,
+                    lons,
+                    random.randint(1000, 60000, num),
+                    random.randint(-100, -30, num),
+                    random.uniform(0.1, 2.0, num),
+                )
+            ],
+            dtype=NETWORK_DTYPE,
+        )
+        reference = _timeit(lambda: closure(networks), repeat)
+        current = _timeit(lambda: aggregate_mac_position(networks, 10.0), repeat)
+        _print_row(num, reference, current)
+
+
+def benchmark_shards(sizes, repeat, db):
+    """Station lookups spanning multiple shard tables, used by query_macs."""
+    random = numpy.random.RandomState(42)
+    shards = list(WifiShard.shards().values())
+
+    _print_header("serial", "union")
+    with db_worker_session(db, commit=False) as session:
+        for num in sizes:
+            if num > len(shards):
+                break
+            # Ten lookups per shard, the size is the number of shards.
+            shard_keys = {
+                shard: ["%012x" % mac for mac in random.randint(0, 2**47, 10)]
+                for shard in shards[:num]
+            }
+            reference = _timeit(
+                lambda: query_shards(
+                    session, shard_keys, MAC_FIELDS, "mac", union=False
+                ),
+                repeat,
+            )
+            current = _timeit(
+                lambda: query_shards(
+                    session, shard_keys, MAC_FIELDS, "mac", union=True
+                ),
+                repeat,
+            )
+            _print_row(num, reference, current)
+
+
+def _station_batch(num, seed=42):
+    """
+    Return a batch of observations for `num` wifi stations, five per
+    station, and existing station rows for every other station.
+    """
+    random = numpy.random.RandomState(seed)
+    modified = util.utcnow() - timedelta(days=10)
+    shard_values = {}
+    stations = {}
+    for i in range(num):
+        mac = "%012x" % (0x0A0000000000 + i)
+        lats, lons = _random_positions(5, seed=seed + i)
+        source = ReportSource.query if i % 3 == 0 else ReportSource.gnss
+        observations = [
+            WifiObservation.create(
+                mac=mac,
+                lat=lat,
+                lon=lon,
+                accuracy=accuracy,
+                signal=signal,
+                source=source,
+            )
+            for lat, lon, accuracy, signal in zip(
+                lats.tolist(),
+                lons.tolist(),
+                random.uniform(5.0, 50.0, 5).tolist(),
+                random.randint(-90, -50, 5).tolist(),
+            )
+        ]
+        shard_values[observations[0].unique_key] = observations
+        if i % 2:
+            station = WifiShard.create(
+                mac=mac,
+                lat=51.5,
+                lon=-0.1,
+                max_lat=51.501,
+                min_lat=51.499,
+                max_lon=-0.099,
+                min_lon=-0.101,
+                radius=100,
+                region="GB",
+                samples=10,
+                source=ReportSource.gnss,
+                weight=10.0,
+                created=modified,
+                modified=modified,
+                last_seen=modified.date(),
+            )
+            stations[station.unique_key] = station
+    return shard_values, stations
+
+
+def benchmark_update(sizes, repeat):
+    """Station states and transitions used by StationUpdater.update_shard."""
+    updater = WifiUpdater(
+        SimpleNamespace(app=SimpleNamespace(data_queues={"update_wifi_0": None})),
+        shard_id="0",
+    )
+
+    def transitions(states):
+        for state in states:
+            transition = state.transition()
+            if transition is not None:
+                transition()
+
+    _print_header("state", "columnar")
+    for num in sizes:
+        shard_values, stations = _station_batch(num)
+        reference = _timeit(
+            lambda: transitions(updater.station_states(shard_values, {}, stations)),
+            repeat,
+        )
+        current = _timeit(
+            lambda: transitions(
+                updater.columnar_station_states(shard_values, {}, stations)
+            ),
+            repeat,
+        )
+        _print_row(num, reference, current)
+
+
+def benchmark_queue(sizes, repeat):
+    """Encoding and decoding of the observations in the station update queues."""
+    codec = BinaryCodec(WifiObservation._binary_layouts)
+
+    def round_trip_json(items):
+        for item in items:
+            json.loads(json.dumps(item).encode("utf-8").decode("utf-8"))
+
+    def round_trip_binary(items):
+        for item in items:
+            codec.decode(codec.encode(item))
+
+    _print_header("json", "binary")
+    for num in sizes:
+        shard_values, _ = _station_batch(num)
+        items = [obs.to_json() for values in shard_values.values() for obs in values]
+        reference = _timeit(lambda: round_trip_json(items), repeat)
+        current = _timeit(lambda: round_trip_binary(items), repeat)
+        _print_row(num, reference, current)
+
+
+def benchmark_decode(sizes, repeat):
+    """Observations created from the station update queues by shard_observations."""
+
+    def construct(items):
+        for item in items:
+            item = dict(item, source=ReportSource(item["source"]))
+            WifiObservation(**item)
+
+    def from_json(items):
+        for item in items:
+            WifiObservation.from_json(dict(item))
+
+    _print_header("init", "from_json")
+    for num in sizes:
+        shard_values, _ = _station_batch(num)
+        items = [obs.to_json() for values in shard_values.values() for obs in values]
+        reference = _timeit(lambda: construct(items), repeat)
+        current = _timeit(lambda: from_json(items), repeat)
+        _print_row(num, reference, current)
+
+
+def benchmark_memory(sizes, repeat):
+    """Memory used by the observations held in a station update batch."""
+    # The same class with an instance dictionary instead of slots.
+    reference_cls = type(
+        "WifiObservation",
+        WifiObservation.__bases__,
+        dict(
+            [
+                (name, value)
+                for name, value in vars(WifiObservation).items()
+                if name != "__slots__" and name not in WifiObservation.__slots__
+            ]
+        ),
+    )
+
+    def allocated(obs_cls, items):
+        tracemalloc.start()
+        try:
+            observations = [obs_cls.from_json(item) for item in items]
+            for obs in observations:
+                obs.unique_key, obs.weight, hash(obs)
+            return tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+
+    print("%-8s %12s %12s %10s" % ("n", "dict KiB", "slots KiB", "ratio"))
+    for num in sizes:
+        shard_values, _ = _station_batch(num)
+        items = [obs.to_json() for values in shard_values.values() for obs in values]
+        reference = allocated(reference_cls, items) / 1024.0
+        current = allocated(WifiObservation, items) / 1024.0
+        _print_row(num, reference, current)
+
+
+BENCHMARKS = {
+    "aggregate": benchmark_aggregate,
+    "cluster": benchmark_cluster,
+    "decode": benchmark_decode,
+    "memory": benchmark_memory,
+    "queue": benchmark_queue,
+    "shards": benchmark_shards,
+    "update": benchmark_update,
+}
+DATABASE_BENCHMARKS = ("shards",)
+
+
+def main(argv, _db=None):
+    parser = argparse.ArgumentParser(prog=argv[0], description="Run micro-benchmarks.")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument(
+        "--min-size", type=int, default=2, help="Smallest input size (default 2)."
+    )
+    parser.add_argument(
+        "--max-size", type=int, default=100, help="Largest input size (default 100)."
+    )
+    parser.add_argument(
+        "--step", type=int, default=1, help="Input size increment (default 1)."
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Runs per input size (default 5)."
+    )
+
+    args = parser.parse_args(argv[1:])
+    sizes = range(args.min_size, args.max_size + 1, args.step)
+    if args.benchmark in DATABASE_BENCHMARKS:
+        db = configure_db("ro", _db=_db, pool=False)
+        BENCHMARKS[args.benchmark](sizes, args.repeat, db)
+    else:
+        BENCHMARKS[args.benchmark](sizes, args.repeat)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
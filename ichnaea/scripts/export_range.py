@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""
+Write one cellid range of a cell shard table to a gzip file.
+
+This is run in a separate process for each range of a parallel cell
+export, see :func:`ichnaea.data.public.write_stations_to_csv_parallel`.
+The cell export task runs in a daemonic Celery worker process, which
+can't start a multiprocessing pool of its own.
+
+The script connects to the read-only database configured by the
+DB_READONLY_URI setting and prints the number of written rows.
+"""
+
+import argparse
+import sys
+
+from ichnaea.data.public import write_range_to_csv
+from ichnaea.db import configure_db, db_worker_session
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog=argv[0], description="Write one cellid range of a cell export."
+    )
+    parser.add_argument("path", help="Path of the gzip file.")
+    parser.add_argument("table", help="The cell shard table.")
+    parser.add_argument("where", help="The SQL condition of the export.")
+    parser.add_argument("min_cellid", help="Hex encoded, exclusive minimum cellid.")
+    parser.add_argument(
+        "max_cellid", help="Hex encoded, inclusive maximum cellid, empty for none."
+    )
+
+    args = parser.parse_args(argv[1:])
+    min_cellid = bytes.fromhex(args.min_cellid)
+    max_cellid = bytes.fromhex(args.max_cellid) if args.max_cellid else None
+
+    db = configure_db("ro", pool=False)
+    try:
+        with db_worker_session(db, commit=False) as session:
+            num_rows = write_range_to_csv(
+                session, args.path, args.table, args.where, min_cellid, max_cellid
+            )
+    finally:
+        db.close()
+
+    print(num_rows)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -5,9 +5,8 @@ Import from public cell data into a local dev environment.
 Download from https://location.services.mozilla.com/downloads
 
 This has been tested with a differential cell export (~400kB compressed).
-A full cell export (~370,000kB) contains unexpected data that will
-require code changes to handle gracefully, and may require adjusting
-the resources of the development environment.
+A full cell export (~370,000kB) should be imported with the --bulk option,
+which reads, validates and writes the stations in large chunks.
 """
 
 import argparse
@@ -15,11 +14,12 @@ import logging
 import os
 import os.path
 import sys
+import time
 
 from ichnaea.conf import settings
 from ichnaea.db import db_worker_session
 from ichnaea.log import configure_logging
-from ichnaea.data.public import read_stations_from_csv
+from ichnaea.data.public import read_stations_from_csv, read_stations_from_csv_bulk
 from ichnaea.taskapp.config import init_worker
 from ichnaea.util import gzip_open
 
@@ -50,6 +50,17 @@ def main(argv, _db=None):
         ),
     )
     parser.add_argument("filename", help="Path to the csv.gz import file.")
+    parser.add_argument(
+        "--bulk",
+        action="store_true",
+        help="Import the stations in chunks, for large files like a full export.",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=50000,
+        help="Number of rows per chunk of a bulk import (default 50000).",
+    )
 
     args = parser.parse_args(argv[1:])
 
@@ -70,9 +81,30 @@ def main(argv, _db=None):
 
     with db_worker_session(celery_app.db, commit=False) as session:
         with gzip_open(filename, "r") as file_handle:
-            read_stations_from_csv(
-                session, file_handle, celery_app.redis_client, cellarea_queue
-            )
+            if args.bulk:
+                start = time.monotonic()
+
+                def report_progress(rows):
+                    duration = time.monotonic() - start
+                    LOGGER.info(
+                        "Processed %d rows in %.1f seconds (%d rows/sec).",
+                        rows,
+                        duration,
+                        rows / max(duration, 0.001),
+                    )
+
+                read_stations_from_csv_bulk(
+                    session,
+                    file_handle,
+                    celery_app.redis_client,
+                    cellarea_queue,
+                    chunk_size=args.chunk_size,
+                    progress=report_progress,
+                )
+            else:
+                read_stations_from_csv(
+                    session, file_handle, celery_app.redis_client, cellarea_queue
+                )
     return 0
 
 
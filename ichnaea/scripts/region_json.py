@@ -1,6 +1,7 @@
 """
 Parse naturalearth 50m admin subunits dataset and generate minimal
-GeoJSON files for regions and buffered regions.
+GeoJSON files for regions and buffered regions, and the region index
+file used by the Geocoder.
 
 Script is installed as `location_region_json`.
 
@@ -347,8 +348,16 @@ def main(argv):
         prog=argv[0], description="Create region GeoJSON files."
     )
 
-    # implicitly parse and react to -h/--help
-    parser.parse_args(argv[1:])
+    parser.add_argument(
+        "--index-only",
+        action="store_true",
+        help="Only build the region index file from the GeoJSON files.",
+    )
+
+    args = parser.parse_args(argv[1:])
+    if args.index_only:
+        geocode.build_region_index()
+        return 0
 
     os.system(
         "ogr2ogr -f GeoJSON "
@@ -368,6 +377,9 @@ def main(argv):
     with util.gzip_open(geocode.REGIONS_BUFFER_FILE, "w", compresslevel=7) as fd:
         fd.write(buffer_collection)
 
+    geocode.build_region_index()
+    return 0
+
 
 if __name__ == "__main__":
     sys.exit(main(sys.argv))
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""
+Run the long-running station update worker.
+
+The worker updates the station tables for the station types listed in
+the STATION_WORKER_TYPES setting, which also stops the scheduling of
+the celery update tasks for those types. Only run one station worker
+at a time.
+"""
+
+import argparse
+import os
+import sys
+
+from ichnaea.conf import settings
+from ichnaea.data.station_worker import STATION_UPDATERS, run_station_workers
+from ichnaea.log import configure_logging
+
+
+def main(argv, _run=run_station_workers):
+    parser = argparse.ArgumentParser(
+        prog=argv[0], description="Run the station update worker."
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of worker processes (default number of CPUs).",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=40.0,
+        help="Seconds between updates of shards without a full batch (default 40).",
+    )
+
+    args = parser.parse_args(argv[1:])
+
+    station_types = settings("station_worker_types")
+    if not station_types:
+        print("No station types configured, set STATION_WORKER_TYPES.")
+        return 1
+
+    unknown = set(station_types) - set(STATION_UPDATERS.keys())
+    if unknown:
+        print("Unknown station types: %s" % ", ".join(sorted(unknown)))
+        return 1
+
+    configure_logging()
+    return _run(station_types, max(args.processes, 1), interval=args.interval)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
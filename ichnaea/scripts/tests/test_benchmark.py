@@ -0,0 +1,50 @@
+from ichnaea.scripts import benchmark
+
+
+class TestBenchmark(object):
+    def test_aggregate(self, capsys):
+        argv = ["script", "aggregate", "--max-size=3", "--repeat=1"]
+        assert benchmark.main(argv) == 0
+        lines = capsys.readouterr().out.strip().split("\n")
+        assert len(lines) == 3
+        assert [line.split()[0] for line in lines[1:]] == ["2", "3"]
+
+    def test_cluster(self, capsys):
+        argv = ["script", "cluster", "--max-size=4", "--repeat=1"]
+        assert benchmark.main(argv) == 0
+        lines = capsys.readouterr().out.strip().split("\n")
+        assert len(lines) == 4
+        assert lines[0].split()[0] == "n"
+        assert [line.split()[0] for line in lines[1:]] == ["2", "3", "4"]
+
+    def test_shards(self, capsys, db):
+        argv = ["script", "shards", "--max-size=20", "--step=8", "--repeat=1"]
+        assert benchmark.main(argv, _db=db) == 0
+        lines = capsys.readouterr().out.strip().split("\n")
+        # There are only 16 wifi shards.
+        assert [line.split()[0] for line in lines[1:]] == ["2", "10"]
+
+    def test_decode(self, capsys):
+        argv = ["script", "decode", "--max-size=3", "--repeat=1"]
+        assert benchmark.main(argv) == 0
+        lines = capsys.readouterr().out.strip().split("\n")
+        assert [line.split()[0] for line in lines[1:]] == ["2", "3"]
+
+    def test_memory(self, capsys):
+        argv = ["script", "memory", "--max-size=3", "--repeat=1"]
+        assert benchmark.main(argv) == 0
+        lines = capsys.readouterr().out.strip().split("\n")
+        assert [line.split()[0] for line in lines[1:]] == ["2", "3"]
+
+    def test_queue(self, capsys):
+        argv = ["script", "queue", "--max-size=3", "--repeat=1"]
+        assert benchmark.main(argv) == 0
+        lines = capsys.readouterr().out.strip().split("\n")
+        assert [line.split()[0] for line in lines[1:]] == ["2", "3"]
+
+    def test_update(self, capsys):
+        argv = ["script", "update", "--max-size=3", "--repeat=1"]
+        assert benchmark.main(argv) == 0
+        lines = capsys.readouterr().out.strip().split("\n")
+        assert len(lines) == 3
+        assert [line.split()[0] for line in lines[1:]] == ["2", "3"]
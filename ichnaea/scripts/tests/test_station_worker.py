@@ -0,0 +1,31 @@
+from unittest import mock
+
+from ichnaea.scripts import station_worker
+from ichnaea.scripts.station_worker import main
+
+
+class TestMain(object):
+    def _main(self, argv, station_types):
+        run = mock.Mock(return_value=0)
+        with mock.patch.object(
+            station_worker, "settings", return_value=station_types
+        ), mock.patch.object(station_worker, "configure_logging"):
+            result = main(["script"] + argv, _run=run)
+        return (result, run)
+
+    def test_run(self):
+        result, run = self._main(["--processes=3", "--interval=5"], ["cell", "wifi"])
+        assert result == 0
+        run.assert_called_once_with(["cell", "wifi"], 3, interval=5.0)
+
+    def test_no_types(self, capsys):
+        result, run = self._main([], [])
+        assert result == 1
+        assert not run.called
+        assert "STATION_WORKER_TYPES" in capsys.readouterr().out
+
+    def test_unknown_types(self, capsys):
+        result, run = self._main([], ["wifi", "gsm"])
+        assert result == 1
+        assert not run.called
+        assert "gsm" in capsys.readouterr().out
@@ -5,11 +5,20 @@ Contains celery specific one-time configuration code.
 from kombu import Queue
 
 from ichnaea.cache import configure_redis
+from ichnaea.conf import settings
 from ichnaea.db import configure_db
 from ichnaea.geoip import configure_geoip
 from ichnaea.log import configure_raven, configure_stats
-from ichnaea.models import BlueShard, CellShard, DataMap, WifiShard
-from ichnaea.queue import DataQueue
+from ichnaea.models import (
+    BlueObservation,
+    BlueShard,
+    CellObservation,
+    CellShard,
+    DataMap,
+    WifiObservation,
+    WifiShard,
+)
+from ichnaea.queue import BinaryCodec, DataQueue
 
 TASK_QUEUES = (
     Queue("celery_blue", routing_key="celery_blue"),
@@ -39,30 +48,71 @@ def configure_data(redis_client):
     """
     Configure fixed set of data queues.
     """
+    target = settings("data_queue_batch_target")
+    binary = settings("data_queue_binary_observations")
+    blue_codec = BinaryCodec(BlueObservation._binary_layouts)
+    cell_codec = BinaryCodec(CellObservation._binary_layouts)
+    wifi_codec = BinaryCodec(WifiObservation._binary_layouts)
     data_queues = {
         # *_incoming need to be the exact same as in webapp.config
         "update_incoming": DataQueue(
-            "update_incoming", redis_client, "report", batch=5000, compress=True
+            "update_incoming",
+            redis_client,
+            "report",
+            batch=5000,
+            compress=True,
+            batch_target=target,
         )
     }
     for key in ("update_cellarea",):
         data_queues[key] = DataQueue(
-            key, redis_client, "cellarea", batch=100, json=False
+            key, redis_client, "cellarea", batch=100, json=False, batch_target=target
         )
+    data_queues["update_cellarea_delta"] = DataQueue(
+        "update_cellarea_delta",
+        redis_client,
+        "cellarea_delta",
+        batch=100,
+        batch_target=target,
+    )
     for shard_id in BlueShard.shards().keys():
         key = "update_blue_" + shard_id
-        data_queues[key] = DataQueue(key, redis_client, "bluetooth", batch=500)
+        data_queues[key] = DataQueue(
+            key,
+            redis_client,
+            "bluetooth",
+            batch=500,
+            batch_target=target,
+            codec=blue_codec,
+            binary=binary,
+        )
     for shard_id in DataMap.shards().keys():
         key = "update_datamap_" + shard_id
         data_queues[key] = DataQueue(
-            key, redis_client, "datamap", batch=500, json=False
+            key, redis_client, "datamap", batch=500, json=False, batch_target=target
         )
     for shard_id in CellShard.shards().keys():
         key = "update_cell_" + shard_id
-        data_queues[key] = DataQueue(key, redis_client, "cell", batch=500)
+        data_queues[key] = DataQueue(
+            key,
+            redis_client,
+            "cell",
+            batch=500,
+            batch_target=target,
+            codec=cell_codec,
+            binary=binary,
+        )
     for shard_id in WifiShard.shards().keys():
         key = "update_wifi_" + shard_id
-        data_queues[key] = DataQueue(key, redis_client, "wifi", batch=500)
+        data_queues[key] = DataQueue(
+            key,
+            redis_client,
+            "wifi",
+            batch=500,
+            batch_target=target,
+            codec=wifi_codec,
+            binary=binary,
+        )
     return data_queues
 
 
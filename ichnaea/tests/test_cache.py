@@ -0,0 +1,150 @@
+from datetime import date, datetime, timedelta
+from unittest import mock
+
+import gevent
+import pytest
+from redis.exceptions import RedisError
+
+from ichnaea.cache import (
+    decode_station,
+    encode_station,
+    configure_runtime_config,
+    RedisCoalescer,
+    RuntimeConfig,
+    station_cache_key,
+    STATION_RECORD,
+)
+from ichnaea.api.locate.cache import MacRow
+from ichnaea.util import UTC
+
+
+class TestStationRecord(object):
+    def test_roundtrip(self):
+        row = MacRow(
+            "0123456789ab",
+            51.5,
+            -0.1,
+            150,
+            "GB",
+            20,
+            datetime(2019, 3, 1, 12, 30, 15, tzinfo=UTC),
+            datetime(2020, 1, 2, 3, 4, 5, tzinfo=UTC),
+            date(2020, 1, 2),
+            date(2019, 6, 1),
+            2,
+        )
+        value = encode_station(row)
+        assert len(value) == STATION_RECORD.size
+        decoded = decode_station(value)
+        assert decoded == row[1:]
+        # Like the database values, the datetimes have a UTC timezone.
+        assert decoded[5].tzinfo is not None
+        assert decoded[6].utcoffset() == timedelta(0)
+
+    def test_none(self):
+        row = MacRow("0123456789ab", 1.0, 2.0, *([None] * 8))
+        assert decode_station(encode_station(row)) == (1.0, 2.0) + (None,) * 8
+
+    def test_key(self):
+        assert station_cache_key("wifi_shard_0", b"\x01\x02") == (
+            b"cache:station:1:wifi_shard_0:\x01\x02"
+        )
+
+
+class TestRedisCoalescer(object):
+    @pytest.fixture
+    def coalescer(self, redis):
+        with mock.patch.object(redis, "pipeline", wraps=redis.pipeline):
+            yield RedisCoalescer(redis)
+
+    def test_prefetch(self, coalescer, redis):
+        redis.set("foo", b"1")
+        coalescer.prefetch("foo", lambda pipe: pipe.get("foo"))
+        coalescer.prefetch("foo", lambda pipe: pipe.get("foo"))
+        assert redis.pipeline.call_count == 0
+
+        def incr(pipe):
+            pipe.incr("bar")
+            pipe.incr("bar")
+
+        assert coalescer.execute(incr) == [1, 2]
+        assert coalescer.read("foo", None) == [b"1"]
+        assert redis.pipeline.call_count == 1
+
+    def test_read(self, coalescer, redis):
+        redis.set("foo", b"1")
+        assert coalescer.read("foo", lambda pipe: pipe.get("foo")) == [b"1"]
+        assert coalescer.read("foo", lambda pipe: pipe.get("foo")) == [b"1"]
+        assert redis.pipeline.call_count == 1
+
+    def test_defer(self, coalescer, redis):
+        coalescer.defer(lambda pipe: pipe.set("foo", b"1"))
+        coalescer.defer(lambda pipe: pipe.set("bar", b"2"))
+        assert redis.get("foo") is None
+        coalescer.flush()
+        coalescer.flush()
+        assert redis.mget("foo", "bar") == [b"1", b"2"]
+        assert redis.pipeline.call_count == 1
+
+    def test_not_deferred(self, redis):
+        coalescer = RedisCoalescer(redis, deferred=False)
+        coalescer.defer(lambda pipe: pipe.set("foo", b"1"))
+        assert redis.get("foo") == b"1"
+
+    def test_close(self, coalescer, redis):
+        coalescer.defer(lambda pipe: pipe.set("foo", b"1"))
+        coalescer.close()
+        assert redis.get("foo") == b"1"
+        # A greenlet outliving the request still gets its writes sent.
+        coalescer.defer(lambda pipe: pipe.set("bar", b"2"))
+        assert redis.get("bar") == b"2"
+
+    def test_failure(self, coalescer, redis):
+        coalescer.defer(lambda pipe: pipe.set("foo", b"1"))
+        with mock.patch.object(redis, "connection_pool") as pool:
+            pool.get_connection.side_effect = RedisError()
+            with pytest.raises(RedisError):
+                coalescer.execute(lambda pipe: pipe.get("bar"))
+        # Pending commands are dropped.
+        coalescer.flush()
+        assert redis.get("foo") is None
+
+
+class TestRuntimeConfig(object):
+    @pytest.fixture
+    def runtime_config(self, redis):
+        runtime_config = RuntimeConfig(redis, 0.01)
+        yield runtime_config
+        runtime_config.stop()
+
+    def test_configure(self, redis):
+        assert configure_runtime_config(redis, 0) is None
+        assert configure_runtime_config(redis, 30.0).interval == 30.0
+
+    def test_default(self, runtime_config):
+        assert runtime_config.get("global_locate_sample_rate") == 100.0
+
+    def test_invalid(self, runtime_config, redis):
+        redis.set("global_locate_sample_rate", b"abc")
+        assert runtime_config.get("global_locate_sample_rate") == 100.0
+
+    def test_refresh(self, runtime_config, redis, metricsmock):
+        redis.set("global_locate_sample_rate", b"50.5")
+        assert runtime_config.get("global_locate_sample_rate") == 50.5
+        redis.set("global_locate_sample_rate", b"0")
+        assert runtime_config.get("global_locate_sample_rate") == 50.5
+        gevent.sleep(0.05)
+        assert runtime_config.get("global_locate_sample_rate") == 0.0
+        assert metricsmock.has_record(
+            "incr", "runtime_config.refresh", value=1, tags=["status:success"]
+        )
+
+    def test_failure(self, runtime_config, redis, metricsmock):
+        redis.set("global_locate_sample_rate", b"50.0")
+        assert runtime_config.get("global_locate_sample_rate") == 50.0
+        with mock.patch.object(redis, "mget", side_effect=RedisError()):
+            gevent.sleep(0.05)
+            assert runtime_config.get("global_locate_sample_rate") == 50.0
+        assert metricsmock.has_record(
+            "incr", "runtime_config.refresh", value=1, tags=["status:failure"]
+        )
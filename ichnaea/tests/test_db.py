@@ -5,7 +5,7 @@ from pymysql.constants.ER import CONSTRAINT_FAILED, LOCK_WAIT_TIMEOUT, LOCK_DEAD
 from pymysql.err import InternalError, MySQLError, OperationalError
 from sqlalchemy.exc import InterfaceError, StatementError
 
-from ichnaea.db import retry_on_mysql_lock_fail
+from ichnaea.db import count_mysql_lock_retries, retry_on_mysql_lock_fail
 
 
 class TestDatabase:
@@ -144,3 +144,25 @@ class TestRetryOnMySQLLockFail:
         assert count == 2
         assert backoff_sleep_mock.call_count == 1
         metricsmock.assert_incr_once("dberror", tags=[f"errno:{errno}", "weight:heavy"])
+
+    @pytest.mark.parametrize(
+        "errclass,errno,errmsg", RETRIABLES.values(), ids=list(RETRIABLES.keys())
+    )
+    def test_count_retries(self, errclass, errno, errmsg, backoff_sleep_mock):
+        count = 0
+
+        @retry_on_mysql_lock_fail()
+        def raise_twice():
+            nonlocal count
+            count += 1
+            if count < 3:
+                self._raise_mysql_error(errclass, errno, errmsg)
+
+        with count_mysql_lock_retries() as retries:
+            raise_twice()
+        assert retries.count == 2
+
+        # Retries outside of the block aren't counted.
+        count = 0
+        raise_twice()
+        assert retries.count == 2
@@ -1,13 +1,21 @@
+import itertools
+
+import numpy
 import pytest
 
 from geocalc import (
     bbox,
+    circle_radii,
+    circle_radius,
     destination,
     distance,
+    distances,
     haversine_distance,
+    haversine_distances,
     vincenty_distance,
     latitude_add,
     longitude_add,
+    pairwise_haversine_distance,
     random_points,
 )
 from ichnaea import constants
@@ -113,6 +121,56 @@ class TestDistance(object):
         assert round(self.dist(-100.0, -186.0, 0.0, 0.0), 4) == 11112616.8752
 
 
+class TestDistances(object):
+    def test_empty(self):
+        empty = numpy.array([], dtype=numpy.double)
+        assert len(distances(empty, empty, empty, empty)) == 0
+
+    def test_distances(self):
+        lats = numpy.array([1.0, 0.0, 44.0337065, 51.5])
+        lons = numpy.array([1.0, 0.0, -79.4908184, -0.1])
+        other_lats = numpy.array([1.0, 0.5, 44.0349396, -51.5])
+        other_lons = numpy.array([1.0, 179.7, -79.4908184, 179.9])
+        result = distances(lats, lons, other_lats, other_lons)
+        assert len(result) == 4
+        for value, args in zip(result, zip(lats, lons, other_lats, other_lons)):
+            # Includes the haversine fallback of nearly antipodal points.
+            assert value == distance(*args)
+        assert result[0] == 0.0
+
+    def test_mismatched_length(self):
+        with pytest.raises(ValueError):
+            one = numpy.array([1.0])
+            distances(one, one, one, numpy.array([]))
+
+
+class TestCircleRadii(object):
+    def test_radii(self):
+        random = numpy.random.RandomState(42)
+        lats = random.uniform(-80.0, 80.0, 100)
+        lons = random.uniform(-180.0, 180.0, 100)
+        deltas = random.uniform(0.0, 0.5, (4, 100))
+        args = (
+            lats,
+            lons,
+            lats + deltas[0],
+            lons + deltas[1],
+            lats - deltas[2],
+            lons - deltas[3],
+        )
+        result = circle_radii(*args)
+        assert result.tolist() == [circle_radius(*values) for values in zip(*args)]
+
+    def test_null(self):
+        zeros = numpy.zeros(3, dtype=numpy.double)
+        assert circle_radii(*([zeros] * 6)).tolist() == [0, 0, 0]
+
+    def test_mismatched_length(self):
+        one = numpy.array([1.0])
+        with pytest.raises(ValueError):
+            circle_radii(one, one, one, one, one, numpy.array([]))
+
+
 class TestHaversineDistance(object):
 
     dist = haversine_distance
@@ -152,6 +210,55 @@ class TestVincentyDistance(object):
         assert round(self.dist(-100.0, -186.0, 0.0, 0.0), 4) == 11112616.8752
 
 
+class TestHaversineDistances(object):
+    def test_empty(self):
+        empty = numpy.array([], dtype=numpy.double)
+        assert len(haversine_distances(1.0, 1.0, empty, empty)) == 0
+
+    def test_distances(self):
+        lats = numpy.array([-90.0, 0.5, 44.0349396, -100.0])
+        lons = numpy.array([0.0, 179.0, -79.4908184, -186.0])
+        result = haversine_distances(44.0337065, -79.4908184, lats, lons)
+        assert len(result) == 4
+        for value, lat, lon in zip(result, lats, lons):
+            expected = haversine_distance(44.0337065, -79.4908184, lat, lon)
+            assert round(value, 4) == round(expected, 4)
+        assert round(result[2], 4) == 137.1147
+
+    def test_mismatched_length(self):
+        with pytest.raises(ValueError):
+            haversine_distances(1.0, 1.0, numpy.array([1.0]), numpy.array([]))
+
+
+class TestPairwiseHaversineDistance(object):
+    def test_empty(self):
+        empty = numpy.array([], dtype=numpy.double)
+        assert len(pairwise_haversine_distance(empty, empty)) == 0
+        one = numpy.array([1.0])
+        assert len(pairwise_haversine_distance(one, one)) == 0
+
+    def test_condensed(self):
+        lats = numpy.array([90.0, 0.0, 44.0337065, 44.0349396, -100.0])
+        lons = numpy.array([0.0, 179.0, -79.4908184, -79.4908184, -186.0])
+        result = pairwise_haversine_distance(lats, lons)
+        assert len(result) == 10
+        expected = [
+            haversine_distance(lats[i], lons[i], lats[j], lons[j])
+            for i, j in itertools.combinations(range(len(lats)), 2)
+        ]
+        for value, expected_value in zip(result, expected):
+            assert round(value, 4) == round(expected_value, 4)
+
+    def test_closeby(self):
+        lats = numpy.array([44.0337065, 44.0349396])
+        lons = numpy.array([-79.4908184, -79.4908184])
+        assert round(pairwise_haversine_distance(lats, lons)[0], 4) == 137.1147
+
+    def test_mismatched_length(self):
+        with pytest.raises(ValueError):
+            pairwise_haversine_distance(numpy.array([1.0, 2.0]), numpy.array([1.0]))
+
+
 class TestLatitudeAdd(object):
     def test_returns_min_lat(self):
         assert latitude_add(-85.0, 0.0, -1000000) == constants.MIN_LAT
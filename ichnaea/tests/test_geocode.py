@@ -1,7 +1,66 @@
-from ichnaea.geocode import GEOCODER
+import gzip
+import shutil
+
+import numpy
+import pytest
+from shapely import geometry
+
+import geocalc
+from ichnaea.geocode import (
+    build_region_index,
+    GEOCODER,
+    Geocoder,
+    REGIONS_BUFFER_FILE,
+    REGIONS_FILE,
+)
 from ichnaea.models.constants import ALL_VALID_MCCS
 
 
+def _border_corpus(num, seed=42):
+    """Return random points in Europe inside multiple buffered regions."""
+    random = numpy.random.RandomState(seed)
+    corpus = []
+    for lat, lon in zip(
+        random.uniform(35.0, 60.0, num), random.uniform(-10.0, 30.0, num)
+    ):
+        point = geometry.Point(lon, lat)
+        codes = set(
+            [
+                code
+                for code in GEOCODER._tree_codes(point.bounds)
+                if GEOCODER._buffered_shapes[code].contains(point)
+            ]
+        )
+        if len(codes) > 1:
+            corpus.append((lat, lon, codes))
+    return corpus
+
+
+def _reference_tie_break(lat, lon, buffered_codes):
+    """The former tie-break, measuring the distance to every boundary vertex."""
+    point = geometry.Point(lon, lat)
+    precise_codes = set(
+        [
+            code
+            for code in buffered_codes
+            if GEOCODER._prepared_shapes[code].contains(point)
+        ]
+    )
+    if len(precise_codes) == 1:
+        return tuple(precise_codes)[0]
+
+    distances = {}
+    for code in precise_codes or buffered_codes:
+        boundary = GEOCODER._shapes[code].boundary
+        geoms = getattr(boundary, "geoms", [boundary])
+        for geom in geoms:
+            for coord in geom.coords:
+                distances[geocalc.distance(coord[1], coord[0], lat, lon)] = code
+    if precise_codes:
+        return distances[max(distances.keys())]
+    return distances[min(distances.keys())]
+
+
 class TestGeocoder(object):
     def test_no_region(self):
         func = GEOCODER.region
@@ -22,6 +81,32 @@ class TestGeocoder(object):
         assert func(51.5142, -0.0931) == "GB"
         assert func(60.1, 20.0) == "FI"
 
+    def test_regions(self):
+        lats = [31.522, 42.83256, 46.2130, 51.5142, 0.0, 48.3]
+        lons = [34.455, 20.34221, 6.1290, -0.0931, 0.0, -7.0]
+        assert GEOCODER.regions(lats, lons) == ["XW", "RS", "FR", "GB", None, None]
+        assert GEOCODER.regions([], []) == []
+
+    @pytest.mark.parametrize("resolution", [0, 0.01, 0.5])
+    def test_grid(self, resolution):
+        exact = Geocoder(grid_resolution=0)
+        geocoder = Geocoder(grid_resolution=resolution, grid_size=100)
+        random = numpy.random.RandomState(42)
+        # Points around the borders of Europe.
+        lats = random.uniform(35.0, 60.0, 500)
+        lons = random.uniform(-10.0, 30.0, 500)
+        expected = [exact.region(lat, lon) for lat, lon in zip(lats, lons)]
+        assert [geocoder.region(lat, lon) for lat, lon in zip(lats, lons)] == expected
+        assert geocoder.regions(lats, lons) == expected
+        exact.close()
+        geocoder.close()
+
+    def test_tie_break(self):
+        corpus = _border_corpus(10000)
+        assert len(corpus) > 100
+        for lat, lon, codes in corpus:
+            assert GEOCODER.region(lat, lon) == _reference_tie_break(lat, lon, codes)
+
     def test_in_region(self):
         func = GEOCODER.in_region
         assert func(51.5142, -0.0931, "GB")
@@ -43,6 +128,18 @@ class TestGeocoder(object):
         assert func(31.522, 34.455, 425) == "XW"
         assert func(0.0, 0.0, 234) is None
 
+    def test_regions_for_cells(self):
+        lats = [51.5142, 51.5142, 46.2130, 46.5743, 31.522, 0.0, 46.2130]
+        lons = [-0.0931, -0.0931, 6.1290, 6.3532, 34.455, 0.0, 6.1290]
+        mccs = [234, 235, 228, 208, 425, 234, 262]
+        expected = [
+            GEOCODER.region_for_cell(lat, lon, mcc)
+            for lat, lon, mcc in zip(lats, lons, mccs)
+        ]
+        assert expected == ["GB", "GB", "CH", "FR", "XW", None, None]
+        assert GEOCODER.regions_for_cells(lats, lons, mccs) == expected
+        assert GEOCODER.regions_for_cells([], [], []) == []
+
     def test_region_for_code(self):
         func = GEOCODER.region_for_code
         assert func("GB").code == "GB"
@@ -60,6 +157,68 @@ class TestGeocoder(object):
             assert GEOCODER.region_max_radius(invalid) is None
 
 
+class TestRegionIndex(object):
+    @pytest.fixture(scope="class")
+    def index_file(self, tmp_path_factory):
+        index_file = str(tmp_path_factory.mktemp("geocode") / "regions.idx")
+        build_region_index(index_file)
+        return index_file
+
+    def test_lazy(self, index_file):
+        geocoder = Geocoder(index_file=index_file)
+        assert not geocoder.loaded
+        assert geocoder.region(51.5142, -0.0931) == "GB"
+        assert geocoder.loaded
+        assert geocoder._index is not None
+        # Only the shapes needed for the lookup were parsed.
+        assert "GB" in geocoder._buffered_shapes
+        assert len(geocoder._buffered_shapes) < 5
+        assert not geocoder._shapes
+        geocoder.close()
+
+    def test_unused(self, index_file):
+        geocoder = Geocoder(index_file=index_file)
+        geocoder.close()
+        assert not geocoder.loaded
+
+    def test_same_results(self, index_file):
+        geocoder = Geocoder(index_file=index_file)
+        assert geocoder.valid_regions == GEOCODER.valid_regions
+        for code in ("GB", "US", "VA", "XW"):
+            assert geocoder.region_max_radius(code) == GEOCODER.region_max_radius(code)
+        random = numpy.random.RandomState(42)
+        lats = random.uniform(-60.0, 75.0, 1000)
+        lons = random.uniform(-180.0, 180.0, 1000)
+        assert geocoder.regions(lats, lons) == GEOCODER.regions(lats, lons)
+        for lat, lon, codes in _border_corpus(2000):
+            assert geocoder.region(lat, lon) == GEOCODER.region(lat, lon)
+        geocoder.close()
+
+    def test_outdated(self, index_file, tmp_path):
+        # Same content, but a different file.
+        regions_file = str(tmp_path / "regions.geojson.gz")
+        with gzip.open(REGIONS_FILE, "rb") as src:
+            with gzip.open(regions_file, "wb", compresslevel=1) as dst:
+                shutil.copyfileobj(src, dst)
+
+        geocoder = Geocoder(
+            regions_file=regions_file,
+            buffer_file=REGIONS_BUFFER_FILE,
+            index_file=index_file,
+        )
+        assert geocoder.region(51.5142, -0.0931) == "GB"
+        assert geocoder._index is None
+        geocoder.close()
+
+    def test_invalid(self, tmp_path):
+        index_file = tmp_path / "regions.idx"
+        index_file.write_bytes(b"invalid")
+        geocoder = Geocoder(index_file=str(index_file))
+        assert geocoder.region(51.5142, -0.0931) == "GB"
+        assert geocoder._index is None
+        geocoder.close()
+
+
 class TestRegionsForMcc(object):
     def test_no_match(self):
         assert GEOCODER.regions_for_mcc(None) == []
@@ -1,6 +1,19 @@
+from unittest import mock
 from uuid import uuid4
 
-from ichnaea.queue import DataQueue
+import pytest
+from pymysql.constants.ER import LOCK_DEADLOCK
+from pymysql.err import MySQLError, OperationalError
+from sqlalchemy.exc import InterfaceError
+
+from ichnaea.db import retry_on_mysql_lock_fail
+from ichnaea.models import BlueObservation, CellObservation, WifiObservation
+from ichnaea.queue import BatchController, BinaryCodec, DataQueue
+from ichnaea.tests.factories import (
+    BlueObservationFactory,
+    CellObservationFactory,
+    WifiObservationFactory,
+)
 
 
 class TestDataQueue(object):
@@ -72,3 +85,223 @@ class TestDataQueue(object):
         assert queue.size() == 2
         queue.dequeue()
         assert queue.size() == 0
+
+
+class TestBatchController(object):
+    def test_bounds(self):
+        controller = BatchController(500, 2.0)
+        assert controller.min_batch == 50
+        assert controller.max_batch == 5000
+        assert controller.adapt(60, 60, 0.1, 1, 0) == 50
+        assert controller.adapt(4000, 4000, 0.1, 0, 100000) == 5000
+
+    def test_retries(self):
+        controller = BatchController(500, 2.0)
+        assert controller.adapt(500, 500, 0.1, 1, 100000) == 250
+
+    def test_slow(self):
+        controller = BatchController(500, 2.0)
+        assert controller.adapt(500, 500, 2.5, 0, 100000) == 400
+        assert controller.adapt(500, 500, 10.0, 0, 100000) == 250
+
+    def test_backlog(self):
+        controller = BatchController(500, 2.0)
+        assert controller.adapt(500, 500, 0.5, 0, 1000) == 750
+        # Not fast enough to grow.
+        assert controller.adapt(500, 500, 1.5, 0, 1000) == 500
+
+    def test_quiet(self):
+        controller = BatchController(500, 2.0)
+        assert controller.adapt(2000, 100, 0.1, 0, 0) == 1250
+        assert controller.adapt(100, 100, 0.1, 0, 0) == 300
+        assert controller.adapt(500, 100, 0.1, 0, 0) == 500
+
+
+class TestAdaptiveBatch(object):
+    def _make_queue(self, redis, batch=100, batch_target=2.0):
+        return DataQueue(
+            uuid4().hex, redis, "data", batch=batch, batch_target=batch_target
+        )
+
+    def test_disabled(self, redis):
+        queue = self._make_queue(redis, batch_target=0)
+        assert queue.controller is None
+        queue.enqueue(list(range(1000)))
+        with queue.processing():
+            queue.dequeue()
+        assert queue.batch == 100
+
+    def test_backlog(self, redis, metricsmock):
+        queue = self._make_queue(redis)
+        queue.enqueue(list(range(1000)))
+        with queue.processing():
+            assert len(queue.dequeue()) == 100
+        assert queue.batch == 150
+        metricsmock.assert_gauge_once(
+            "queue.batch", value=150, tags=["queue:" + queue.key, "data_type:data"]
+        )
+
+        with queue.processing():
+            assert len(queue.dequeue()) == 150
+        assert queue.batch == 225
+
+    def test_slow(self, redis):
+        queue = self._make_queue(redis)
+        queue.enqueue(list(range(1000)))
+        with mock.patch("ichnaea.queue.time.monotonic", side_effect=[0.0, 4.0]):
+            with queue.processing():
+                queue.dequeue()
+        assert queue.batch == 50
+
+    def test_lock_retries(self, redis, backoff_sleep_mock):
+        queue = self._make_queue(redis)
+        queue.enqueue(list(range(1000)))
+        count = 0
+
+        @retry_on_mysql_lock_fail()
+        def update():
+            nonlocal count
+            count += 1
+            if count < 2:
+                raise InterfaceError.instance(
+                    statement="SELECT 1",
+                    params={},
+                    orig=OperationalError(LOCK_DEADLOCK, "Deadlock found"),
+                    dbapi_base_err=MySQLError,
+                )
+
+        with queue.processing():
+            queue.dequeue()
+            update()
+        assert queue.batch == 50
+
+    def test_error(self, redis):
+        queue = self._make_queue(redis)
+        queue.enqueue(list(range(1000)))
+        with pytest.raises(ValueError):
+            with queue.processing():
+                queue.dequeue()
+                raise ValueError()
+        assert queue.batch == 100
+
+
+class TestBinaryCodec(object):
+    layouts = {1: (("mac", "mac"), ("signal", "h")), 2: (("lat", "d"), ("age", "i"))}
+
+    def test_round_trip(self):
+        codec = BinaryCodec(self.layouts)
+        value = codec.encode({"lat": 51.5, "age": -10})
+        assert BinaryCodec.is_record(value)
+        assert len(value) == 18
+        assert codec.decode(value) == {"lat": 51.5, "age": -10}
+        assert codec.decode(codec.encode({"age": 0, "lat": None})) == {"age": 0}
+
+    def test_old_version(self):
+        old_codec = BinaryCodec({1: self.layouts[1]})
+        value = old_codec.encode({"mac": "a82066a8b0c1", "signal": -80})
+        assert len(value) == 14
+        codec = BinaryCodec(self.layouts)
+        assert codec.decode(value) == {"mac": "a82066a8b0c1", "signal": -80}
+
+    def test_unknown_version(self):
+        value = BinaryCodec(self.layouts).encode({"lat": 1.0})
+        with pytest.raises(ValueError):
+            BinaryCodec({1: self.layouts[1]}).decode(value)
+
+    def test_invalid(self):
+        codec = BinaryCodec(self.layouts)
+        value = codec.encode({"lat": 1.0})
+        for invalid in (value[:5], value[:-1], value + b"\x00"):
+            with pytest.raises(ValueError):
+                codec.decode(invalid)
+
+    def test_unsupported(self):
+        codec = BinaryCodec({1: self.layouts[1]})
+        assert codec.encode({"mac": "a82066a8b0c1", "extra": 1}) is None
+        assert codec.encode({"mac": "a82066"}) is None
+        assert codec.encode({"mac": "not-a-mac-ab"}) is None
+        assert codec.encode({"signal": 1.5}) is None
+        assert codec.encode({"signal": 100000}) is None
+
+    @pytest.mark.parametrize(
+        "model,factory",
+        [
+            (BlueObservation, BlueObservationFactory),
+            (CellObservation, CellObservationFactory),
+            (WifiObservation, WifiObservationFactory),
+        ],
+    )
+    def test_observations(self, model, factory):
+        for layout in model._binary_layouts.values():
+            assert tuple([field for field, _ in layout]) == model._fields
+
+        codec = BinaryCodec(model._binary_layouts)
+        obs = factory.build(
+            accuracy=12.5,
+            altitude=100.0,
+            altitude_accuracy=8.0,
+            heading=90.0,
+            pressure=1013.0,
+            speed=3.5,
+            timestamp=1405602028568,
+            age=-1500,
+        )
+        value = obs.to_json()
+        record = codec.encode(value)
+        assert record is not None
+        assert codec.decode(record) == value
+        assert model.from_json(codec.decode(record)) == obs
+
+
+class TestBinaryQueue(object):
+    def _make_queue(self, redis, binary=True, compress=False):
+        return DataQueue(
+            uuid4().hex,
+            redis,
+            "wifi",
+            compress=compress,
+            codec=BinaryCodec(WifiObservation._binary_layouts),
+            binary=binary,
+        )
+
+    def test_binary(self, redis):
+        queue = self._make_queue(redis)
+        items = [{"mac": "a82066a8b0c1", "signal": -80}, {"mac": "invalid"}]
+        queue.enqueue(items)
+        values = redis.lrange(queue.key, 0, -1)
+        assert BinaryCodec.is_record(values[0])
+        assert not BinaryCodec.is_record(values[1])
+        assert queue.dequeue() == items
+
+    def test_compress(self, redis):
+        queue = self._make_queue(redis, compress=True)
+        items = [{"mac": "a82066a8b0c1", "lat": 1.0}]
+        queue.enqueue(items)
+        assert queue.dequeue() == items
+
+    def test_mixed(self, redis):
+        json_queue = self._make_queue(redis, binary=False)
+        queue = self._make_queue(redis)
+        queue.key = json_queue.key
+        json_queue.enqueue([{"mac": "a82066a8b0c1"}])
+        queue.enqueue([{"mac": "a82066a8b0c2"}])
+        json_queue.enqueue([{"mac": "a82066a8b0c3"}])
+        assert not BinaryCodec.is_record(redis.lindex(queue.key, 0))
+        assert json_queue.dequeue() == [
+            {"mac": "a82066a8b0c1"},
+            {"mac": "a82066a8b0c2"},
+            {"mac": "a82066a8b0c3"},
+        ]
+
+    def test_decode_error(self, redis, metricsmock):
+        queue = self._make_queue(redis)
+        newer = BinaryCodec({1: (), 2: (("mac", "mac"),)})
+        redis.rpush(
+            queue.key,
+            newer.encode({"mac": "a82066a8b0c1"}),
+            queue.codec.encode({"mac": "a82066a8b0c2"}),
+        )
+        assert queue.dequeue() == [{"mac": "a82066a8b0c2"}]
+        metricsmock.assert_incr_once(
+            "queue.decode_error", value=1, tags=["queue:" + queue.key, "data_type:wifi"]
+        )
@@ -10,7 +10,11 @@ from ichnaea.api.locate.searcher import (
     configure_position_searcher,
     configure_region_searcher,
 )
-from ichnaea.cache import configure_redis
+from ichnaea.cache import (
+    configure_redis,
+    configure_runtime_config,
+    redis_coalescer,
+)
 from ichnaea.conf import check_config
 from ichnaea.content.views import configure_content
 from ichnaea.db import configure_db, db_session, db_worker_session, ping_session
@@ -76,6 +80,7 @@ def main(
     )
 
     registry.redis_client = redis_client = configure_redis(_client=_redis_client)
+    registry.runtime_config = configure_runtime_config(redis_client)
 
     configure_stats()
 
@@ -106,8 +111,10 @@ def main(
         setattr(registry, name, searcher)
 
     config.add_tween("ichnaea.db.db_tween_factory", under=EXCVIEW)
+    config.add_tween("ichnaea.cache.redis_tween_factory", under=EXCVIEW)
     config.add_tween("ichnaea.log.log_tween_factory", under=EXCVIEW)
     config.add_request_method(db_session, property=True)
+    config.add_request_method(redis_coalescer, property=True)
 
     # freeze skip logging set
     config.registry.skip_logging = frozenset(config.registry.skip_logging)
@@ -127,6 +134,9 @@ def shutdown_worker(app):
         registry.db.close()
         del registry.db
         del registry.raven_client
+        if registry.runtime_config is not None:
+            registry.runtime_config.stop()
+        del registry.runtime_config
         registry.redis_client.close()
         del registry.redis_client
         registry.http_session.close()